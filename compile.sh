@@ -1,6 +1,17 @@
-alias ligo="docker run --rm -v "$PWD":"$PWD" -w "$PWD" ligolang/ligo:0.20.0"
-ligo compile-contract lqt_fa12.mligo main > michelson/lqt_fa12.tz
-ligo compile-contract dex.mligo main > michelson/dex_fa12.tz
-ligo compile-contract dex_fa2.mligo main > michelson/dex_fa2.tz
-ligo compile-contract factory.mligo main > michelson/factory_fa12.tz
-ligo compile-contract factory_fa2.mligo main > michelson/factory_fa2.tz
+# LIGO 0.34 targets Hangzhou, whose VIEW instruction and view sections the
+# dex and the liquidity token use; LIGO overrides the docker image
+LIGO=${LIGO:-"docker run --rm -v $PWD:$PWD -w $PWD ligolang/ligo:0.34.0"}
+set -e
+ligo() { $LIGO "$@" ; }
+# an output is replaced only once it compiled, so a failed run keeps the
+# committed file
+compile() { ligo compile contract "$1" --entry-point main --protocol hangzhou > "$2.tmp" ; mv "$2.tmp" "$2" ; }
+trap 'rm -f michelson/*.tmp' EXIT
+compile lqt_fa12.mligo michelson/lqt_fa12.tz
+compile dex.mligo michelson/dex_fa12.tz
+compile dex_fa2.mligo michelson/dex_fa2.tz
+python -m tools.views add michelson/lqt_fa12.tz lqt_fa12.mligo --views lqt --ligo "$LIGO"
+python -m tools.views add michelson/dex_fa12.tz dex.mligo --ligo "$LIGO"
+python -m tools.views add michelson/dex_fa2.tz dex_fa2.mligo --ligo "$LIGO"
+compile factory.mligo michelson/factory_fa12.tz
+compile factory_fa2.mligo michelson/factory_fa2.tz
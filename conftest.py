@@ -0,0 +1 @@
+"""Makes the `tools` package importable from tests/ when running `pytest` from the repository root."""
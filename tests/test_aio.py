@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from tools.aio import AsyncClient, HttpSource, check_pools
+
+from test_dex import alice_pk, backend, bob_pk, get_xtz_balance, pytezos, send_conf, setup_fa2_swaps, setup_swaps, shell
+
+if backend == "interpreter":
+    from test_dex import chain as source
+else:
+    source = HttpSource(shell)
+
+
+class SlowSource:
+    """`source` answering after `delay` seconds, recording the most calls in flight."""
+
+    def __init__(self, source, delay=0.02):
+        self.source = source
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __getattr__(self, name):
+        method = getattr(self.source, name)
+
+        def call(*args):
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                time.sleep(self.delay)
+                return method(*args)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+        return call
+
+
+class TestAsyncClient(unittest.TestCase):
+    def test_balances(self):
+        """Storage, tez, token and liquidity token balances match the blocking reads"""
+        (swap, token), = setup_swaps([(10 ** 6, 10 ** 6)])
+        (swap_fa2, token_fa2), = setup_fa2_swaps([(10 ** 6, 10 ** 6)])
+
+        async def run():
+            async with AsyncClient(source) as client:
+                pool, pool_fa2 = await client.storages([swap.address, swap_fa2.address])
+                return await asyncio.gather(
+                    client.balance(swap.address),
+                    client.token_balance(token.address, alice_pk),
+                    client.token_balance(token_fa2.address, alice_pk, 0),
+                    client.token_balance(token.address, bob_pk),
+                    client.lqt_balance(pool, alice_pk),
+                    client.lqt_balance(pool_fa2, alice_pk),
+                ), pool
+
+        (balance, tokens, tokens_fa2, no_tokens, lqt, lqt_fa2), pool = asyncio.run(run())
+        self.assertEqual(balance, get_xtz_balance(swap.address))
+        self.assertEqual(tokens, token.getBalance(alice_pk, None).callback_view())
+        self.assertEqual(tokens_fa2, token_fa2.balance_of({"requests": [{"owner": alice_pk, "token_id": 0}], "callback": None}).view()[0]["balance"])
+        self.assertEqual(no_tokens, 0)
+        self.assertEqual((lqt, lqt_fa2), (pool.lqt_total, 10 ** 6))
+
+    def test_check_pools(self):
+        """Every launched pool passes the balance checks until tokens are sent to it directly"""
+        swaps = setup_swaps([(10 ** 6, 10 ** 6)] * 4)
+        checks = check_pools(source, [swap.address for swap, _ in swaps])
+        self.assertTrue(all(check.ok for check in checks))
+
+        swap, token = swaps[2]
+        token.transfer({"from": alice_pk, "to": swap.address, "value": 5}).send(**send_conf)
+        checks = check_pools(source, [swap.address for swap, _ in swaps])
+        self.assertEqual([check.ok for check in checks], [True, True, False, True])
+        self.assertEqual(checks[2].token_balance - checks[2].token_pool, 5)
+
+    def test_bounded_concurrency(self):
+        """Reads run concurrently, never more at once than the connections"""
+        swaps = setup_swaps([(10 ** 6, 10 ** 6)] * 4)
+        slow = SlowSource(source)
+        start = time.monotonic()
+        checks = check_pools(slow, [swap.address for swap, _ in swaps] * 4, connections=4)
+        self.assertEqual(len(checks), 16)
+        self.assertGreater(slow.max_in_flight, 1)
+        self.assertLessEqual(slow.max_in_flight, 4)
+        # 16 checks of three sequential reads each take 48 delays one at a time
+        self.assertLess(time.monotonic() - start, 48 * slow.delay)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,304 @@
+"""Gas and storage benchmarks of every dex entrypoint and of `launchExchange`,
+for the FA1.2 and the FA2 builds.
+
+Each scenario runs on a freshly set up pool and is compared with
+tests/benchmark_baseline.json, which holds one set of scenarios per backend.
+Both record the paid storage and the operation size; the sandbox adds
+protocol gas and fees. The in-process chain meters neither, so it records
+executed instructions instead, the metric the committed "interpreter"
+baseline is checked on; it has no sandbox baseline yet. A metric more than
+DEX_BENCHMARK_THRESHOLD (default 0.02, i.e. 2%) above its baseline fails the
+run; after an intended change, DEX_BENCHMARK_UPDATE=1 rewrites the baseline
+of the current backend:
+
+    DEX_BENCHMARK_UPDATE=1 pytest tests/test_benchmark.py
+
+The "batchSwap<n>" scenarios send n alternating trades in one `batchSwap`
+call; `test_batch_amortization` checks that the cost per trade falls below
+that of a single swap call and keeps falling with the batch size.
+
+On the in-process chain, every dex scenario also records
+"accumulate_instructions": the instructions its dex calls spent in the
+`accumulate` prologue of main (tools/profiler.py), so the baseline holds the
+cost of each call with accumulate (executed_instructions) and without it
+(the difference). `test_accumulate` checks that it runs once per dex call,
+in the same number of instructions whatever the call does.
+
+"updateTokenPool" resyncs the token pool through the callback of the
+token, "updateTokenPoolView" through its `get_balance` view.
+
+The "lqt/transfer" scenario moves liquidity tokens to one new holder with
+`transfer`, and "lqt/batchTransfer<n>" to n new holders in one
+`batchTransfer` call; `test_batch_transfer_amortization` checks the cost
+per holder the same way.
+"""
+
+import json
+import os
+import unittest
+
+from pytezos.crypto.encoding import base58_encode
+from pytezos.operation.forge import forge_operation
+from pytezos.operation.result import OperationResult
+
+from tools.profiler import Profiler, ligo_map
+
+from test_dex import (Env, FA12Storage, FA2Storage, alice_pk, backend, pool_token_info, pytezos,
+                      restart_setups, send_conf, setup_fa2_swaps, setup_swaps)
+
+if backend == "interpreter":
+    from test_dex import chain
+
+
+baseline_path = "tests/benchmark_baseline.json"
+threshold = float(os.environ.get("DEX_BENCHMARK_THRESHOLD", "0.02"))
+update_baseline = os.environ.get("DEX_BENCHMARK_UPDATE") == "1"
+
+deadline = "2029-09-06T15:08:29.000Z"
+tokenPool = 10 ** 10
+xtzPool = 10 ** 10
+batch_sizes = (1, 10, 100)
+
+
+def operation_size(opg_result):
+    """Bytes of the signed operation: branch, forged contents and signature."""
+    size = 32 + 64
+    for content in opg_result["contents"]:
+        content = {"fee": "0", "counter": "0", "gas_limit": "0", "storage_limit": "0", **content}
+        size += len(forge_operation(content))
+    return size
+
+
+def measure(opg):
+    """The metrics of `opg` the current backend reports."""
+    opg_result = opg.opg_result
+    metrics = {
+        "paid_storage_size_diff": OperationResult.paid_storage_size_diff(opg_result),
+        "operation_size": operation_size(opg_result),
+    }
+    if backend == "sandbox":
+        metrics["consumed_gas"] = OperationResult.consumed_gas(opg_result)
+        metrics["fee"] = sum(int(content["fee"]) for content in opg_result["contents"])
+    else:
+        metrics["executed_instructions"] = sum(
+            int(result.get("executed_instructions", 0))
+            for result in OperationResult.iter_results(opg_result)
+        )
+    return metrics
+
+
+def accumulate_profiler():
+    """A profiler of the in-process chain that knows the prologue of both dex
+    builds. The pool setups of `run_scenarios` run here first, so that the
+    dex calls of their launches are not profiled with the scenarios."""
+    sources = {}
+    for setup, source in ((setup_swaps, "dex.mligo"), (setup_fa2_swaps, "dex_fa2.mligo")):
+        restart_setups()
+        setup([(tokenPool, xtzPool)], balance_view=True)
+        restart_setups()
+        swap, _ = setup([(tokenPool, xtzPool)] * 2)[0]
+        sources[chain.accounts[swap.address].code_id] = ligo_map(source)
+    return Profiler(chain, sources=sources)
+
+
+def measure_scenarios(prefix, scenarios, profiler=None):
+    """The metrics of `scenarios` by "<prefix>/<scenario>"; with an active
+    `profiler`, with the instructions the dex calls spent in accumulate."""
+    results = {}
+    for scenario, opg in scenarios:
+        metrics = results[f"{prefix}/{scenario}"] = measure(opg)
+        if profiler is not None:
+            metrics["accumulate_instructions"] = sum(
+                sample[0] for stack, sample in profiler.samples.items() if "prologue (accumulate)" in stack
+            )
+            profiler.samples.clear()
+    return results
+
+
+def launch_exchange(build, factory):
+    if build == "fa2":
+        storage = Env.fa2_storage(FA2Storage(alice_pk), pool_token_info, {alice_pk: tokenPool}, [(alice_pk, factory.address)])
+        token = Env.originate(Env.fa2_contract(), storage)
+        param = {"token_address": token.address, "token_amount": tokenPool, "token_id": 0}
+    else:
+        storage = Env.fa12_storage(FA12Storage(alice_pk), pool_token_info, {alice_pk: (tokenPool, {factory.address: tokenPool})})
+        token = Env.originate(Env.fa12_contract(), storage)
+        param = {"token_address": token.address, "token_amount": tokenPool}
+    _, opg = Env.launch_exchanges(factory, [param], [xtzPool])
+    return opg
+
+
+def batch_legs(size):
+    """`size` alternating xtzToToken and tokenToXtz legs, 1000 mutez or 1000 tokens each."""
+    return [
+        {"xtzToTokenLeg": {"to": alice_pk, "xtzSold": 1000, "minTokensBought": 0}} if i % 2 == 0 else
+        {"tokenToXtzLeg": {"to": alice_pk, "tokensSold": 1000, "minXtzBought": 0}}
+        for i in range(size)
+    ]
+
+
+def holder(i):
+    """A distinct implicit account for every `i`."""
+    return base58_encode(i.to_bytes(20, "big"), b"tz1").decode()
+
+
+def run_lqt_scenarios():
+    """Yields (scenario, operation group) for the transfers of the liquidity token."""
+    def lqt():
+        restart_setups()
+        (swap, _), = setup_swaps([(tokenPool, xtzPool)])
+        return Env.contract(swap.storage["lqtAddress"]())
+
+    yield "transfer", lqt().transfer({"from": alice_pk, "to": holder(1), "value": 1000}).send(**send_conf)
+
+    for size in batch_sizes:
+        txs = [{"to": holder(i + 1), "value": 1000} for i in range(size)]
+        yield f"batchTransfer{size}", lqt().batchTransfer([{"from": alice_pk, "txs": txs}]).send(**send_conf)
+
+
+def run_scenarios(build):
+    """Yields (scenario, operation group) for every entrypoint of `build`."""
+    setup = setup_fa2_swaps if build == "fa2" else setup_swaps
+
+    def swaps():
+        restart_setups()
+        return [swap for swap, _ in setup([(tokenPool, xtzPool)] * 2)]
+
+    factory, opg = Env.originate_factory(build)
+    yield "originateFactory", opg
+    yield "launchExchange", launch_exchange(build, factory)
+
+    swap, _ = swaps()
+    yield "xtzToToken", swap.xtzToToken({"to": alice_pk, "minTokensBought": 0, "deadline": deadline}).with_amount(100000).send(**send_conf)
+
+    swap, _ = swaps()
+    yield "tokenToXtz", swap.tokenToXtz({"to": alice_pk, "tokensSold": 10000, "minXtzBought": 0, "deadline": deadline}).send(**send_conf)
+
+    swap, swap_out = swaps()
+    yield "tokenToToken", swap.tokenToToken({
+        "outputDexterContract": swap_out.address,
+        "minTokensBought": 0,
+        "to": alice_pk,
+        "tokensSold": 10000,
+        "deadline": deadline
+    }).send(**send_conf)
+
+    swap, swap_out = swaps()
+    yield "xtzToTokenRoute", swap.xtzToTokenRoute({
+        "to": alice_pk,
+        "minTokensBought": 0,
+        "tokensBought": 0,
+        "legs": [(swap_out.address, 50000)],
+        "deadline": deadline
+    }).with_amount(100000).send(**send_conf)
+
+    for size in batch_sizes:
+        swap, _ = swaps()
+        yield f"batchSwap{size}", swap.batchSwap({"swaps": batch_legs(size), "deadline": deadline}).with_amount(1000 * ((size + 1) // 2)).send(**send_conf)
+
+    swap, _ = swaps()
+    yield "addLiquidity", swap.addLiquidity({"owner": alice_pk, "minLqtMinted": 1, "maxTokensDeposited": 100000, "deadline": deadline}).with_amount(10000).send(**send_conf)
+
+    swap, _ = swaps()
+    yield "removeLiquidity", swap.removeLiquidity({"to": alice_pk, "lqtBurned": 10000, "minXtzWithdrawn": 1, "minTokensWithdrawn": 1, "deadline": deadline}).send(**send_conf)
+
+    swap, _ = swaps()
+    yield "updateTokenPool", swap.updateTokenPool().send(**send_conf)
+
+    restart_setups()
+    (swap, _), = setup([(tokenPool, xtzPool)], balance_view=True)
+    yield "updateTokenPoolView", swap.updateTokenPool().send(**send_conf)
+
+
+def load_baseline():
+    if not os.path.exists(baseline_path):
+        return {}
+    with open(baseline_path) as f:
+        return json.load(f)
+
+
+class TestBenchmark(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.results = {}
+        if backend == "interpreter":
+            profiler = accumulate_profiler()
+            with profiler:
+                for build in ("fa12", "fa2"):
+                    cls.results.update(measure_scenarios(build, run_scenarios(build), profiler))
+        else:
+            for build in ("fa12", "fa2"):
+                cls.results.update(measure_scenarios(build, run_scenarios(build)))
+        cls.results.update({
+            f"lqt/{scenario}": measure(opg)
+            for scenario, opg in run_lqt_scenarios()
+        })
+        if update_baseline:
+            baseline = load_baseline()
+            baseline[backend] = cls.results
+            with open(baseline_path, "w") as f:
+                json.dump(baseline, f, indent=2, sort_keys=True)
+                f.write("\n")
+
+    def test_no_regression(self):
+        """Every metric of every scenario stays within `threshold` of the baseline"""
+        baseline = load_baseline().get(backend)
+        if baseline is None:
+            self.skipTest(f"no {backend} baseline in {baseline_path}")
+
+        for scenario, metrics in self.results.items():
+            with self.subTest(scenario=scenario):
+                self.assertIn(scenario, baseline)
+                for metric, value in metrics.items():
+                    limit = baseline[scenario][metric] * (1 + threshold)
+                    self.assertLessEqual(value, limit, f"{scenario} {metric}: {value} > baseline {baseline[scenario][metric]}")
+
+    def test_batch_amortization(self):
+        """A batchSwap trade costs less than a single swap call, and less the
+        larger the batch"""
+        metric = "consumed_gas" if backend == "sandbox" else "executed_instructions"
+        for build in ("fa12", "fa2"):
+            with self.subTest(build=build):
+                single = (self.results[f"{build}/xtzToToken"][metric] + self.results[f"{build}/tokenToXtz"][metric]) / 2
+                per_trade = [self.results[f"{build}/batchSwap{size}"][metric] / size for size in batch_sizes]
+                self.assertLess(per_trade[1], single)
+                self.assertLess(per_trade[2], per_trade[1])
+
+    def test_update_token_pool_view(self):
+        """Reading the token pool from a balance view costs less than the
+        callback round trip"""
+        metric = "consumed_gas" if backend == "sandbox" else "executed_instructions"
+        for build in ("fa12", "fa2"):
+            with self.subTest(build=build):
+                self.assertLess(self.results[f"{build}/updateTokenPoolView"][metric],
+                                self.results[f"{build}/updateTokenPool"][metric])
+
+    def test_accumulate(self):
+        """accumulate runs once per dex call, batches included, in the same
+        number of instructions whatever the call does"""
+        if backend != "interpreter":
+            self.skipTest("profiles run in the in-process chain")
+        for build in ("fa12", "fa2"):
+            with self.subTest(build=build):
+                per_call = self.results[f"{build}/xtzToToken"]["accumulate_instructions"]
+                self.assertGreater(per_call, 0)
+                for scenario in ("tokenToXtz", "addLiquidity", "removeLiquidity", "batchSwap1", "batchSwap100"):
+                    self.assertEqual(self.results[f"{build}/{scenario}"]["accumulate_instructions"], per_call)
+                # launchExchange calls setLqtAddress on the new pool
+                for scenario in ("launchExchange", "updateTokenPoolView"):
+                    self.assertEqual(self.results[f"{build}/{scenario}"]["accumulate_instructions"], per_call)
+                for scenario in ("tokenToToken", "xtzToTokenRoute", "updateTokenPool"):
+                    self.assertEqual(self.results[f"{build}/{scenario}"]["accumulate_instructions"], 2 * per_call)
+
+    def test_batch_transfer_amortization(self):
+        """A batchTransfer to many holders costs less per holder than a
+        transfer, and less the larger the batch"""
+        metric = "consumed_gas" if backend == "sandbox" else "executed_instructions"
+        single = self.results["lqt/transfer"][metric]
+        per_holder = [self.results[f"lqt/batchTransfer{size}"][metric] / size for size in batch_sizes]
+        self.assertLess(per_holder[1], single)
+        self.assertLess(per_holder[2], per_holder[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from tools.global_constants import load
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCES = ["compile.sh", "dex.mligo", "dex_fa2.mligo", "factory.mligo", "factory_fa2.mligo", "lqt_fa12.mligo"]
+OUTPUTS = [
+    "lqt_fa12.tz",
+    "dex_fa12.tz",
+    "dex_fa2.tz",
+    "factory_fa12.tz",
+    "factory_fa2.tz",
+]
+
+
+# DEX_SKIP_COMPILE=1 explicitly leaves the committed files unchecked
+skip = os.environ.get("DEX_SKIP_COMPILE") == "1"
+
+
+@unittest.skipIf(skip, "DEX_SKIP_COMPILE=1")
+class TestCompile(unittest.TestCase):
+    def test_committed_michelson(self):
+        """The committed michelson/ files are what compile.sh writes from the sources"""
+        if not (os.environ.get("LIGO") or shutil.which("docker")):
+            self.fail("compile.sh needs docker or $LIGO (LIGO 0.34); set DEX_SKIP_COMPILE=1 to run without it")
+        with tempfile.TemporaryDirectory() as tree:
+            for name in SOURCES:
+                shutil.copy(os.path.join(ROOT, name), tree)
+            shutil.copytree(os.path.join(ROOT, "michelson"), os.path.join(tree, "michelson"))
+            shutil.copytree(os.path.join(ROOT, "tools"), os.path.join(tree, "tools"),
+                            ignore=shutil.ignore_patterns("__pycache__"))
+            run = subprocess.run(["bash", "compile.sh"], cwd=tree, capture_output=True, text=True)
+            self.assertEqual(run.returncode, 0, run.stderr)
+
+            for name in OUTPUTS:
+                with self.subTest(name):
+                    self.assertEqual(load(os.path.join(tree, "michelson", name)),
+                                     load(os.path.join(ROOT, "michelson", name)))
+
+
+if __name__ == '__main__':
+    unittest.main()
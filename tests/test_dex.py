@@ -1,7 +1,12 @@
+import functools
+import hashlib
 import math
+import os
+import time
 import unittest
 import random
 import json
+import numpy as np
 from contextlib import contextmanager
 
 from dataclasses import dataclass
@@ -10,14 +15,22 @@ from pytezos.michelson.repl import InterpreterResult
 from pytezos import ContractInterface
 from pytezos.michelson.stack import MichelsonStack
 from pytezos.michelson.micheline import MichelsonRuntimeError
-from pytezos.rpc.errors import MichelsonError
+from pytezos.michelson.parse import michelson_to_micheline
+from pytezos.rpc.errors import MichelsonError, RpcError
 from pytezos.crypto.key import Key
 from pytezos import pytezos
+from pytezos.contract.metadata import ContractMetadata
 from pytezos.contract.result import OperationResult
 
 from pytezos.michelson.sections.storage import StorageSection
 from decimal import Decimal
 
+from tools import global_constants, quote, twap, views
+from tools.history import history
+from tools.interfaces import InterfaceCache
+from tools.pipeline import Pipeline
+from tools.local_chain import LocalChain, LocalClient
+
 
 default_reserve = "tz1VYKnRgPyfZjdsnoVPyQrhBuhWHoP5QqxM"
 
@@ -43,10 +56,122 @@ shell = "http://localhost:8732"
 # bob_pk = alice_pk
 # shell = "https://florencenet.api.tez.ie/"
 
+# parallel runs (`pytest -n auto`): every pytest-xdist worker signs with its
+# own key and pays reserve fees to its own address, so workers never share an
+# account counter or a measured balance. DEX_TEST_SHELLS optionally gives each
+# worker its own sandbox node: "http://localhost:8732,http://localhost:8733"
+worker = os.environ.get("PYTEST_XDIST_WORKER")
+bootstrap_key = alice_key
+worker_funds = 10 ** 11
+
+
+def worker_key(role):
+    seed = hashlib.sha256(f"dex-tests/{worker}/{role}".encode()).digest()
+    return Key.from_secret_exponent(seed)
+
+
+if worker:
+    shells = os.environ.get("DEX_TEST_SHELLS")
+    if shells:
+        shells = shells.split(",")
+        shell = shells[int(worker.lstrip("gw")) % len(shells)]
+    alice_key = worker_key("signer").secret_key()
+    alice_pk = worker_key("signer").public_key_hash()
+    default_reserve = worker_key("reserve").public_key_hash()
+
 using_params = dict(shell=shell, key=alice_key)
 
-pytezos = pytezos.using(**using_params)
+# "interpreter" runs the compiled contracts in-process (tools/local_chain.py),
+# "sandbox" sends every operation to the node at `shell`
+backend = os.environ.get("DEX_TEST_BACKEND", "interpreter")
+
+if backend == "sandbox":
+    pytezos = pytezos.using(**using_params)
+else:
+    chain = LocalChain()
+    for address in (alice_pk, bob_pk):
+        chain.set_balance(address, 10 ** 15)
+    pytezos = LocalClient(chain, alice_key)
 send_conf = dict(min_confirmations=1)
+# parsed contract code by code hash, in memory only: a reset sandbox reuses
+# addresses, which a cache kept across runs would bind to stale code
+interfaces = InterfaceCache(None)
+
+
+def fund_worker_signer():
+    """Funds and reveals the worker signer from the sandbox bootstrap account."""
+    if int(pytezos.account(alice_pk)["balance"]) > 0:
+        return
+    bootstrap = pytezos.using(shell=shell, key=bootstrap_key)
+    for attempt in range(10):
+        try:
+            bootstrap.transaction(destination=alice_pk, amount=worker_funds).send(**send_conf)
+            break
+        except RpcError as e:
+            # workers sharing a node race on the bootstrap account counter
+            if "counter" not in str(e) or attempt == 9:
+                raise
+            time.sleep(random.random())
+    pytezos.reveal().send(**send_conf)
+
+
+if worker and backend == "sandbox":
+    fund_worker_signer()
+
+
+# (setups run before it in its test, setup and arguments) -> (chain snapshot, result)
+setup_cache = {}
+# the test the chain was last set up for, the cached setups run in it so far
+# (None once it changed the chain otherwise) and the level after the last one
+setup_state = {"test": None, "setups": (), "level": None}
+
+
+def current_test():
+    """The pytest id of the running test, without its phase."""
+    return os.environ.get("PYTEST_CURRENT_TEST", "").rsplit(" ", 1)[0]
+
+
+def restart_setups():
+    """Lets the next cached setup roll the chain back as at the start of a
+    test, for a test that sets up several independent runs."""
+    setup_state["test"] = None
+
+
+def cached_setup(setup):
+    """Runs `setup` once per session, arguments and earlier setups of the
+    test on the interpreter backend.
+
+    The first cached setup of a test rolls the chain back to the state right
+    after that setup first ran and returns the same contracts, so tests start
+    from a known state without paying the originations again; a test makes
+    it before deploying anything itself. Later setups of the same test never
+    roll back what the test already deployed: they are cached after the
+    setups before them, and deploy again once the test has sent anything
+    else. A sandbox node cannot roll back, so there every call deploys
+    again."""
+    if backend == "sandbox":
+        return setup
+
+    @functools.wraps(setup)
+    def wrapper(*args, **kwargs):
+        key = (setup.__name__, repr(args), repr(sorted(kwargs.items())))
+        test = current_test()
+        if setup_state["test"] != test:
+            setup_state.update(test=test, setups=(), level=chain.level)
+        elif setup_state["setups"] is None or setup_state["level"] != chain.level:
+            setup_state["setups"] = None
+            return setup(*args, **kwargs)
+        setups = setup_state["setups"] + (key,)
+        if setups in setup_cache:
+            snapshot, result = setup_cache[setups]
+            chain.restore(snapshot)
+        else:
+            result = setup(*args, **kwargs)
+            setup_cache[setups] = chain.snapshot(), result
+        setup_state.update(setups=setups, level=chain.level)
+        return result
+
+    return wrapper
 
 
 @dataclass
@@ -67,98 +192,146 @@ class FA2Storage:
 
 class Env:
     @staticmethod
-    def deploy_fa2(init_storage: FA12Storage, token_info):
+    def contract(address, key=None):
+        """The contract at `address`, without fetching or parsing its code when
+        its code hash is given or already known (tools/interfaces.py)."""
+        return interfaces.contract(pytezos.using(**using_params), address, key)
+
+    @staticmethod
+    def originate_batch(contracts):
+        """Originates every (ContractInterface, storage) pair in one operation group."""
+        scripts = [contract.script(initial_storage=storage) for contract, storage in contracts]
+        opg = pytezos.bulk(*[pytezos.origination(script=script) for script in scripts]).send(**send_conf)
+        return [
+            Env.contract(result.originated_contracts[0], interfaces.add(script["code"]))
+            for script, result in zip(scripts, OperationResult.from_operation_group(opg.opg_result))
+        ]
+
+    @staticmethod
+    def originate(contract: ContractInterface, storage):
+        return Env.originate_batch([(contract, storage)])[0]
+
+    @staticmethod
+    def launch_exchanges(factory, params, xtz_pools):
+        """Launches one exchange per `launchExchange` param in one operation group.
+
+        Returns the new swaps and the operation group."""
+        counter = factory.storage["counter"]()
+        dex = interfaces.spawned(factory.address, "xtzToToken")
+        opg = pytezos.bulk(*[
+            factory.launchExchange(param).with_amount(xtz_pool)
+            for param, xtz_pool in zip(params, xtz_pools)
+        ]).send(**send_conf)
+        swaps = [
+            Env.contract(factory.storage["swaps"][counter + i](), dex)
+            for i in range(len(params))
+        ]
+        return swaps, opg
+
+    @staticmethod
+    def fa2_contract(balance_view=False):
+        """The FA2 test token; with `balance_view`, with the `get_balance`
+        view the dex reads its token pool from."""
+        if not balance_view:
+            return interfaces.from_file("tests/FA2.tz")
         with open("tests/FA2.tz") as f:
-            michelson = f.read()
+            return interfaces.from_michelson(f.read() + "\n" + fa2_balance_view)
 
-        fa2 = ContractInterface.from_michelson(michelson).using(**using_params)
+    @staticmethod
+    def fa2_storage(init_storage: FA2Storage, token_info, ledger=None, operators=()):
+        """`ledger` maps holders to balances and `operators` lists (owner, operator)
+        pairs of token 0, so the token can be originated already minted."""
         token_metadata = {
             0: {
                 "token_id": 0,
                 "token_info": token_info,
             }
         }
-        storage = {
+        return {
             'administrator': init_storage.admin,
-            'all_tokens': 0,
-            'ledger': {},
+            'all_tokens': 1 if ledger else 0,
+            'ledger': {(owner, 0): amount for owner, amount in (ledger or {}).items()},
             'metadata': {},
-            'operators': {},
+            'operators': {(owner, operator, 0): None for owner, operator in operators},
             'paused': False,
             'token_metadata': token_metadata
         }
-        opg = fa2.originate(initial_storage=storage).send(**send_conf)
-        fa2_addr = OperationResult.from_operation_group(opg.opg_result)[0].originated_contracts[0]
-        fa2 = pytezos.using(**using_params).contract(fa2_addr)
 
-        return fa2
+    @staticmethod
+    def deploy_fa2(init_storage: FA2Storage, token_info):
+        return Env.originate(Env.fa2_contract(), Env.fa2_storage(init_storage, token_info))
 
     @staticmethod
-    def deploy_fa12(init_storage: FA12Storage, token_info):
+    def fa12_contract(balance_view=False):
+        """The FA1.2 test token; with `balance_view`, with the `get_balance`
+        view the dex reads its token pool from."""
+        if not balance_view:
+            return interfaces.from_file("tests/FA12.json")
         with open("tests/FA12.json") as f:
-            source = f.read()
+            return interfaces.from_micheline(json.load(f) + michelson_to_micheline(fa12_balance_view))
 
-        micheline = json.loads(source)
-        fa12 = ContractInterface.from_micheline(micheline).using(**using_params)
+    @staticmethod
+    def fa12_storage(init_storage: FA12Storage, token_info, balances=None):
+        """`balances` maps holders to (balance, approvals), so the token can be
+        originated already minted and approved."""
+        balances = balances or {}
         token_metadata = {
             0: {
                 "token_id": 0,
                 "token_info": token_info,
             }
         }
-        storage = {
+        return {
             "administrator": init_storage.admin,
-            "balances": {},
+            "balances": {
+                holder: {"balance": balance, "approvals": approvals}
+                for holder, (balance, approvals) in balances.items()
+            },
             "metadata": {},
             "paused": False,
             "token_metadata": token_metadata,
-            "totalSupply": 0,
+            "totalSupply": sum(balance for balance, _ in balances.values()),
         }
-        opg = fa12.originate(initial_storage=storage).send(**send_conf)
-        fa12_addr = OperationResult.from_operation_group(opg.opg_result)[0].originated_contracts[0]
-        fa12 = pytezos.using(**using_params).contract(fa12_addr)
-
-        return fa12
 
     @staticmethod
-    def deploy_factory_fa2():
-        with open("michelson/factory_fa2.tz") as f:
-            source = f.read()
+    def deploy_fa12(init_storage: FA12Storage, token_info):
+        return Env.originate(Env.fa12_contract(), Env.fa12_storage(init_storage, token_info))
 
-        factory = ContractInterface.from_michelson(source).using(**using_params)
-        factory_storage = {
+    @staticmethod
+    def factory_script(build="fa12", reserve=default_reserve):
+        """The origination script of the `build` ("fa12" or "fa2") factory."""
+        factory = interfaces.from_file(f"michelson/factory_{build}.tz")
+        return factory.script(initial_storage={
             "empty_allowances": {},
             "empty_tokens": {},
-            "empty_history": {},
             "empty_user_investments": {},
+            "empty_user_positions": {},
             "swaps": {},
             "token_to_swaps": {},
             "counter": 0,
-            "default_reserve": default_reserve,
-        }
-        opg = factory.originate(initial_storage=factory_storage).send(**send_conf)
-        factory_addr = OperationResult.from_operation_group(opg.opg_result)[0].originated_contracts[0]
-        return pytezos.using(**using_params).contract(factory_addr)
+            "default_reserve": reserve,
+            "default_token_metadata": {},
+            "default_metadata": {},
+        })
 
     @staticmethod
-    def deploy_factory(reserve=default_reserve):
-        with open("michelson/factory_fa12.tz") as f:
-            source = f.read()
+    def originate_factory(build="fa12", reserve=default_reserve):
+        """Originates the `build` factory. Returns the factory and the
+        operation group."""
+        script = Env.factory_script(build, reserve)
+        opg = pytezos.origination(script=script).send(**send_conf)
+        address = OperationResult.from_operation_group(opg.opg_result)[0].originated_contracts[0]
+        return Env.contract(address, interfaces.add(script["code"])), opg
 
-        factory = ContractInterface.from_michelson(source).using(**using_params)
-        factory_storage = {
-            "empty_allowances": {},
-            "empty_tokens": {},
-            "empty_history": {},
-            "empty_user_investments": {},
-            "swaps": {},
-            "token_to_swaps": {},
-            "counter": 0,
-            "default_reserve": reserve,
-        }
-        opg = factory.originate(initial_storage=factory_storage).send(**send_conf)
-        factory_addr = OperationResult.from_operation_group(opg.opg_result)[0].originated_contracts[0]
-        return pytezos.using(**using_params).contract(factory_addr)
+    @staticmethod
+    @cached_setup
+    def deploy_factory_fa2():
+        return Env.originate_factory("fa2")[0]
+
+    @staticmethod
+    @cached_setup
+    def deploy_factory(reserve=default_reserve):
+        return Env.originate_factory("fa12", reserve=reserve)[0]
 
 
 default_token_info = [
@@ -207,32 +380,76 @@ default_token_info = [
 ]
 
 
-def setup_swap_dashboard_data_test(tokenPool, xtzPool, reserve=default_reserve):
-    factory = Env.deploy_factory(reserve)
-    fa12_init_storage = FA12Storage(alice_pk)
+pool_token_info = {
+    "decimals": b"0",
+    "symbol": b"ETHtz",
+    "name": b"ETHtez",
+    "thumbnailUri": b"https://ethtz.io/ETHtz_purple.png"
+}
+
+
+# get_balance views of the test tokens, (owner) or (owner, token_id) -> balance
+fa12_balance_view = 'view "get_balance" address nat { UNPAIR ; SWAP ; CAR ; GET 3 ; SWAP ; GET ; IF_NONE { PUSH nat 0 } { CDR } } ;'
+fa2_balance_view = 'view "get_balance" (pair address nat) nat { UNPAIR ; SWAP ; CAR ; GET 4 ; SWAP ; GET ; IF_NONE { PUSH nat 0 } {} } ;'
 
-    def setup_fa12_token(amount):
-        token_info = {
-            "decimals": b"0",
-            "symbol": b"ETHtz",
-            "name": b"ETHtez",
-            "thumbnailUri": b"https://ethtz.io/ETHtz_purple.png"
-        }
-        token = Env.deploy_fa12(fa12_init_storage, token_info)
-        token.mint({"address": alice_pk, "value": amount * 1000}).send(**send_conf)
-        token.approve({"spender": factory.address, "value": amount}).send(**send_conf)
-        return token
 
-    token = setup_fa12_token(tokenPool)
-    param = {"token_address": token.address, "token_amount": tokenPool}
+@cached_setup
+def setup_swaps(pools, reserve=default_reserve, balance_view=False):
+    """Launches one FA1.2 swap per (tokenPool, xtzPool) from a new factory.
 
-    factory.launchExchange(param).with_amount(xtzPool).send(**send_conf)
+    The setup is batched by dependency rather than sent operation by
+    operation: the tokens are originated already minted and approved for the
+    factory, then every exchange is launched in one group and every swap
+    approval sent in another. Addresses originated in a group are derived
+    from its hash, so a group cannot use them itself.
+
+    With `balance_view`, the tokens have a `get_balance` view."""
+    factory = Env.deploy_factory(reserve)
+    fa12_init_storage = FA12Storage(alice_pk)
+    fa12 = Env.fa12_contract(balance_view)
+    tokens = Env.originate_batch([
+        (fa12, Env.fa12_storage(fa12_init_storage, pool_token_info, {alice_pk: (tokenPool * 1000, {factory.address: tokenPool})}))
+        for tokenPool, _ in pools
+    ])
+    params = [
+        {"token_address": token.address, "token_amount": tokenPool}
+        for token, (tokenPool, _) in zip(tokens, pools)
+    ]
+    swaps, _ = Env.launch_exchanges(factory, params, [xtzPool for _, xtzPool in pools])
+
+    pytezos.bulk(*[
+        token.approve({"spender": swap.address, "value": 100000})
+        for swap, token in zip(swaps, tokens)
+    ]).send(**send_conf)
+    return list(zip(swaps, tokens))
+
+
+@cached_setup
+def setup_fa2_swaps(pools, balance_view=False):
+    """FA2 counterpart of `setup_swaps`: the factory, then each swap, is made
+    an operator of alice's tokens."""
+    factory = Env.deploy_factory_fa2()
+    fa2_init_storage = FA2Storage(alice_pk)
+    fa2 = Env.fa2_contract(balance_view)
+    tokens = Env.originate_batch([
+        (fa2, Env.fa2_storage(fa2_init_storage, pool_token_info, {alice_pk: tokenPool * 1000}, [(alice_pk, factory.address)]))
+        for tokenPool, _ in pools
+    ])
+    params = [
+        {"token_address": token.address, "token_amount": tokenPool, "token_id": 0}
+        for token, (tokenPool, _) in zip(tokens, pools)
+    ]
+    swaps, _ = Env.launch_exchanges(factory, params, [xtzPool for _, xtzPool in pools])
+
+    pytezos.bulk(*[
+        token.update_operators([{"add_operator": {"owner": alice_pk, "operator": swap.address, "token_id": 0}}])
+        for swap, token in zip(swaps, tokens)
+    ]).send(**send_conf)
+    return list(zip(swaps, tokens))
 
-    swap_address = factory.storage["swaps"][0]()
-    swap = pytezos.using(**using_params).contract(swap_address)
 
-    token.approve({"spender": swap.address, "value": 100000}).send(**send_conf)
-    return swap, token
+def setup_swap_dashboard_data_test(tokenPool, xtzPool, reserve=default_reserve):
+    return setup_swaps([(tokenPool, xtzPool)], reserve)[0]
 
 
 def get_xtz_balance(address):
@@ -326,8 +543,7 @@ class TestFactory(unittest.TestCase):
         """
         tokenPool = 10 ** 10
         xtzPool = 10 ** 10
-        swap_in, token_in = setup_swap_dashboard_data_test(tokenPool, xtzPool)
-        swap_out, token_out = setup_swap_dashboard_data_test(tokenPool, xtzPool)
+        (swap_in, token_in), (swap_out, token_out) = setup_swaps([(tokenPool, xtzPool)] * 2)
 
         start_reserve_balance = get_xtz_balance(default_reserve)
         start_alice_token_out = token_out.getBalance(alice_pk, None).callback_view()
@@ -384,9 +600,9 @@ class TestFactory(unittest.TestCase):
 
         # history
         xtz_volume = (tokensSold * swap_in_start_xtzPool) // (swap_in_start_tokenPool + tokensSold)
-        self.assertEqual(swap_in.storage["history"]["xtzVolume"](), xtz_volume)
-        self.assertEqual(int(swap_in.storage["history"]["xtzPool"]()), swap_in_end_xtzPool)
-        self.assertEqual(int(swap_in.storage["history"]["tokenPool"]()), swap_in_end_tokenPool)
+        self.assertEqual(history(swap_in)["xtzVolume"], xtz_volume)
+        self.assertEqual(history(swap_in)["xtzPool"], swap_in_start_xtzPool - swap_in_xtz_bought - swap_in_reserve_fee)
+        self.assertEqual(history(swap_in)["tokenPool"], swap_in_start_tokenPool + tokensSold)
 
     def test_token_to_xtz_reserve_fee(self):
         """
@@ -441,9 +657,9 @@ class TestFactory(unittest.TestCase):
 
         # history
         xtz_volume = (tokensSold * start_xtzPool) // (start_tokenPool + tokensSold)
-        self.assertEqual(swap.storage["history"]["xtzVolume"](), xtz_volume)
-        self.assertEqual(int(swap.storage["history"]["xtzPool"]()), end_xtzPool)
-        self.assertEqual(int(swap.storage["history"]["tokenPool"]()), end_tokenPool)
+        self.assertEqual(history(swap)["xtzVolume"], xtz_volume)
+        self.assertEqual(history(swap)["xtzPool"], start_xtzPool - xtz_bought - reserve_fee)
+        self.assertEqual(history(swap)["tokenPool"], start_tokenPool + tokensSold)
 
     def test_xtz_to_token_reserve_fee(self):
         """
@@ -497,9 +713,9 @@ class TestFactory(unittest.TestCase):
         self.assertEqual(tokens_bought, 99719)
 
         # history
-        self.assertEqual(swap.storage["history"]["xtzVolume"](), xtz_sold)
-        self.assertEqual(int(swap.storage["history"]["xtzPool"]()), end_xtzPool)
-        self.assertEqual(int(swap.storage["history"]["tokenPool"]()), end_tokenPool)
+        self.assertEqual(history(swap)["xtzVolume"], xtz_sold)
+        self.assertEqual(history(swap)["xtzPool"], start_xtzPool + xtz_sold - reserve_fee)
+        self.assertEqual(history(swap)["tokenPool"], start_tokenPool - tokens_bought)
 
     def test_add_liquidity_dashboard_data(self):
         """We test that:
@@ -509,10 +725,11 @@ class TestFactory(unittest.TestCase):
         xtzPool = 10000
         swap, token = setup_swap_dashboard_data_test(tokenPool, xtzPool)
         xtzAmount = 10
+        expected = quote.add_liquidity(xtzPool, tokenPool, swap.storage["lqtTotal"](), xtzAmount)
         swap.addLiquidity({"owner": alice_pk, "minLqtMinted": 1, "maxTokensDeposited": 1000000000000, "deadline": "2029-09-06T15:08:29.000Z"}).with_amount(xtzAmount).send(**send_conf)
-        self.assertEqual(swap.storage["user_investments"][alice_pk](), {'direction': 'aDD', 'token': swap.storage["tokenPool"]() - tokenPool, 'xtz': swap.storage["xtzPool"]() - xtzPool})
-        self.assertEqual(swap.storage["history"]["xtzPool"](), swap.storage["xtzPool"]())
-        self.assertEqual(swap.storage["history"]["tokenPool"](), swap.storage["tokenPool"]())
+        self.assertEqual(swap.storage["user_investments"][alice_pk](), {'direction': 'aDD', 'token': int(expected.tokens_deposited), 'xtz': xtzAmount})
+        self.assertEqual(history(swap)["xtzPool"], int(expected.xtz_pool))
+        self.assertEqual(history(swap)["tokenPool"], int(expected.token_pool))
 
     def test_remove_liquidity_dashboard_data(self):
         """We test that:
@@ -521,10 +738,11 @@ class TestFactory(unittest.TestCase):
         tokenPool = 1000
         xtzPool = 10000
         swap, token = setup_swap_dashboard_data_test(tokenPool, xtzPool)
+        expected = quote.remove_liquidity(xtzPool, tokenPool, swap.storage["lqtTotal"](), 100)
         swap.removeLiquidity({"to": alice_pk, "lqtBurned": 100, "minXtzWithdrawn": 1, "minTokensWithdrawn": 1, "deadline": "2029-09-06T15:08:29.000Z"}).send(**send_conf)
-        self.assertEqual(swap.storage["user_investments"][alice_pk](), {'direction': 'rEMOVE', 'token': tokenPool - swap.storage["tokenPool"](), 'xtz': xtzPool - swap.storage["xtzPool"]()})
-        self.assertEqual(swap.storage["history"]["xtzPool"](), swap.storage["xtzPool"]())
-        self.assertEqual(swap.storage["history"]["tokenPool"](), swap.storage["tokenPool"]())
+        self.assertEqual(swap.storage["user_investments"][alice_pk](), {'direction': 'rEMOVE', 'token': int(expected.tokens_withdrawn), 'xtz': int(expected.xtz_withdrawn)})
+        self.assertEqual(history(swap)["xtzPool"], int(expected.xtz_pool))
+        self.assertEqual(history(swap)["tokenPool"], int(expected.token_pool))
 
     def test_xtz_to_token_dashboard_data(self):
         """We test that: xtz/token pools are tracked so the price history can be trivially calculated later on"""
@@ -533,16 +751,17 @@ class TestFactory(unittest.TestCase):
         swap, token = setup_swap_dashboard_data_test(tokenPool, xtzPool)
 
         xtzAmount = 10
+        expected = quote.xtz_to_token(xtzPool, tokenPool, xtzAmount)
         swap.xtzToToken({"to": alice_pk, "minTokensBought": 0, "deadline": "2029-09-06T15:08:29.000Z"}).with_amount(xtzAmount).send(**send_conf)
-        self.assertEqual(swap.storage["history"]["xtzPool"](), swap.storage["xtzPool"]())
-        self.assertEqual(swap.storage["history"]["tokenPool"](), swap.storage["tokenPool"]())
-        self.assertEqual(swap.storage["history"]["xtzVolume"](), xtzAmount)
+        self.assertEqual(history(swap)["xtzPool"], int(expected.xtz_pool))
+        self.assertEqual(history(swap)["tokenPool"], int(expected.token_pool))
+        self.assertEqual(history(swap)["xtzVolume"], xtzAmount)
 
         xtzAmount = 11
         swap.xtzToToken({"to": alice_pk, "minTokensBought": 0, "deadline": "2029-09-06T15:08:29.000Z"}).with_amount(xtzAmount).send(**send_conf)
-        self.assertEqual(swap.storage["history"]["xtzVolume"](), xtzAmount)
+        self.assertEqual(history(swap)["xtzVolume"], xtzAmount)
 
-    def token_to_xtz_dashboard_data(self):
+    def test_token_to_xtz_dashboard_data(self):
         """We test that: xtz/token pools are tracked so the price history can be trivially calculated later on"""
         tokenPool = 1000
         xtzPool = 10000
@@ -552,12 +771,13 @@ class TestFactory(unittest.TestCase):
         start_tokenPool = swap.storage["tokenPool"]()
 
         tokensSold = 10
+        expected = quote.token_to_xtz(start_xtzPool, start_tokenPool, tokensSold)
         swap.tokenToXtz({"to": alice_pk, "tokensSold": tokensSold, "minXtzBought": 0, "deadline": "2029-09-06T15:08:29.000Z"}).send(**send_conf)
-        self.assertEqual(swap.storage["history"]["xtzPool"](), swap.storage["xtzPool"]())
-        self.assertEqual(swap.storage["history"]["tokenPool"](), swap.storage["tokenPool"]())
+        self.assertEqual(history(swap)["xtzPool"], int(expected.xtz_pool))
+        self.assertEqual(history(swap)["tokenPool"], int(expected.token_pool))
 
         xtz_volume = (tokensSold * start_xtzPool) // (start_tokenPool + tokensSold)
-        self.assertEqual(swap.storage["history"]["xtzVolume"](), xtz_volume)
+        self.assertEqual(history(swap)["xtzVolume"], xtz_volume)
 
         new_xtzPool = swap.storage["xtzPool"]()
         new_tokenPool = swap.storage["tokenPool"]()
@@ -565,28 +785,28 @@ class TestFactory(unittest.TestCase):
         swap.tokenToXtz({"to": alice_pk, "tokensSold": tokensSold, "minXtzBought": 0, "deadline": "2029-09-06T15:08:29.000Z"}).send(**send_conf)
 
         xtz_volume = (tokensSold * new_xtzPool) // (new_tokenPool + tokensSold)
-        self.assertEqual(swap.storage["history"]["xtzVolume"](), xtz_volume)
+        self.assertEqual(history(swap)["xtzVolume"], xtz_volume)
 
     def test_token_to_token_dashboard_data(self):
         """We test that: xtz/token pools are tracked so the price history can be trivially calculated later on"""
         tokenPool = 1000
         xtzPool = 10000
-        swap, token = setup_swap_dashboard_data_test(tokenPool, xtzPool)
-        swap2, token2 = setup_swap_dashboard_data_test(tokenPool, xtzPool)
+        (swap, token), (swap2, token2) = setup_swaps([(tokenPool, xtzPool)] * 2)
 
         start_xtzPool = swap.storage["xtzPool"]()
         start_tokenPool = swap.storage["tokenPool"]()
 
         tokensSold = 10
+        expected = quote.token_to_token(start_xtzPool, start_tokenPool, swap2.storage["xtzPool"](), swap2.storage["tokenPool"](), tokensSold)
         swap.tokenToToken({"outputDexterContract": swap2.address, "minTokensBought": 0, "to": alice_pk, "tokensSold": 10, "deadline": "2029-09-06T15:08:29.000Z"}).send(**send_conf)
-        self.assertEqual(swap.storage["history"]["xtzPool"](), swap.storage["xtzPool"]())
-        self.assertEqual(swap.storage["history"]["tokenPool"](), swap.storage["tokenPool"]())
+        self.assertEqual(history(swap)["xtzPool"], int(expected.sold.xtz_pool))
+        self.assertEqual(history(swap)["tokenPool"], int(expected.sold.token_pool))
 
         xtz_volume = (tokensSold * start_xtzPool) // (start_tokenPool + tokensSold)
-        self.assertEqual(swap.storage["history"]["xtzVolume"](), xtz_volume)
+        self.assertEqual(history(swap)["xtzVolume"], xtz_volume)
 
-        self.assertEqual(swap2.storage["history"]["xtzPool"](), swap2.storage["xtzPool"]())
-        self.assertEqual(swap2.storage["history"]["tokenPool"](), swap2.storage["tokenPool"]())
+        self.assertEqual(history(swap2)["xtzPool"], int(expected.bought.xtz_pool))
+        self.assertEqual(history(swap2)["tokenPool"], int(expected.bought.token_pool))
 
         new_xtzPool = swap.storage["xtzPool"]()
         new_tokenPool = swap.storage["tokenPool"]()
@@ -594,11 +814,11 @@ class TestFactory(unittest.TestCase):
         swap.tokenToXtz({"to": alice_pk, "tokensSold": tokensSold, "minXtzBought": 0, "deadline": "2029-09-06T15:08:29.000Z"}).send(**send_conf)
 
         xtz_volume = (tokensSold * new_xtzPool) // (new_tokenPool + tokensSold)
-        self.assertEqual(swap.storage["history"]["xtzVolume"](), xtz_volume)
+        self.assertEqual(history(swap)["xtzVolume"], xtz_volume)
 
     def test_launch_exchange_fa2(self):
         """We test that the FA2 factory launches an FA2 swap with an FA 2 token and
-        configures it properly including the initial history big maps"""
+        configures it properly including the initial history"""
         factory = Env.deploy_factory_fa2()
         fa2_init_storage = FA2Storage(alice_pk)
 
@@ -623,7 +843,7 @@ class TestFactory(unittest.TestCase):
 
         # should not fail
         swap_address = factory.storage["swaps"][0]()
-        swap = pytezos.using(**using_params).contract(swap_address)
+        swap = Env.contract(swap_address)
 
         # counter incremented
         self.assertEqual(factory.storage()["counter"], 1)
@@ -635,19 +855,22 @@ class TestFactory(unittest.TestCase):
         self.assertEqual(swap.storage()["freezeBaker"], False)
         self.assertEqual(swap.storage()["manager"], factory.address)
         self.assertEqual(swap.storage()["tokenAddress"], token.address)
-        self.assertEqual(swap.storage["history"]["tokenPool"](), tokenPool)
-        self.assertEqual(swap.storage["history"]["xtzPool"](), xtzPool)
-        self.assertEqual(swap.storage["history"]["xtzVolume"](), 0)
+        self.assertEqual(history(swap)["tokenPool"], tokenPool)
+        self.assertEqual(history(swap)["xtzPool"], xtzPool)
+        self.assertEqual(history(swap)["xtzVolume"], 0)
         lqt_total = xtzPool
         self.assertEqual(swap.storage()["lqtTotal"], lqt_total)
         self.assertEqual(swap.storage["user_investments"][alice_pk](), {'direction': 'aDD', 'token': 1000, 'xtz': 10000})
+        self.assertEqual(swap.storage["user_positions"][alice_pk](), {
+            "xtzDeposited": 10000, "tokensDeposited": 1000, "xtzWithdrawn": 0, "tokensWithdrawn": 0,
+            "lqt": lqt_total, "xtzCost": 10000, "tokenCost": 1000})
 
         ## test fa12 balances
         token_address = swap.storage()["tokenAddress"]
-        token = pytezos.using(**using_params).contract(token_address)
+        token = Env.contract(token_address)
 
         def get_balance(addr):
-            return token.balance_of({"requests": [{"owner": addr, "token_id": 0}], "callback": None}).view()[0]['nat_2']
+            return token.balance_of({"requests": [{"owner": addr, "token_id": 0}], "callback": None}).view()[0]['balance']
 
         self.assertEqual(get_balance(alice_pk), tokenPool * 1000 - tokenPool)
         self.assertEqual(get_balance(swap.address), tokenPool)
@@ -657,7 +880,7 @@ class TestFactory(unittest.TestCase):
 
         ## testing lqt token initialization
         lqt_token_address = swap.storage()["lqtAddress"]
-        lqt_token = pytezos.using(**using_params).contract(lqt_token_address)
+        lqt_token = Env.contract(lqt_token_address)
 
         self.assertEqual(lqt_token.storage()["admin"], swap.address)
         self.assertEqual(lqt_token.storage["tokens"][alice_pk](), lqt_total)
@@ -673,7 +896,7 @@ class TestFactory(unittest.TestCase):
 
     def test_launch_exchange(self):
         """We test that the FA1.2 factory launches an FA1.2 swap with an FA1.2 token and
-        configures it properly including the initial history big maps"""
+        configures it properly including the initial history"""
         factory = Env.deploy_factory()
         fa12_init_storage = FA12Storage(alice_pk)
 
@@ -698,7 +921,7 @@ class TestFactory(unittest.TestCase):
 
         # should not fail
         swap_address = factory.storage["swaps"][0]()
-        swap = pytezos.using(**using_params).contract(swap_address)
+        swap = Env.contract(swap_address)
 
         # counter incremented
         self.assertEqual(factory.storage()["counter"], 1)
@@ -710,16 +933,19 @@ class TestFactory(unittest.TestCase):
         self.assertEqual(swap.storage()["freezeBaker"], False)
         self.assertEqual(swap.storage()["manager"], factory.address)
         self.assertEqual(swap.storage()["tokenAddress"], token.address)
-        self.assertEqual(swap.storage["history"]["tokenPool"](), tokenPool)
-        self.assertEqual(swap.storage["history"]["xtzPool"](), xtzPool)
-        self.assertEqual(swap.storage["history"]["xtzVolume"](), 0)
+        self.assertEqual(history(swap)["tokenPool"], tokenPool)
+        self.assertEqual(history(swap)["xtzPool"], xtzPool)
+        self.assertEqual(history(swap)["xtzVolume"], 0)
         lqt_total = xtzPool
         self.assertEqual(swap.storage()["lqtTotal"], lqt_total)
         self.assertEqual(swap.storage["user_investments"][alice_pk](), {'direction': 'aDD', 'token': 1000, 'xtz': 10000})
+        self.assertEqual(swap.storage["user_positions"][alice_pk](), {
+            "xtzDeposited": 10000, "tokensDeposited": 1000, "xtzWithdrawn": 0, "tokensWithdrawn": 0,
+            "lqt": lqt_total, "xtzCost": 10000, "tokenCost": 1000})
 
         ## test fa12 balances
         token_address = swap.storage()["tokenAddress"]
-        token = pytezos.using(**using_params).contract(token_address)
+        token = Env.contract(token_address)
         self.assertEqual(
             token.storage["balances"][alice_pk]()["balance"],
             tokenPool * 1000 - tokenPool
@@ -734,7 +960,7 @@ class TestFactory(unittest.TestCase):
 
         ## testing lqt token initialization
         lqt_token_address = swap.storage()["lqtAddress"]
-        lqt_token = pytezos.using(**using_params).contract(lqt_token_address)
+        lqt_token = Env.contract(lqt_token_address)
 
         self.assertEqual(lqt_token.storage()["admin"], swap.address)
         self.assertEqual(lqt_token.storage["tokens"][alice_pk](), lqt_total)
@@ -751,43 +977,518 @@ class TestFactory(unittest.TestCase):
     @unittest.skip("Only used to deploy on testnet for frontend tests")
     def test_deploy_swarm(self):
         """Used to deploy factory contracts along with FA1.2 and FA2 tokens.
-        Should help with developing the application frontend."""
-        factory = Env.deploy_factory()
-        factory_fa2 = Env.deploy_factory_fa2()
-
-        with open('contract_addresses.txt', 'w') as f:
-            f.write(f'factory FA1.2: {factory.address}\n')
-            f.write(f'factory FA2: {factory_fa2.address}\n')
+        Should help with developing the application frontend.
 
+        The operations go through a pipeline (tools/pipeline.py): the
+        factories are included in one block, the tokens in the next and
+        every exchange in the third."""
         fa2_init_storage = FA2Storage(alice_pk)
+        fa12_init_storage = FA12Storage(alice_pk)
+        fa2_infos = default_token_info[3:]
+        fa12_infos = default_token_info[:3]
 
-        for token_info in default_token_info[3:]:
+        def amount(token_info):
             decimals = int(token_info["decimals"].decode("utf-8"))
-            token = Env.deploy_fa2(fa2_init_storage, token_info)
-            amount = int(1000 * math.pow(10, decimals))
-            token.mint({"address": alice_pk, "amount": amount * 1000, "metadata": {}, "token_id": 0}).send(**send_conf)
-            token.update_operators([{"add_operator": {"owner": alice_pk, "operator": factory_fa2.address, "token_id": 0}}]).send(**send_conf)
-            param = {"token_address": token.address, "token_amount": amount, "token_id": 0}
-            opg = factory_fa2.launchExchange(param).with_amount(Decimal(10)).send(**send_conf)
-            consumed_gas = OperationResult.consumed_gas(opg.opg_result)
-
+            return int(1000 * math.pow(10, decimals))
+
+        with Pipeline(pytezos) as pipeline:
+            factories = [pipeline.submit(pytezos.origination(script=Env.factory_script(build))) for build in ("fa12", "fa2")]
+            factory, factory_fa2 = [Env.contract(submission.wait().originated_contracts[0]) for submission in factories]
+
+            with open('contract_addresses.txt', 'w') as f:
+                f.write(f'factory FA1.2: {factory.address}\n')
+                f.write(f'factory FA2: {factory_fa2.address}\n')
+
+            fa2, fa12 = Env.fa2_contract(), Env.fa12_contract()
+            tokens = [
+                pipeline.submit(pytezos.origination(script=contract.script(initial_storage=storage)))
+                for contract, storage in
+                [(fa2, Env.fa2_storage(fa2_init_storage, token_info, {alice_pk: amount(token_info) * 1000}, [(alice_pk, factory_fa2.address)]))
+                 for token_info in fa2_infos]
+                + [(fa12, Env.fa12_storage(fa12_init_storage, token_info, {alice_pk: (amount(token_info) * 1000, {factory.address: amount(token_info)})}))
+                   for token_info in fa12_infos]
+            ]
+            tokens = [Env.contract(submission.wait().originated_contracts[0]) for submission in tokens]
+            fa2_tokens, fa12_tokens = tokens[:len(fa2_infos)], tokens[len(fa2_infos):]
+
+            launches = [
+                (kind, token, pipeline.submit(launcher.launchExchange(
+                    {"token_address": token.address, "token_amount": amount(token_info), **token_param}
+                ).with_amount(Decimal(10))))
+                for kind, launcher, launched, infos, token_param in [
+                    ("fa2", factory_fa2, fa2_tokens, fa2_infos, dict(token_id=0)),
+                    ("fa1.2", factory, fa12_tokens, fa12_infos, dict()),
+                ]
+                for token, token_info in zip(launched, infos)
+            ]
             with open('contract_addresses.txt', 'a') as f:
-                f.write(f'fa2 token: {token.address} ; {consumed_gas} gas \n')
+                for kind, token, submission in launches:
+                    consumed_gas = OperationResult.consumed_gas(submission.wait().opg_result["contents"][0])
+                    f.write(f'{kind} token: {token.address} ; {consumed_gas} gas \n')
+
+
+    def test_setups_in_one_test(self):
+        """We test that later setups of a test keep the contracts it deployed
+        before and what it sent to them, and launch from their own factory"""
+        (swap, _), = setup_swaps([(10 ** 6, 10 ** 6)])
+        pools = setup_swaps([(10 ** 6, 10 ** 6)] * 2)
+        self.assertEqual(swap.storage["xtzPool"](), 10 ** 6)
+        self.assertNotEqual(pools[0][0].storage["manager"](), swap.storage["manager"]())
+
+        swap.xtzToToken({"to": alice_pk, "minTokensBought": 0, "deadline": "2029-09-06T15:08:29.000Z"}).with_amount(1000).send(**send_conf)
+        (fa2_swap, _), = setup_fa2_swaps([(10 ** 6, 10 ** 6)])
+        self.assertEqual(swap.storage["xtzPool"](), 10 ** 6 + 1000)
+        self.assertEqual(fa2_swap.storage["xtzPool"](), 10 ** 6)
+
+class TestBatchSwap(unittest.TestCase):
+    deadline = "2029-09-06T15:08:29.000Z"
+
+    def legs(self):
+        return [
+            {"xtzToTokenLeg": {"to": alice_pk, "xtzSold": 100000, "minTokensBought": 1}},
+            {"tokenToXtzLeg": {"to": bob_pk, "tokensSold": 5000, "minXtzBought": 1}},
+            {"xtzToTokenLeg": {"to": bob_pk, "xtzSold": 20000, "minTokensBought": 1}},
+            {"xtzToTokenLeg": {"to": alice_pk, "xtzSold": 3000, "minTokensBought": 1}},
+            {"tokenToXtzLeg": {"to": bob_pk, "tokensSold": 70000, "minXtzBought": 1}},
+        ]
+
+    def test_batch_matches_single_swaps(self):
+        """A batch leaves the pool, the reserve and the traders where the same
+        swaps sent one by one do, and records the tez traded by all legs"""
+        tokenPool = 10 ** 10
+        xtzPool = 10 ** 10
+        (swap, token), (swap_single, token_single) = setup_swaps([(tokenPool, xtzPool)] * 2)
+
+        def balances(token):
+            return (token.getBalance(alice_pk, None).callback_view(), token.getBalance(bob_pk, None).callback_view(),
+                    get_xtz_balance(bob_pk), get_xtz_balance(default_reserve))
+
+        legs = self.legs()
+        start = balances(token_single)
+        volume = 0
+        for leg in legs:
+            (kind, param), = leg.items()
+            xtz_pool, token_pool = swap_single.storage["xtzPool"](), swap_single.storage["tokenPool"]()
+            if kind == "xtzToTokenLeg":
+                swap_single.xtzToToken({"to": param["to"], "minTokensBought": 1, "deadline": self.deadline}).with_amount(param["xtzSold"]).send(**send_conf)
+                volume += param["xtzSold"]
+            else:
+                swap_single.tokenToXtz({"to": param["to"], "tokensSold": param["tokensSold"], "minXtzBought": 1, "deadline": self.deadline}).send(**send_conf)
+                volume += int(quote.token_to_xtz(xtz_pool, token_pool, param["tokensSold"]).xtz_volume)
+        single_deltas = [end - begin for begin, end in zip(start, balances(token_single))]
+
+        start = balances(token)
+        amount = sum(leg["xtzToTokenLeg"]["xtzSold"] for leg in legs if "xtzToTokenLeg" in leg)
+        swap.batchSwap({"swaps": legs, "deadline": self.deadline}).with_amount(amount).send(**send_conf)
+        deltas = [end - begin for begin, end in zip(start, balances(token))]
+
+        self.assertEqual(deltas, single_deltas)
+        self.assertEqual(swap.storage["xtzPool"](), swap_single.storage["xtzPool"]())
+        self.assertEqual(swap.storage["tokenPool"](), swap_single.storage["tokenPool"]())
+        self.assertEqual(swap.storage["xtzVolume"](), volume)
+
+    def test_batch_fa2(self):
+        """An FA2 batch moves the tokens of every leg in one transfer"""
+        tokenPool = 10 ** 10
+        xtzPool = 10 ** 10
+        (swap, token), = setup_fa2_swaps([(tokenPool, xtzPool)])
+
+        def balance(owner):
+            return token.balance_of({"requests": [{"owner": owner, "token_id": 0}], "callback": None}).view()[0]["balance"]
+
+        legs = self.legs()
+        xtz_pool, token_pool = xtzPool, tokenPool
+        tokens = {alice_pk: 0, bob_pk: 0}
+        for leg in legs:
+            (kind, param), = leg.items()
+            if kind == "xtzToTokenLeg":
+                res = quote.xtz_to_token(xtz_pool, token_pool, param["xtzSold"])
+                tokens[param["to"]] += int(res.tokens_bought)
+            else:
+                res = quote.token_to_xtz(xtz_pool, token_pool, param["tokensSold"])
+                tokens[alice_pk] -= param["tokensSold"]
+            xtz_pool, token_pool = int(res.xtz_pool), int(res.token_pool)
+
+        start = {owner: balance(owner) for owner in tokens}
+        amount = sum(leg["xtzToTokenLeg"]["xtzSold"] for leg in legs if "xtzToTokenLeg" in leg)
+        swap.batchSwap({"swaps": legs, "deadline": self.deadline}).with_amount(amount).send(**send_conf)
+        self.assertEqual({owner: balance(owner) - start[owner] for owner in tokens}, tokens)
+        self.assertEqual((swap.storage["xtzPool"](), swap.storage["tokenPool"]()), (xtz_pool, token_pool))
+
+    def test_batch_checks(self):
+        """Every leg checks its own minimum out, and the amount must be the
+        tez sold by the legs"""
+        tokenPool = 10 ** 10
+        xtzPool = 10 ** 10
+        swap, _ = setup_swap_dashboard_data_test(tokenPool, xtzPool)
+        bought = int(quote.xtz_to_token(xtzPool, tokenPool, 1000).tokens_bought)
+        cases = [
+            ([{"xtzToTokenLeg": {"to": alice_pk, "xtzSold": 1000, "minTokensBought": bought + 1}}], 1000, '18'),
+            ([{"tokenToXtzLeg": {"to": alice_pk, "tokensSold": 1000, "minXtzBought": 10 ** 6}}], 0, '8'),
+            ([{"xtzToTokenLeg": {"to": alice_pk, "xtzSold": 1000, "minTokensBought": bought}}], 1001, '35'),
+        ]
+        for legs, amount, error in cases:
+            with self.subTest(error=error):
+                with self.assertRaises(MichelsonError) as context:
+                    swap.batchSwap({"swaps": legs, "deadline": self.deadline}).with_amount(amount).send(**send_conf)
+                self.assertEqual(context.exception.args[0]['with'], {'int': error})
+
+
+class TestUpdateTokenPool(unittest.TestCase):
+    def donate(self, build, swap, token, amount):
+        """Sends `amount` tokens to `swap` without going through it."""
+        if build == "fa2":
+            token.transfer([{"from_": alice_pk, "txs": [{"to_": swap.address, "token_id": 0, "amount": amount}]}]).send(**send_conf)
+        else:
+            token.transfer({"from": alice_pk, "to": swap.address, "value": amount}).send(**send_conf)
+
+    def test_update_token_pool(self):
+        """Tokens with a get_balance view are read in place, without an
+        internal operation; the others call back updateTokenPoolInternal.
+        Either way the token pool is the balance of the dex after the call,
+        and the dex is not left locked"""
+        for build, setup in [("fa12", setup_swaps), ("fa2", setup_fa2_swaps)]:
+            for balance_view in (False, True):
+                with self.subTest(build=build, balance_view=balance_view):
+                    (swap, token), = setup([(10 ** 6, 10 ** 6)], balance_view=balance_view)
+                    self.donate(build, swap, token, 1234)
+                    opg = swap.updateTokenPool().send(**send_conf)
+                    content, = opg.opg_result["contents"]
+                    internal = content["metadata"].get("internal_operation_results", [])
+                    self.assertEqual(len(internal), 0 if balance_view else 2)
+                    self.assertEqual(swap.storage["tokenPool"](), 10 ** 6 + 1234)
+                    self.assertFalse(swap.storage["selfIsUpdatingTokenPool"]())
+
+
+class TestLqt(unittest.TestCase):
+    def test_views_match_callbacks(self):
+        """We test that the views of the liquidity token return what its
+        callback entrypoints send"""
+        (swap, _), = setup_swaps([(10 ** 6, 3 * 10 ** 6)])
+        lqt = Env.contract(swap.storage["lqtAddress"]())
+        for owner in [alice_pk, bob_pk]:
+            self.assertEqual(lqt.get_balance(owner).run_view(), lqt.getBalance(owner, None).callback_view())
+        request = {"owner": alice_pk, "spender": swap.address}
+        self.assertEqual(lqt.get_allowance(request).run_view(), lqt.getAllowance(request, None).callback_view())
+        self.assertEqual(lqt.get_total_supply().run_view(), 3 * 10 ** 6)
+        self.assertEqual(lqt.get_total_supply().run_view(), lqt.getTotalSupply(None, None).callback_view())
+
+    def test_batch_transfer(self):
+        """A batch moves the tokens the same transfers one by one do, and is
+        rejected as a whole when a sender cannot pay for all of it"""
+        (swap, _), (swap_single, _) = setup_swaps([(10 ** 6, 10 ** 6)] * 2)
+        lqt, lqt_single = (Env.contract(pool.storage["lqtAddress"]()) for pool in (swap, swap_single))
+        txs = [{"to": bob_pk, "value": 1000}, {"to": default_reserve, "value": 20}, {"to": bob_pk, "value": 3},
+               {"to": alice_pk, "value": 7}]
+        holders = [alice_pk, bob_pk, default_reserve]
+
+        for tx in txs:
+            lqt_single.transfer({"from": alice_pk, "to": tx["to"], "value": tx["value"]}).send(**send_conf)
+        lqt.batchTransfer([{"from": alice_pk, "txs": txs}]).send(**send_conf)
+        self.assertEqual([lqt.get_balance(holder).run_view() for holder in holders],
+                         [lqt_single.get_balance(holder).run_view() for holder in holders])
+        self.assertEqual(lqt.get_balance(bob_pk).run_view(), 1003)
+
+        cases = [
+            ([{"from": alice_pk, "txs": [{"to": bob_pk, "value": 10 ** 6}]}], "NotEnoughBalance"),
+            ([{"from": alice_pk, "txs": [{"to": bob_pk, "value": 1}]},
+              {"from": bob_pk, "txs": [{"to": alice_pk, "value": 1}]}], "NotEnoughAllowance"),
+        ]
+        for batches, error in cases:
+            with self.subTest(error=error):
+                with self.assertRaises(MichelsonError) as context:
+                    lqt.batchTransfer(batches).send(**send_conf)
+                self.assertEqual(context.exception.args[0]['with'], {'string': error})
+        self.assertEqual(lqt.get_balance(bob_pk).run_view(), 1003)
+
+
+class TestQuote(unittest.TestCase):
+    deadline = "2029-09-06T15:08:29.000Z"
 
-        fa12_init_storage = FA12Storage(alice_pk)
+    @staticmethod
+    def pools(swap):
+        storage = swap.storage()
+        return storage["xtzPool"], storage["tokenPool"], storage["lqtTotal"]
 
-        for token_info in default_token_info[:3]:
-            decimals = int(token_info["decimals"].decode("utf-8"))
-            token = Env.deploy_fa12(fa12_init_storage, token_info)
-            amount = int(1000 * math.pow(10, decimals))
-            token.mint({"address": alice_pk, "value": amount * 1000}).send(**send_conf)
-            token.approve({"spender": factory.address, "value": amount}).send(**send_conf)
-            param = {"token_address": token.address, "token_amount": amount}
-            opg = factory.launchExchange(param).with_amount(Decimal(10)).send(**send_conf)
-            consumed_gas = OperationResult.consumed_gas(opg.opg_result)
+    def test_quotes_match_contract(self):
+        """We test that the quotes of every swap and liquidity entrypoint are
+        what the contract computes: amounts out, reserve fee and new pools"""
+        tokenPool = 10 ** 10
+        xtzPool = 10 ** 10
+        (swap, token), (swap_out, token_out) = setup_swaps([(tokenPool, xtzPool)] * 2)
 
-            with open('contract_addresses.txt', 'a') as f:
-                f.write(f'fa1.2 token: {token.address} ; {consumed_gas} gas \n')
+        xtz_sold = 100000
+        expected = quote.xtz_to_token(xtzPool, tokenPool, xtz_sold)
+        start_reserve = get_xtz_balance(default_reserve)
+        swap.xtzToToken({"to": alice_pk, "minTokensBought": int(expected.tokens_bought), "deadline": self.deadline}).with_amount(xtz_sold).send(**send_conf)
+        self.assertEqual(get_xtz_balance(default_reserve) - start_reserve, expected.reserve_fee)
+        self.assertEqual(self.pools(swap)[:2], (expected.xtz_pool, expected.token_pool))
+        self.assertEqual(swap.storage["xtzVolume"](), expected.xtz_volume)
+
+        xtz_pool, token_pool, _ = self.pools(swap)
+        tokens_sold = 1000
+        expected = quote.token_to_xtz(xtz_pool, token_pool, tokens_sold)
+        start_reserve = get_xtz_balance(default_reserve)
+        swap.tokenToXtz({"to": alice_pk, "tokensSold": tokens_sold, "minXtzBought": int(expected.xtz_bought), "deadline": self.deadline}).send(**send_conf)
+        self.assertEqual(get_xtz_balance(default_reserve) - start_reserve, expected.reserve_fee)
+        self.assertEqual(self.pools(swap)[:2], (expected.xtz_pool, expected.token_pool))
+        self.assertEqual(swap.storage["xtzVolume"](), expected.xtz_volume)
+
+        xtz_pool, token_pool, _ = self.pools(swap)
+        xtz_pool_out, token_pool_out, _ = self.pools(swap_out)
+        expected = quote.token_to_token(xtz_pool, token_pool, xtz_pool_out, token_pool_out, tokens_sold)
+        start_reserve = get_xtz_balance(default_reserve)
+        start_tokens = token_out.getBalance(alice_pk, None).callback_view()
+        swap.tokenToToken({
+            "outputDexterContract": swap_out.address,
+            "minTokensBought": int(expected.tokens_bought),
+            "to": alice_pk,
+            "tokensSold": tokens_sold,
+            "deadline": self.deadline
+        }).send(**send_conf)
+        self.assertEqual(get_xtz_balance(default_reserve) - start_reserve, expected.reserve_fee)
+        self.assertEqual(token_out.getBalance(alice_pk, None).callback_view() - start_tokens, expected.tokens_bought)
+        self.assertEqual(self.pools(swap)[:2], (expected.sold.xtz_pool, expected.sold.token_pool))
+        self.assertEqual(self.pools(swap_out)[:2], (expected.bought.xtz_pool, expected.bought.token_pool))
+
+        xtz_deposited = 1001
+        expected = quote.add_liquidity(*self.pools(swap), xtz_deposited)
+        swap.addLiquidity({"owner": alice_pk, "minLqtMinted": int(expected.lqt_minted), "maxTokensDeposited": int(expected.tokens_deposited), "deadline": self.deadline}).with_amount(xtz_deposited).send(**send_conf)
+        self.assertEqual(self.pools(swap), (expected.xtz_pool, expected.token_pool, expected.lqt_total))
+
+        lqt_burned = 12345
+        expected = quote.remove_liquidity(*self.pools(swap), lqt_burned)
+        swap.removeLiquidity({"to": alice_pk, "lqtBurned": lqt_burned, "minXtzWithdrawn": int(expected.xtz_withdrawn), "minTokensWithdrawn": int(expected.tokens_withdrawn), "deadline": self.deadline}).send(**send_conf)
+        self.assertEqual(self.pools(swap), (expected.xtz_pool, expected.token_pool, expected.lqt_total))
+
+    def test_quotes_above_int64(self):
+        """We test that pools and amounts above 2**63 are quoted exactly and
+        that small values give the same quotes through int64 arrays"""
+        xtz_pool = 2 ** 70 + 12345
+        token_pool = 3 ** 45
+        xtz_sold = [1, 10 ** 6, 2 ** 64, 2 ** 66 + 1]
+        res = quote.xtz_to_token(xtz_pool, token_pool, xtz_sold, slippage=50)
+        for i, amount in enumerate(xtz_sold):
+            bought = (amount * 9972 * token_pool) // (xtz_pool * 10000 + amount * 9972)
+            self.assertEqual(res.tokens_bought[i], bought)
+            self.assertEqual(res.reserve_fee[i], amount * 3 // 10000)
+            self.assertEqual(res.token_pool[i], token_pool - bought)
+            self.assertEqual(res.min_tokens_bought[i], bought * 9950 // 10000)
+
+        res = quote.add_liquidity(2 ** 64, 2 ** 64 + 1, 2 ** 64, [7, 2 ** 64])
+        self.assertEqual(list(res.tokens_deposited), [8, 2 ** 64 + 1])
+
+        small = quote.token_to_xtz(10000, 1000, range(1, 2000))
+        exact = quote.token_to_xtz(10000, 1000 + 2 ** 64, range(1, 2000))
+        self.assertEqual(small.xtz_bought.dtype, np.int64)
+        self.assertEqual(exact.xtz_bought.dtype, object)
+        for i, tokens_sold in enumerate(range(1, 2000)):
+            self.assertEqual(small.xtz_bought[i], (tokens_sold * 9972 * 10000) // (1000 * 10000 + tokens_sold * 9972))
+            self.assertEqual(small.reserve_fee[i], (tokens_sold * 3 * 10000) // (1000 * 10000 + tokens_sold * 3))
+
+
+class TestViews(unittest.TestCase):
+    deadline = "2029-09-06T15:08:29.000Z"
+
+    def test_views_match_entrypoints(self):
+        """We test that the views return what the swap and liquidity
+        entrypoints then send: tokens, tez, reserve fee and withdrawals"""
+        (swap, token), = setup_swaps([(10 ** 10 + 7, 3 * 10 ** 9 + 1)])
+        for xtz_sold in [1, 3333, 10 ** 6 + 1]:
+            tokens_bought = swap.getXtzToTokenPrice(xtz_sold).run_view()
+            reserve_fee = swap.getXtzToTokenReserveFee(xtz_sold).run_view()
+            start_tokens = token.getBalance(alice_pk, None).callback_view()
+            start_reserve = get_xtz_balance(default_reserve)
+            swap.xtzToToken({"to": alice_pk, "minTokensBought": tokens_bought, "deadline": self.deadline}).with_amount(xtz_sold).send(**send_conf)
+            self.assertEqual(token.getBalance(alice_pk, None).callback_view() - start_tokens, tokens_bought)
+            self.assertEqual(get_xtz_balance(default_reserve) - start_reserve, reserve_fee)
+
+        for tokens_sold in [1, 4444, 90001]:
+            xtz_bought = swap.getTokenToXtzPrice(tokens_sold).run_view()
+            reserve_fee = swap.getTokenToXtzReserveFee(tokens_sold).run_view()
+            xtz_pool = swap.storage["xtzPool"]()
+            start_reserve = get_xtz_balance(default_reserve)
+            swap.tokenToXtz({"to": alice_pk, "tokensSold": tokens_sold, "minXtzBought": xtz_bought, "deadline": self.deadline}).send(**send_conf)
+            self.assertEqual(swap.storage["xtzPool"](), xtz_pool - xtz_bought - reserve_fee)
+            self.assertEqual(get_xtz_balance(default_reserve) - start_reserve, reserve_fee)
+
+        lqt_burned = 12345
+        value = swap.getLiquidityValue(lqt_burned).run_view()
+        storage = swap.storage()
+        swap.removeLiquidity({"to": alice_pk, "lqtBurned": lqt_burned, "minXtzWithdrawn": value["xtz"], "minTokensWithdrawn": value["tokens"], "deadline": self.deadline}).send(**send_conf)
+        self.assertEqual(swap.storage["xtzPool"](), storage["xtzPool"] - value["xtz"])
+        self.assertEqual(swap.storage["tokenPool"](), storage["tokenPool"] - value["tokens"])
+
+    def test_views_match_quote(self):
+        """We test that the views of both builds agree with tools.quote"""
+        tokenPool, xtzPool = 2 * 10 ** 9 + 3, 10 ** 9 + 5
+        # a cached setup rolls the chain back, so each build is checked right after its setup
+        for setup in (setup_swaps, setup_fa2_swaps):
+            (pool, _), = setup([(tokenPool, xtzPool)])
+            lqtTotal = pool.storage["lqtTotal"]()
+            for amount in [0, 1, 999, 10 ** 6, 2 ** 62]:
+                buy = quote.xtz_to_token(xtzPool, tokenPool, amount)
+                sell = quote.token_to_xtz(xtzPool, tokenPool, amount)
+                self.assertEqual(pool.getXtzToTokenPrice(amount).run_view(), buy.tokens_bought)
+                self.assertEqual(pool.getXtzToTokenReserveFee(amount).run_view(), buy.reserve_fee)
+                self.assertEqual(pool.getTokenToXtzPrice(amount).run_view(), sell.xtz_bought)
+                self.assertEqual(pool.getTokenToXtzReserveFee(amount).run_view(), sell.reserve_fee)
+            for lqt_burned in [1, lqtTotal // 3, lqtTotal]:
+                remove = quote.remove_liquidity(xtzPool, tokenPool, lqtTotal, lqt_burned)
+                self.assertEqual(pool.getLiquidityValue(lqt_burned).run_view(),
+                                 {"xtz": remove.xtz_withdrawn, "tokens": remove.tokens_withdrawn})
+
+    def test_history_view(self):
+        """We test that getHistory returns the entries of the history big_map
+        of the first dex contracts: the pools and the last swap's volume"""
+        tokenPool, xtzPool = 10 ** 9 + 7, 3 * 10 ** 8
+        for setup in (setup_swaps, setup_fa2_swaps):
+            (swap, _), = setup([(tokenPool, xtzPool)])
+            self.assertEqual(swap.getHistory().run_view(), {"tokenPool": tokenPool, "xtzPool": xtzPool, "xtzVolume": 0})
+            expected = quote.xtz_to_token(xtzPool, tokenPool, 12345)
+            swap.xtzToToken({"to": alice_pk, "minTokensBought": 0, "deadline": self.deadline}).with_amount(12345).send(**send_conf)
+            self.assertEqual(swap.getHistory().run_view(), {"tokenPool": int(expected.token_pool),
+                                                            "xtzPool": int(expected.xtz_pool),
+                                                            "xtzVolume": 12345})
+
+    def test_cumulatives(self):
+        """We test that every call adds the prices of the pools it starts
+        from, times the seconds they held, and every swap its tez volume,
+        so two reads of getCumulatives give the averages between them"""
+        (swap, token), = setup_swaps([(10 ** 9, 3 * 10 ** 8)])
+        storage = swap.storage()
+        self.assertEqual((storage["xtzPriceCumulative"], storage["tokenPriceCumulative"],
+                          storage["xtzVolumeCumulative"]), (0, 0, 0))
+        start = twap.read(swap)
+        self.assertEqual(start, twap.advance(storage, start.timestamp))
+
+        calls = [
+            swap.xtzToToken({"to": alice_pk, "minTokensBought": 1, "deadline": self.deadline}).with_amount(10 ** 6),
+            swap.tokenToXtz({"to": alice_pk, "tokensSold": 90000, "minXtzBought": 1, "deadline": self.deadline}),
+            swap.removeLiquidity({"to": alice_pk, "lqtBurned": 10 ** 6, "minXtzWithdrawn": 1,
+                                  "minTokensWithdrawn": 1, "deadline": self.deadline}),
+            swap.xtzToToken({"to": alice_pk, "minTokensBought": 1, "deadline": self.deadline}).with_amount(3 * 10 ** 7),
+        ]
+        volume, prices = 0, []
+        for call in calls:
+            before = swap.storage()
+            call.send(**send_conf)
+            after = swap.storage()
+            self.assertEqual(twap.advance(before, after["lastUpdate"])[:2],
+                             (after["xtzPriceCumulative"], after["tokenPriceCumulative"]))
+            volume += after["xtzVolume"] if call.parameters["entrypoint"] != "removeLiquidity" else 0
+            self.assertEqual(after["xtzVolumeCumulative"], volume)
+            prices.append(Decimal(before["tokenPool"]) / before["xtzPool"])
+
+        end = twap.read(swap)
+        self.assertEqual(end, twap.advance(swap.storage(), end.timestamp))
+        window = twap.average(start, end)
+        self.assertEqual(window.seconds, end.timestamp - start.timestamp)
+        self.assertEqual(window.xtz_volume, volume)
+        self.assertTrue(min(prices) - 1 <= window.xtz_price <= max(prices) + 1)
+
+    def test_positions(self):
+        """We test that the liquidity calls of an address add up in its
+        position, which getPosition returns: the tez and tokens it deposited
+        and withdrew, and the liquidity tokens it still holds at the average
+        cost of its deposits"""
+        tokenPool, xtzPool = 10 ** 9, 3 * 10 ** 8
+        (swap, _), = setup_swaps([(tokenPool, xtzPool)])
+        position = {"xtzDeposited": xtzPool, "tokensDeposited": tokenPool, "xtzWithdrawn": 0, "tokensWithdrawn": 0,
+                    "lqt": xtzPool, "xtzCost": xtzPool, "tokenCost": tokenPool}
+        self.assertEqual(swap.getPosition(alice_pk).run_view(), position)
+        self.assertEqual(swap.getPosition(bob_pk).run_view(), dict.fromkeys(position, 0))
+
+        swap.xtzToToken({"to": alice_pk, "minTokensBought": 1, "deadline": self.deadline}).with_amount(10 ** 7).send(**send_conf)
+        storage = swap.storage()
+        xtz_deposited = 10 ** 4 + 3  # within the 100000 tokens approved by the setup
+        add = quote.add_liquidity(storage["xtzPool"], storage["tokenPool"], storage["lqtTotal"], xtz_deposited)
+        swap.addLiquidity({"owner": alice_pk, "minLqtMinted": 1, "maxTokensDeposited": int(add.tokens_deposited),
+                           "deadline": self.deadline}).with_amount(xtz_deposited).send(**send_conf)
+        for field, value in [("xtzDeposited", xtz_deposited), ("tokensDeposited", add.tokens_deposited),
+                             ("lqt", add.lqt_minted), ("xtzCost", xtz_deposited), ("tokenCost", add.tokens_deposited)]:
+            position[field] += int(value)
+        self.assertEqual(swap.getPosition(alice_pk).run_view(), position)
+
+        for lqt_burned in [position["lqt"] // 3, position["lqt"] - position["lqt"] // 3]:
+            storage = swap.storage()
+            remove = quote.remove_liquidity(storage["xtzPool"], storage["tokenPool"], storage["lqtTotal"], lqt_burned)
+            swap.removeLiquidity({"to": alice_pk, "lqtBurned": lqt_burned, "minXtzWithdrawn": 1, "minTokensWithdrawn": 1,
+                                  "deadline": self.deadline}).send(**send_conf)
+            lqt = position["lqt"] - lqt_burned
+            position.update(xtzWithdrawn=position["xtzWithdrawn"] + int(remove.xtz_withdrawn),
+                            tokensWithdrawn=position["tokensWithdrawn"] + int(remove.tokens_withdrawn),
+                            lqt=lqt,
+                            xtzCost=position["xtzCost"] * lqt // position["lqt"],
+                            tokenCost=position["tokenCost"] * lqt // position["lqt"])
+            self.assertEqual(swap.getPosition(alice_pk).run_view(), position)
+            self.assertEqual(swap.storage["user_positions"][alice_pk](), position)
+        self.assertEqual((position["lqt"], position["xtzCost"], position["tokenCost"]), (0, 0, 0))
+
+    @unittest.skipIf(backend != "interpreter", "bob is only funded in the in-process chain")
+    def test_position_of_owner(self):
+        """We test that liquidity added for another owner goes to the position
+        of the owner, who gets the liquidity tokens and can burn them against
+        it, and leaves the sender's position alone"""
+        tokenPool, xtzPool = 10 ** 9, 3 * 10 ** 8
+        (swap, _), = setup_swaps([(tokenPool, xtzPool)])
+        alice_position = swap.getPosition(alice_pk).run_view()
+
+        storage = swap.storage()
+        xtz_deposited = 10 ** 4 + 3  # within the 100000 tokens approved by the setup
+        add = quote.add_liquidity(storage["xtzPool"], storage["tokenPool"], storage["lqtTotal"], xtz_deposited)
+        swap.addLiquidity({"owner": bob_pk, "minLqtMinted": 1, "maxTokensDeposited": int(add.tokens_deposited),
+                           "deadline": self.deadline}).with_amount(xtz_deposited).send(**send_conf)
+        position = {"xtzDeposited": xtz_deposited, "tokensDeposited": int(add.tokens_deposited), "xtzWithdrawn": 0,
+                    "tokensWithdrawn": 0, "lqt": int(add.lqt_minted), "xtzCost": xtz_deposited,
+                    "tokenCost": int(add.tokens_deposited)}
+        self.assertEqual(swap.getPosition(bob_pk).run_view(), position)
+        self.assertEqual(swap.getPosition(alice_pk).run_view(), alice_position)
+
+        storage = swap.storage()
+        remove = quote.remove_liquidity(storage["xtzPool"], storage["tokenPool"], storage["lqtTotal"], position["lqt"])
+        bob_swap = interfaces.contract(pytezos.using(shell=shell, key=bob_key), swap.address)
+        bob_swap.removeLiquidity({"to": bob_pk, "lqtBurned": position["lqt"], "minXtzWithdrawn": 1, "minTokensWithdrawn": 1,
+                                  "deadline": self.deadline}).send(**send_conf)
+        position.update(xtzWithdrawn=int(remove.xtz_withdrawn), tokensWithdrawn=int(remove.tokens_withdrawn),
+                        lqt=0, xtzCost=0, tokenCost=0)
+        self.assertEqual(swap.getPosition(bob_pk).run_view(), position)
+        self.assertEqual(swap.getPosition(alice_pk).run_view(), alice_position)
+
+    def test_offchain_views(self):
+        """We test that the TZIP-16 views run off-chain on a pool's storage
+        return what its on-chain views return"""
+        (swap, _), = setup_swaps([(10 ** 8 + 1, 3 * 10 ** 7)])
+        dex = interfaces.from_file("michelson/dex_fa12.tz")
+        metadata = ContractMetadata.from_json(views.metadata(dex.to_micheline()), context=dex.context)
+        storage = swap.storage()
+        for name, view in views.VIEWS.items():
+            if name in ("getCumulatives", "getPosition"):
+                # run to NOW and read a big_map entry, which an off-chain
+                # run on the storage alone does not have
+                continue
+            args = () if view.parameter == "unit" else (12345,)
+            self.assertEqual(
+                getattr(metadata, name)(*args).storage_view(storage),
+                getattr(swap, name)(*args).run_view(),
+                name
+            )
+
+    def test_add_views(self):
+        """We test that the views of the compiled contracts are the sections
+        tools.views appends to the compiled contract"""
+        for path, contract_views in [("michelson/dex_fa12.tz", views.VIEWS), ("michelson/dex_fa2.tz", views.VIEWS),
+                                     ("michelson/lqt_fa12.tz", views.LQT_VIEWS)]:
+            with open(path) as f:
+                michelson = f.read()
+            contract = michelson[:michelson.index('\n  view "')].rstrip(" ;") + " }\n"
+            lambdas = {
+                section["args"][0]["string"]: section["args"][3]
+                for section in global_constants.load(path)
+                if section["prim"] == "view"
+            }
+            self.assertEqual(sorted(lambdas), sorted(contract_views))
+            self.assertEqual(views.add_views(contract, lambdas, contract_views), michelson)
 
 
 if __name__ == '__main__':
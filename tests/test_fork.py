@@ -0,0 +1,112 @@
+import os
+import tempfile
+import unittest
+
+from tools import fork
+from tools.indexer import NodeSource
+from tools.local_chain import LocalClient
+
+from test_dex import alice_pk, backend, bob_pk, pytezos, send_conf, setup_fa2_swaps, setup_swaps
+
+if backend == "interpreter":
+    from test_dex import chain as source
+else:
+    source = NodeSource(pytezos.shell)
+
+deadline = "2029-09-06T15:08:29.000Z"
+tokenPool = 10 ** 6
+xtzPool = 10 ** 6
+
+
+def trade(client, swap, swap_out):
+    """Swaps both ways, moves liquidity and trades token to token as `client`."""
+    swap = client.contract(swap)
+    swap.xtzToToken({"to": alice_pk, "minTokensBought": 1, "deadline": deadline}).with_amount(10000).send(**send_conf)
+    swap.tokenToXtz({"to": bob_pk, "tokensSold": 5000, "minXtzBought": 1, "deadline": deadline}).send(**send_conf)
+    swap.addLiquidity({"owner": alice_pk, "minLqtMinted": 1, "maxTokensDeposited": 10000, "deadline": deadline}).with_amount(1000).send(**send_conf)
+    swap.removeLiquidity({"to": alice_pk, "lqtBurned": 500, "minXtzWithdrawn": 1, "minTokensWithdrawn": 1, "deadline": deadline}).send(**send_conf)
+    swap.tokenToToken({
+        "outputDexterContract": swap_out,
+        "minTokensBought": 1,
+        "to": alice_pk,
+        "tokensSold": 1000,
+        "deadline": deadline
+    }).send(**send_conf)
+
+
+class PinnedSource:
+    """`source` that answers reads only at the block `header()` pins."""
+
+    def __init__(self, source):
+        self.source = source
+        self.blocks = []
+
+    def header(self):
+        return {**self.source.block(self.source.head_level())["header"], "hash": "BLpinned"}
+
+    def at(self, block):
+        self.blocks.append(block)
+        return self.source
+
+
+class TestFork(unittest.TestCase):
+    def check_fork(self, swaps):
+        (swap, _), (swap_out, _) = swaps
+        snapshot = fork.export(source, [swap.address, swap_out.address], holders=[alice_pk])
+        with tempfile.TemporaryDirectory() as d:
+            fork.save(snapshot, os.path.join(d, "pools.json"))
+            chain = fork.load(fork.read(os.path.join(d, "pools.json")))
+
+        trade(LocalClient(chain, alice_pk), swap.address, swap_out.address)
+        trade(pytezos, swap.address, swap_out.address)
+
+        forked = LocalClient(chain, alice_pk)
+        for contract in (swap, swap_out):
+            live, offline = contract.storage(), forked.contract(contract.address).storage()
+            for field in ("tokenPool", "xtzPool", "lqtTotal", "xtzVolume"):
+                self.assertEqual(offline[field], live[field], field)
+            self.assertEqual(chain.balance(contract.address), int(pytezos.account(contract.address)["balance"]))
+        return chain
+
+    def test_fa12(self):
+        """Calls on an FA1.2 fork change pools and balances as on the chain"""
+        swaps = setup_swaps([(tokenPool, xtzPool)] * 2)
+        chain = self.check_fork(swaps)
+        (_, token), _ = swaps
+        self.assertEqual(LocalClient(chain, alice_pk).contract(token.address).storage["balances"][alice_pk]["balance"](),
+                         token.storage["balances"][alice_pk]["balance"]())
+
+    def test_fa2(self):
+        """Calls on an FA2 fork change pools and balances as on the chain"""
+        swaps = setup_fa2_swaps([(tokenPool, xtzPool)] * 2)
+        chain = self.check_fork(swaps)
+        (_, token), _ = swaps
+        self.assertEqual(LocalClient(chain, alice_pk).contract(token.address).storage["ledger"][(alice_pk, 0)](),
+                         token.storage["ledger"][(alice_pk, 0)]())
+
+    def test_pinned(self):
+        """An export reads every contract at the block pinned when it starts"""
+        (swap, _), (swap_out, _) = setup_swaps([(tokenPool, xtzPool)] * 2)
+        pinned = PinnedSource(source)
+        snapshot = fork.export(pinned, [swap.address, swap_out.address], holders=[alice_pk])
+        self.assertEqual(pinned.blocks, ["BLpinned"])
+        self.assertEqual(snapshot["level"], source.head_level())
+        self.assertEqual(len(snapshot["contracts"]), 6)
+
+    def test_rewind(self):
+        """A fork restored from its snapshot replays a call identically"""
+        (swap, _), (swap_out, _) = setup_swaps([(tokenPool, xtzPool)] * 2)
+        chain = fork.load(fork.export(source, [swap.address, swap_out.address], holders=[alice_pk]))
+        forked = LocalClient(chain, alice_pk).contract(swap.address)
+        start = chain.snapshot()
+        pools = []
+        for _ in range(2):
+            forked.xtzToToken({"to": alice_pk, "minTokensBought": 1, "deadline": deadline}).with_amount(10000).send()
+            pools.append(forked.storage["tokenPool"]())
+            chain.restore(start)
+        self.assertEqual(pools[0], pools[1])
+        self.assertEqual(forked.storage["tokenPool"](), tokenPool)
+
+
+if __name__ == '__main__':
+    unittest.main()
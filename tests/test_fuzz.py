@@ -0,0 +1,49 @@
+import json
+import random
+import unittest
+
+from tools.fuzz import Case, Model, Runner, Step, fuzz, generate
+
+
+class WrongFeeModel(Model):
+    """A model charging one mutez too much reserve fee on `xtzToToken`."""
+
+    def xtz_to_token(self, xtz):
+        bought, fee = super().xtz_to_token(xtz)
+        return bought, fee + 1
+
+
+class TestFuzz(unittest.TestCase):
+    def test_contract_matches_model(self):
+        report = fuzz(cases=2, steps=10, workers=2, seed=7)
+        self.assertEqual(report.failures, [])
+        self.assertEqual((report.cases, report.steps), (4, 40))
+
+    def test_shrink(self):
+        """A mismatch shrinks to the single step that shows it, with the
+        smallest amounts that still do"""
+        runner = Runner("fa12")
+        case = Case("fa12", 10 ** 6, 10 ** 6, 10 ** 6, [(10 ** 9, 10 ** 6, 0)], [
+            Step("transfer", 0, 1000),
+            Step("default", 0, 5000),
+            Step("tokenToXtz", 0, 10 ** 4, (0,)),
+            Step("xtzToToken", 0, 10 ** 5, (90000,)),
+            Step("addLiquidity", 0, 10 ** 4, (0, 10 ** 6)),
+        ])
+        self.assertIsNone(runner.run(case))
+        mismatch = runner.run(case, WrongFeeModel)
+        self.assertEqual(mismatch.step, 3)
+        self.assertIn("tez", mismatch.fields)
+
+        shrunk, mismatch = runner.shrink(case, mismatch, WrongFeeModel)
+        self.assertEqual(shrunk.steps, [Step("xtzToToken", 0, 0, (0,))])
+        self.assertEqual(mismatch.step, 0)
+        self.assertEqual(runner.run(shrunk, WrongFeeModel), mismatch)
+
+    def test_json(self):
+        case = generate(random.Random(1), "fa2", 5)
+        self.assertEqual(Case.from_json(json.loads(json.dumps(case.to_json()))), case)
+
+
+if __name__ == '__main__':
+    unittest.main()
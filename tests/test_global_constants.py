@@ -0,0 +1,59 @@
+import unittest
+
+from pytezos.rpc.errors import RpcError
+
+from tools import global_constants
+
+from test_dex import backend, pytezos, send_conf
+
+if backend == "interpreter":
+    from test_dex import chain
+
+# a counter whose code is a registered constant
+body = [
+    {"prim": "CDR"},
+    {"prim": "PUSH", "args": [{"prim": "nat"}, {"int": "1"}]},
+    {"prim": "ADD"},
+    {"prim": "NIL", "args": [{"prim": "operation"}]},
+    {"prim": "PAIR"},
+]
+
+
+def script(key):
+    return {
+        "code": [
+            {"prim": "parameter", "args": [{"prim": "unit"}]},
+            {"prim": "storage", "args": [{"prim": "nat"}]},
+            {"prim": "code", "args": [{"prim": "constant", "args": [{"string": key}]}]},
+        ],
+        "storage": {"int": "0"},
+    }
+
+
+class TestGlobalConstants(unittest.TestCase):
+    def setUp(self):
+        if backend != "interpreter":
+            self.skipTest("the constants of a sandbox may be registered already")
+
+    def test_expand(self):
+        """A script runs its constants expanded and stores them as sent"""
+        key = global_constants.constant_hash(body)
+        if key not in chain.constants:
+            pytezos.register_global_constant(body).send(**send_conf)
+        self.assertEqual(chain.constants[key], body)
+
+        opg = pytezos.origination(script=script(key)).send(**send_conf)
+        address = opg.opg_result["contents"][0]["metadata"]["operation_result"]["originated_contracts"][0]
+        self.assertEqual(chain.code(address), global_constants.expand(script(key)["code"], chain.constants))
+        pytezos.transaction(destination=address, amount=0).send(**send_conf)
+        self.assertEqual(chain.storage(address), {"int": "1"})
+
+    def test_unregistered_constant(self):
+        """A script referencing an unregistered constant cannot be originated"""
+        key = global_constants.constant_hash([{"prim": "FAILWITH"}])
+        with self.assertRaises(RpcError):
+            pytezos.origination(script=script(key)).send(**send_conf)
+
+
+if __name__ == '__main__':
+    unittest.main()
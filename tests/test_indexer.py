@@ -0,0 +1,209 @@
+import os
+import tempfile
+import unittest
+
+from tools.indexer import ENTRYPOINTS, ColumnStore, Indexer, NodeSource
+
+from test_dex import Env, FA12Storage, alice_pk, backend, cached_setup, pool_token_info, pytezos, send_conf
+from test_snapshot import CountingSource
+
+if backend == "interpreter":
+    from test_dex import chain as source
+else:
+    source = NodeSource(pytezos.shell)
+
+deadline = "2029-09-06T15:08:29.000Z"
+tokenPool = 10 ** 6
+xtzPool = 10 ** 6
+
+
+@cached_setup
+def setup_pools(count, balance_view=False):
+    """A new factory and `count` FA1.2 swaps launched from it, approved by
+    alice, and the level of the factory. With `balance_view`, the tokens
+    have a `get_balance` view."""
+    factory = Env.deploy_factory()
+    level = source.head_level()
+    tokens = Env.originate_batch([
+        (Env.fa12_contract(balance_view), Env.fa12_storage(FA12Storage(alice_pk), pool_token_info, {alice_pk: (tokenPool * 1000, {factory.address: tokenPool})}))
+        for _ in range(count)
+    ])
+    params = [{"token_address": token.address, "token_amount": tokenPool} for token in tokens]
+    swaps, _ = Env.launch_exchanges(factory, params, [xtzPool] * count)
+    pytezos.bulk(*[
+        token.approve({"spender": swap.address, "value": 100000})
+        for swap, token in zip(swaps, tokens)
+    ]).send(**send_conf)
+    return factory, swaps, level
+
+
+class TestIndexer(unittest.TestCase):
+    def setUp(self):
+        self.factory, self.swaps, self.start_level = setup_pools(2)
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def index(self):
+        store = ColumnStore(self.dir.name)
+        Indexer(source, self.factory.address, store, start_level=self.start_level).sync()
+        return store
+
+    def trade(self):
+        swap, swap_out = self.swaps
+        swap.xtzToToken({"to": alice_pk, "minTokensBought": 0, "deadline": deadline}).with_amount(1000).send(**send_conf)
+        swap.tokenToToken({
+            "outputDexterContract": swap_out.address,
+            "minTokensBought": 0,
+            "to": alice_pk,
+            "tokensSold": 1000,
+            "deadline": deadline
+        }).send(**send_conf)
+
+    def assertPoolState(self, rows, row, swap):
+        storage = swap.storage()
+        self.assertEqual(rows["xtz_pool"][row], storage["xtzPool"])
+        self.assertEqual(rows["token_pool"][row], storage["tokenPool"])
+        self.assertEqual(rows["lqt_total"][row], storage["lqtTotal"])
+        self.assertEqual(rows["xtz_volume"][row], storage["xtzVolume"])
+
+    def test_code_requests(self):
+        """The code of a contract is read once, not for every call"""
+        self.trade()
+        self.trade()
+        counting = CountingSource(source)
+        Indexer(counting, self.factory.address, ColumnStore(self.dir.name), start_level=self.start_level).sync()
+        self.assertLessEqual(counting.requests.get("code", 0), 1 + len(self.swaps))
+
+    def test_history_pool(self):
+        """Pools of the first dex contracts, without xtzVolume, are rejected"""
+        indexer = Indexer(source, self.factory.address, ColumnStore(self.dir.name))
+        indexer._add_pool(0, self.swaps[0].address)
+        storage = {"xtzPool": xtzPool, "tokenPool": tokenPool, "lqtTotal": xtzPool, "history": 7}
+        with self.assertRaisesRegex(ValueError, "history"):
+            indexer._row(self.swaps[0].address, "xtzToToken", alice_pk, 0, storage, 1, 0)
+
+    def test_launches(self):
+        """Pools are found from the factory and their launch is the first row"""
+        store = self.index()
+        self.assertEqual(store.pools, {0: self.swaps[0].address, 1: self.swaps[1].address})
+
+        rows = store.read()
+        self.assertEqual(list(rows["pool"]), [0, 1])
+        self.assertEqual([ENTRYPOINTS[i] for i in rows["entrypoint"]], ["launchExchange"] * 2)
+        self.assertEqual([store.addresses[i] for i in rows["sender"]], [alice_pk] * 2)
+        self.assertEqual(list(rows["investment"]), [1, 1])
+        self.assertEqual(list(rows["investment_xtz"]), [xtzPool] * 2)
+        self.assertEqual(list(rows["investment_token"]), [tokenPool] * 2)
+
+    def test_trades(self):
+        """Every pool call is a row with the pool storage after the call"""
+        self.trade()
+        store = self.index()
+
+        rows = store.read(pools=[0, 1])
+        self.assertEqual(
+            [(pool, ENTRYPOINTS[i]) for pool, i in zip(rows["pool"], rows["entrypoint"])][2:],
+            [(0, "xtzToToken"), (0, "tokenToToken"), (1, "xtzToToken")]
+        )
+        self.assertEqual(store.addresses[rows["sender"][4]], self.swaps[0].address)
+        self.assertEqual(rows["amount"][2], 1000)
+        self.assertEqual(rows["xtz_volume"][2], 1000)
+        self.assertPoolState(rows, 3, self.swaps[0])
+        self.assertPoolState(rows, 4, self.swaps[1])
+
+    def test_route(self):
+        """Every leg of a route is a row of the pool it swaps in"""
+        swap, swap_out = self.swaps
+        swap.xtzToTokenRoute({
+            "to": alice_pk,
+            "minTokensBought": 0,
+            "tokensBought": 0,
+            "legs": [(swap_out.address, 1000)],
+            "deadline": deadline,
+        }).with_amount(3000).send(**send_conf)
+        store = self.index()
+
+        rows = store.read(pools=[0, 1])
+        self.assertEqual(
+            [(pool, ENTRYPOINTS[i]) for pool, i in zip(rows["pool"], rows["entrypoint"])][2:],
+            [(0, "xtzToTokenRoute"), (1, "xtzToTokenRoute")]
+        )
+        self.assertEqual(store.addresses[rows["sender"][2]], alice_pk)
+        self.assertEqual(store.addresses[rows["sender"][3]], swap.address)
+        self.assertEqual(list(rows["amount"][2:]), [3000, 1000])
+        self.assertEqual(list(rows["xtz_volume"][2:]), [2000, 1000])
+        self.assertPoolState(rows, 2, swap)
+        self.assertPoolState(rows, 3, swap_out)
+
+    def test_batch(self):
+        """A batch is one row with the pool storage left by all its legs"""
+        swap = self.swaps[0]
+        legs = [
+            {"xtzToTokenLeg": {"to": alice_pk, "xtzSold": 2000, "minTokensBought": 1}},
+            {"tokenToXtzLeg": {"to": alice_pk, "tokensSold": 5000, "minXtzBought": 1}},
+            {"xtzToTokenLeg": {"to": alice_pk, "xtzSold": 1000, "minTokensBought": 1}},
+        ]
+        swap.batchSwap({"swaps": legs, "deadline": deadline}).with_amount(3000).send(**send_conf)
+        store = self.index()
+
+        rows = store.read(pools=[0])
+        self.assertEqual([ENTRYPOINTS[i] for i in rows["entrypoint"]], ["launchExchange", "batchSwap"])
+        self.assertEqual(rows["amount"][1], 3000)
+        self.assertEqual(rows["xtz_pool"][1], swap.storage["xtzPool"]())
+        self.assertEqual(rows["token_pool"][1], swap.storage["tokenPool"]())
+        self.assertNotEqual(rows["token_pool"][1], tokenPool)
+        self.assertPoolState(rows, 1, swap)
+
+    def test_liquidity(self):
+        """Liquidity calls carry their user_investments entry"""
+        swap = self.swaps[0]
+        swap.addLiquidity({"owner": alice_pk, "minLqtMinted": 1, "maxTokensDeposited": 10000, "deadline": deadline}).with_amount(1000).send(**send_conf)
+        swap.removeLiquidity({"to": alice_pk, "lqtBurned": 500, "minXtzWithdrawn": 1, "minTokensWithdrawn": 1, "deadline": deadline}).send(**send_conf)
+        store = self.index()
+
+        rows = store.read(pools=[0])
+        self.assertEqual([ENTRYPOINTS[i] for i in rows["entrypoint"]], ["launchExchange", "addLiquidity", "removeLiquidity"])
+        self.assertEqual(list(rows["investment"]), [1, 1, -1])
+        self.assertEqual(list(rows["investment_xtz"][1:]), [1000, 500])
+        self.assertPoolState(rows, 2, swap)
+
+    def test_token_pool_update(self):
+        """A token pool read from the balance view is the row of updateTokenPool"""
+        self.factory, self.swaps, self.start_level = setup_pools(2, balance_view=True)
+        swap = self.swaps[0]
+        token = pytezos.contract(swap.storage["tokenAddress"]())
+        token.transfer({"from": alice_pk, "to": swap.address, "value": 5000}).send(**send_conf)
+        pytezos.contract(swap.address).updateTokenPool().send(**send_conf)
+        store = self.index()
+
+        rows = store.read(pools=[0])
+        self.assertEqual([ENTRYPOINTS[i] for i in rows["entrypoint"]], ["launchExchange", "updateTokenPool"])
+        self.assertEqual(rows["token_pool"][1], tokenPool + 5000)
+        self.assertPoolState(rows, 1, swap)
+
+    def test_resume(self):
+        """A reopened store only indexes the new levels"""
+        store = self.index()
+        level = store.level
+        self.trade()
+        store = self.index()
+
+        self.assertEqual(store.rows, 5)
+        rows = store.read(["level", "pool"], start_level=level + 1)
+        self.assertEqual(list(rows["pool"]), [0, 0, 1])
+        self.assertTrue((rows["level"] > level).all())
+        self.assertEqual(len(store.read(end_level=level)["level"]), 2)
+
+    def test_truncated_tail(self):
+        """Rows written after the last saved level are dropped on reopen"""
+        self.index()
+        with open(os.path.join(self.dir.name, "pool.bin"), "ab") as f:
+            f.write(b"\x01\x02\x03")
+        store = ColumnStore(self.dir.name)
+
+        self.assertEqual(store.rows, 2)
+        self.assertEqual(list(store.read(["pool"])["pool"]), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from pytezos import pytezos
+from pytezos.context.abstract import get_originated_address
+from pytezos.michelson.parse import michelson_to_micheline
+
+from tools.interfaces import InterfaceCache
+from tools.local_chain import code_hash
+
+factory, pool = get_originated_address(1), get_originated_address(2)
+# no node listens there: the tests fail if the cache fetches a script
+offline = pytezos.using(shell="http://localhost:1")
+
+
+def load_code(path):
+    with open(path) as f:
+        return michelson_to_micheline(f.read())
+
+
+class TestInterfaces(unittest.TestCase):
+    def test_from_file(self):
+        """A source parsed once is read back from the cache directory by
+        another cache, without parsing it again"""
+        with tempfile.TemporaryDirectory() as directory:
+            parsed = InterfaceCache(directory).from_file("michelson/dex_fa12.tz")
+            with mock.patch("tools.interfaces.michelson_to_micheline", side_effect=AssertionError):
+                cached = InterfaceCache(directory).from_file("michelson/dex_fa12.tz")
+            self.assertEqual(cached.to_micheline(), parsed.to_micheline())
+            self.assertEqual(set(cached.entrypoints), set(parsed.entrypoints))
+            self.assertIn("xtzToToken", cached.entrypoints)
+
+    def test_spawned(self):
+        """The pools and liquidity tokens of a factory are bound to the code
+        of its CREATE_CONTRACTs without fetching their scripts"""
+        with tempfile.TemporaryDirectory() as directory:
+            interfaces = InterfaceCache(directory)
+            key = code_hash(interfaces.from_file("michelson/factory_fa12.tz").to_micheline())
+            interfaces.bind(factory, key)
+            dex = interfaces.spawned(factory, "xtzToToken")
+            self.assertEqual(dex, code_hash(load_code("michelson/dex_fa12.tz")))
+            self.assertEqual(interfaces.spawned(factory, "mintOrBurn"), code_hash(load_code("michelson/lqt_fa12.tz")))
+            self.assertIsNone(interfaces.spawned(pool, "xtzToToken"))
+            self.assertIn("xtzToToken", interfaces.entrypoints(dex))
+
+            swap = interfaces.contract(offline, pool, key=dex)
+            self.assertEqual(swap.address, pool)
+            self.assertEqual(swap.context.code_expr, load_code("michelson/dex_fa12.tz")[2])
+            self.assertEqual(swap.xtzToToken(to=pool, minTokensBought=1, deadline=0).parameters["entrypoint"],
+                             "xtzToToken")
+
+            # the unchecked binding of the pool stays in this process; a new
+            # one knows the factory and parses the dex once
+            interfaces = InterfaceCache(directory)
+            self.assertEqual(interfaces.addresses, {factory: key})
+            self.assertIs(interfaces.contract(offline, pool, key=dex).program,
+                          interfaces.contract(offline, pool, key=dex).program)
+
+
+if __name__ == '__main__':
+    unittest.main()
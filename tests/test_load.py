@@ -0,0 +1,55 @@
+import unittest
+
+from tools.load import LoadTest, failure_code, group_result, parse_mix
+
+from test_dex import pytezos, setup_fa2_swaps, setup_swaps
+
+deadline = "2029-09-06T15:08:29.000Z"
+
+
+class TestLoad(unittest.TestCase):
+    def test_mix(self):
+        """Every call of the mix runs from the funded traders and the pools
+        keep their invariants"""
+        (swap, _), (other, _) = setup_swaps([(10 ** 6, 10 ** 6)] * 2)
+        test = LoadTest(pytezos, swap.address, other.address, traders=4, rate=200, trade_size=(0.001, 0.01),
+                        deadline=deadline)
+        test.fund(xtz=10 ** 7, tokens=10 ** 5, lqt=10 ** 4)
+        report = test.run(duration=0.2)
+
+        self.assertEqual(len(report.results), 40)
+        self.assertTrue(set(report.calls()) <= set(test.mix))
+        self.assertEqual({result.trader for result in report.results}, set(test.traders))
+        self.assertTrue(report.applied)
+        self.assertTrue(report.ok, report.format())
+        self.assertEqual([check.pool for check in report.pools], [swap.address, other.address])
+        self.assertIsNone(report.hard_gas_limit_per_block)
+
+    def test_stale_quotes(self):
+        """Without slippage tolerance, trades quoted off a state that an
+        earlier trade moved fail with error 18"""
+        (swap, _), = setup_fa2_swaps([(10 ** 6, 10 ** 6)])
+        test = LoadTest(pytezos, swap.address, traders=2, rate=200, mix={"xtzToToken": 1}, trade_size=(0.01, 0.02),
+                        slippage=0, quote_interval=float("inf"), deadline=deadline)
+        test.fund(xtz=10 ** 7, tokens=0)
+        report = test.run(duration=0.05)
+
+        self.assertEqual([result.status for result in report.results], ["applied"] + ["rejected"] * 9)
+        self.assertEqual(report.failures, {"18": 9})
+        self.assertTrue(report.ok, report.format())
+
+    def test_results(self):
+        self.assertEqual(failure_code({"id": "proto.011-PtHangz2.michelson_v1.script_rejected", "with": {"int": "2"}}), "2")
+        self.assertEqual(failure_code({"id": "proto.011-PtHangz2.contract.balance_too_low"}), "contract.balance_too_low")
+        contents = [{"metadata": {
+            "operation_result": {"status": "backtracked", "consumed_milligas": "1500"},
+            "internal_operation_results": [{"result": {
+                "status": "failed", "errors": [{"id": "proto.011-PtHangz2.michelson_v1.script_rejected", "with": {"int": "18"}}],
+            }}],
+        }}]
+        self.assertEqual(group_result(contents), ("failed", "18", 2))
+        self.assertEqual(parse_mix("xtzToToken=4,updateTokenPool"), {"xtzToToken": 4.0, "updateTokenPool": 1.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
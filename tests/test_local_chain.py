@@ -0,0 +1,40 @@
+import unittest
+
+from pytezos import ContractInterface
+from pytezos.michelson.micheline import MichelsonRuntimeError
+from pytezos.rpc.errors import MichelsonError
+
+from tools.local_chain import LocalChain, LocalClient, ScriptRejected
+
+from test_dex import alice_key, alice_pk, send_conf
+
+rejecting = ContractInterface.from_michelson("""
+parameter unit ;
+storage (big_map nat nat) ;
+code { CDR ; PUSH nat 7 ; FAILWITH }
+""")
+
+
+class TestLocalChain(unittest.TestCase):
+    def test_pytezos_semantics_outside_the_chain(self):
+        """Importing the in-process chain leaves pytezos execution outside it
+        as it was"""
+        with self.assertRaises(MichelsonRuntimeError) as e:
+            rejecting.default().interpret(storage={})
+        self.assertNotIsInstance(e.exception.__cause__, ScriptRejected)
+        self.assertEqual(e.exception.args, ("FAILWITH", "7"))
+
+    def test_rejected_value(self):
+        """On the chain, FAILWITH keeps the rejected value"""
+        chain = LocalChain()
+        chain.set_balance(alice_pk, 10 ** 9)
+        client = LocalClient(chain, alice_key)
+        opg = client.origination(script=rejecting.script(initial_storage={})).send(**send_conf)
+        address = opg.opg_result["contents"][0]["metadata"]["operation_result"]["originated_contracts"][0]
+        with self.assertRaises(MichelsonError) as e:
+            client.transaction(destination=address, amount=0).send(**send_conf)
+        self.assertEqual(e.exception.args[0]["with"], {"int": "7"})
+
+
+if __name__ == '__main__':
+    unittest.main()
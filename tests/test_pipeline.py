@@ -0,0 +1,79 @@
+import unittest
+from unittest import mock
+
+from pytezos.rpc.errors import MichelsonError
+
+from tools.pipeline import Pipeline, Submission, _Account
+
+from test_dex import Env, FA12Storage, alice_pk, pool_token_info, pytezos, setup_swaps
+
+deadline = "2029-09-06T15:08:29.000Z"
+
+
+class TestPipeline(unittest.TestCase):
+    def test_submit(self):
+        """Submissions resolve to their own receipts, and a rejected call
+        raises the error send would raise without failing the others"""
+        (swap, token), = setup_swaps([(10 ** 6, 10 ** 6)])
+        with Pipeline(pytezos) as pipeline:
+            buys = [
+                pipeline.submit(swap.xtzToToken({"to": alice_pk, "minTokensBought": 1, "deadline": deadline}).with_amount(1000))
+                for _ in range(3)
+            ]
+            rejected = pipeline.submit(swap.xtzToToken({"to": alice_pk, "minTokensBought": 10 ** 6,
+                                                        "deadline": deadline}).with_amount(1000))
+            origination = pipeline.submit(pytezos.origination(script=Env.fa12_contract().script(
+                initial_storage=Env.fa12_storage(FA12Storage(alice_pk), pool_token_info))))
+
+        for buy in buys:
+            content, = buy.wait().opg_result["contents"]
+            self.assertEqual(content["parameters"]["entrypoint"], "xtzToToken")
+        self.assertEqual(len({buy.level for buy in buys}), 3)
+        with self.assertRaises(MichelsonError) as context:
+            rejected.wait()
+        self.assertEqual(context.exception.args[0]["with"], {"int": "18"})
+        address, = origination.wait().originated_contracts
+        self.assertEqual(Env.contract(address).storage["administrator"](), alice_pk)
+        with self.assertRaises(MichelsonError):
+            pipeline.wait()
+
+    def test_merge(self):
+        """Queued groups of one source are merged up to the operation size
+        limit"""
+        pipeline = Pipeline(pytezos)
+        pipeline._constants = {"max_operation_data_length": 400}
+        account = pipeline._accounts.setdefault(alice_pk, _Account())
+        transfers = [Submission(pytezos, pytezos.transaction(destination=alice_pk, amount=1)) for _ in range(5)]
+        account.queue.extend(transfers)
+        size = Pipeline._size(transfers[0])
+        self.assertGreater(size, 50)
+
+        fits = (400 - 96) // size
+        self.assertEqual(pipeline._take(account, merge=True), transfers[:fits])
+        self.assertEqual(pipeline._take(account, merge=False), transfers[fits:fits + 1])
+        self.assertEqual(list(account.queue), transfers[fits + 1:])
+
+    def test_thread_error(self):
+        """An error that stops the sending thread fails every pending
+        submission and closes the pipeline"""
+        pipeline = Pipeline(pytezos)
+        account = pipeline._accounts.setdefault(alice_pk, _Account())
+        transfers = [Submission(pytezos, pytezos.transaction(destination=alice_pk, amount=1)) for _ in range(2)]
+        account.queue.extend(transfers)
+        pipeline.submissions.extend(transfers)
+        error = ConnectionError("node unreachable")
+        with mock.patch.object(pipeline, "_send", side_effect=error):
+            pipeline._run()
+
+        for transfer in transfers:
+            with self.assertRaises(ConnectionError):
+                transfer.wait(timeout=0)
+        self.assertFalse(account.queue)
+        pipeline.local = False
+        with self.assertRaises(RuntimeError) as context:
+            pipeline.submit(pytezos.transaction(destination=alice_pk, amount=1))
+        self.assertIs(context.exception.__cause__, error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+from pytezos.michelson.micheline import MichelineSequence
+from pytezos.operation.result import OperationResult
+
+from tools.profiler import DECODE_AND_ENCODE, Profiler, ligo_map
+
+from test_dex import alice_pk, backend, send_conf, setup_fa2_swaps, setup_swaps
+
+if backend == "interpreter":
+    from test_dex import chain
+
+deadline = "2029-09-06T15:08:29.000Z"
+
+
+@unittest.skipIf(backend != "interpreter", "profiles run in the in-process chain")
+class TestProfiler(unittest.TestCase):
+    def profiler(self, swap):
+        dex = chain.accounts[swap.address].code_id
+        return Profiler(chain, names={dex: "dex"}, sources={dex: ligo_map("dex.mligo")})
+
+    def test_ligo_map(self):
+        """Entrypoints, the prologue of main and the entrypoint lookups are
+        found in the source, through its includes"""
+        ligo = ligo_map("dex_fa2.mligo")
+        self.assertEqual(ligo.entrypoints["xtzToToken"], "xtz_to_token")
+        self.assertEqual(ligo.entrypoints["updateTokenPoolInternal"], "update_token_pool_internal")
+        self.assertEqual(ligo.prologue, ("accumulate",))
+        self.assertIn("token_transfer", ligo.instructions["CONTRACT %transfer"])
+        self.assertEqual(ligo.instructions["VIEW get_balance"], ("token_balance_view",))
+
+    def test_profile(self):
+        """Every executed instruction is counted once, under the call that
+        ran it, and the profiler leaves the interpreter as it found it"""
+        (swap, _), = setup_swaps([(10 ** 6, 10 ** 6)])
+        sequence = MichelineSequence.__dict__["execute"]
+        profiler = self.profiler(swap)
+        with profiler:
+            opg = swap.tokenToXtz({"to": alice_pk, "tokensSold": 1000, "minXtzBought": 0, "deadline": deadline}).send(**send_conf)
+        self.assertIs(MichelineSequence.__dict__["execute"], sequence)
+        self.assertNotIn("execute", vars(chain))
+
+        executed = sum(int(result.get("executed_instructions", 0)) for result in OperationResult.iter_results(opg.opg_result))
+        calls = {stack[0] for stack in profiler.samples}
+        self.assertIn("dex%tokenToXtz (token_to_xtz)", calls)
+        self.assertEqual(len(calls), 2)  # and the token transfer
+        self.assertEqual(profiler.total(), executed)
+        labels = {label for label, _, _ in profiler.table()}
+        self.assertIn("CONTRACT %transfer (token_transfer, batch_token_transfers)", labels)
+        self.assertGreater(dict((label, value) for label, value, _ in profiler.table("time"))[DECODE_AND_ENCODE], 0)
+
+        lines = profiler.collapsed()
+        self.assertEqual(sum(int(line.rsplit(" ", 1)[1]) for line in lines), profiler.total())
+        self.assertIn("dex%tokenToXtz (token_to_xtz);prologue (accumulate);NOW 2", lines)
+        self.assertFalse([line for line in lines if ";IF" in line.rsplit(";", 1)[0]])
+
+    def test_view(self):
+        """A view runs under the VIEW instruction of its caller"""
+        (swap, _), = setup_fa2_swaps([(10 ** 6, 10 ** 6)], balance_view=True)
+        profiler = self.profiler(swap)
+        with profiler:
+            opg = swap.updateTokenPool().send(**send_conf)
+        executed = sum(int(result.get("executed_instructions", 0)) for result in OperationResult.iter_results(opg.opg_result))
+        self.assertEqual(profiler.total(), executed)
+        view = [line for line in profiler.collapsed() if ";VIEW get_balance (token_balance_view);" in line]
+        self.assertTrue(view)
+        self.assertTrue(all(line.startswith("dex%updateTokenPool (update_token_pool);") for line in view))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+from tools.indexer import NodeSource
+from tools.registry import PoolRegistry, read_registry
+from tools.router import Router
+
+from test_dex import Env, FA12Storage, alice_pk, backend, pool_token_info, pytezos, send_conf
+from test_indexer import setup_pools
+
+if backend == "interpreter":
+    from test_dex import chain as source
+else:
+    source = NodeSource(pytezos.shell)
+
+deadline = "2029-09-06T15:08:29.000Z"
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.factory, self.swaps, _ = setup_pools(2)
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "pools.json")
+
+    def registry(self, path=None, **kwargs):
+        return PoolRegistry(path or self.path, source, [self.factory.address], **kwargs)
+
+    def assertCurrent(self, snapshot):
+        """`snapshot` has every pool of the factory as it is at the head"""
+        self.assertEqual(snapshot.level, source.head_level())
+        self.assertEqual(snapshot.counters, {self.factory.address: self.factory.storage["counter"]()})
+        for index in range(self.factory.storage["counter"]()):
+            swap = Env.contract(self.factory.storage["swaps"][index]())
+            storage = swap.storage()
+            pool = snapshot[swap.address]
+            self.assertEqual(pool.index, index)
+            self.assertEqual(pool.token, (storage["tokenAddress"], None))
+            self.assertEqual(pool.lqt_address, storage["lqtAddress"])
+            self.assertEqual((pool.token_pool, pool.xtz_pool, pool.lqt_total, pool.reserve),
+                             (storage["tokenPool"], storage["xtzPool"], storage["lqtTotal"], storage["reserve"]))
+            self.assertEqual(snapshot.tokens[pool.token], (pool,))
+
+    def launch(self):
+        token = Env.originate(Env.fa12_contract(), Env.fa12_storage(
+            FA12Storage(alice_pk), pool_token_info, {alice_pk: (10 ** 6, {self.factory.address: 10 ** 6})}))
+        (swap,), _ = Env.launch_exchanges(self.factory, [{"token_address": token.address, "token_amount": 10 ** 6}], [10 ** 6])
+        return swap
+
+    def test_refresh(self):
+        """A new registry reads every pool; later refreshes follow the trades
+        and the launches of the blocks since, and end where a new read does"""
+        registry = self.registry()
+        self.assertCurrent(registry.refresh())
+
+        self.swaps[0].xtzToToken({"to": alice_pk, "minTokensBought": 0, "deadline": deadline}).with_amount(1000).send(**send_conf)
+        swap = self.launch()
+        snapshot = registry.refresh()
+        self.assertCurrent(snapshot)
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(snapshot[swap.address].index, 2)
+
+        fresh = self.registry(os.path.join(self.dir.name, "fresh.json")).refresh()
+        self.assertEqual(fresh.pools, snapshot.pools)
+        self.assertIs(registry.refresh(), snapshot)
+
+    def test_far_behind(self):
+        """Past `max_blocks`, only the new swaps entries and the storage of
+        the pools are read"""
+        self.registry().refresh()
+        self.launch()
+        registry = self.registry(max_blocks=0)
+        self.assertEqual(len(registry.snapshot), 2)
+        self.assertCurrent(registry.refresh())
+
+    def test_file(self):
+        """The saved registry reads back without a source and feeds a router"""
+        snapshot = self.registry().refresh()
+        saved = read_registry(self.path)
+        self.assertEqual((saved.level, saved.counters, saved.pools), (snapshot.level, snapshot.counters, snapshot.pools))
+        with self.assertRaises(ValueError):
+            PoolRegistry(self.path).refresh()
+
+        router = Router.from_registry(saved)
+        token = saved[self.swaps[0].address].token
+        route = router.quote(None, token, 1000)
+        self.assertEqual([leg.pool for leg in route.buys], [self.swaps[0].address])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+
+from pytezos.rpc.errors import MichelsonError
+
+from tools import quote
+from tools.indexer import NodeSource
+from tools.router import XTZ, Router
+
+from test_dex import Env, FA12Storage, alice_pk, backend, cached_setup, pool_token_info, pytezos, send_conf
+
+if backend == "interpreter":
+    from test_dex import chain as source
+else:
+    source = NodeSource(pytezos.shell)
+
+deadline = "2029-09-06T15:08:29.000Z"
+# (tokenPool, xtzPool) of the pools of each token in the two factories
+pools = [
+    [(10 ** 6, 10 ** 6), (4 * 10 ** 6, 4 * 10 ** 6)],
+    [(2 * 10 ** 6, 10 ** 6), (10 ** 6, 10 ** 6)],
+]
+
+
+@cached_setup
+def setup_pools():
+    """Two FA1.2 factories with a pool of each of two tokens, approved by
+    alice. Returns the factories and the tokens."""
+    factories = [Env.originate_factory("fa12")[0] for _ in range(2)]
+    tokens = Env.originate_batch([
+        (Env.fa12_contract(), Env.fa12_storage(FA12Storage(alice_pk), pool_token_info, {
+            alice_pk: (10 ** 9, {factory.address: 10 ** 8 for factory in factories})
+        }))
+        for _ in pools
+    ])
+    swaps = []
+    for i, factory in enumerate(factories):
+        params = [{"token_address": token.address, "token_amount": token_pools[i][0]}
+                  for token, token_pools in zip(tokens, pools)]
+        factory_swaps, _ = Env.launch_exchanges(factory, params, [token_pools[i][1] for token_pools in pools])
+        swaps += list(zip(factory_swaps, tokens))
+    pytezos.bulk(*[
+        token.approve({"spender": swap.address, "value": 10 ** 8})
+        for swap, token in swaps
+    ]).send(**send_conf)
+    return factories, tokens
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        self.factories, self.tokens = setup_pools()
+        self.router = Router.from_factories(source, [factory.address for factory in self.factories])
+        self.token_in, self.token_out = [(token.address, None) for token in self.tokens]
+
+    def balance(self, token):
+        return token.getBalance(alice_pk, None).callback_view()
+
+    def test_pools(self):
+        """Pools are grouped by token across factories"""
+        self.assertEqual(len(self.router.pools), 2)
+        self.assertEqual(
+            sorted((pool.token_pool, pool.xtz_pool) for pool in self.router.pools[self.token_in]),
+            sorted(pools[0])
+        )
+
+    def test_split_beats_single_pool(self):
+        """A large order is split and buys more than the best single pool"""
+        amount = 10 ** 6
+        route = self.router.quote(XTZ, self.token_out, amount)
+        self.assertEqual(len(route.buys), 2)
+        self.assertEqual(sum(leg.amount_in for leg in route.buys), amount)
+        single = max(int(quote.xtz_to_token(xtz_pool, token_pool, amount).tokens_bought) for token_pool, xtz_pool in pools[1])
+        self.assertGreater(route.amount_out, single)
+
+    def test_xtz_to_token_route(self):
+        """The route buys exactly the quoted tokens in one operation"""
+        route = self.router.quote(XTZ, self.token_out, 10 ** 6, slippage=50)
+        before = self.balance(self.tokens[1])
+        pytezos.bulk(*route.operations(pytezos, alice_pk, deadline)).send(**send_conf)
+        self.assertEqual(self.balance(self.tokens[1]) - before, route.amount_out)
+
+        before = {pool.address: pool.xtz_pool for pool in self.router.pools[self.token_out]}
+        after = Router.from_factories(source, [factory.address for factory in self.factories])
+        for pool in after.pools[self.token_out]:
+            xtz_sold = next(leg.amount_in for leg in route.buys if leg.pool == pool.address)
+            reserve_fee = xtz_sold * quote.RESERVE_FEE // quote.FEE_DENOMINATOR
+            self.assertEqual(pool.xtz_pool, before[pool.address] + xtz_sold - reserve_fee)
+
+    def test_token_to_token_route(self):
+        """Tokens are sold across the input pools and the tez routed to the output pools"""
+        route = self.router.quote(self.token_in, self.token_out, 10 ** 6)
+        self.assertEqual(len(route.sells), 2)
+        balances = [self.balance(token) for token in self.tokens]
+        pytezos.bulk(*route.operations(pytezos, alice_pk, deadline)).send(**send_conf)
+        self.assertEqual(self.balance(self.tokens[0]), balances[0] - 10 ** 6)
+        self.assertEqual(self.balance(self.tokens[1]), balances[1] + route.amount_out)
+
+    def test_min_tokens_bought(self):
+        """The last leg fails the whole route below minTokensBought"""
+        route = self.router.quote(XTZ, self.token_out, 10 ** 6)
+        route = route._replace(min_out=route.amount_out + 1)
+        with self.assertRaises(MichelsonError) as context:
+            pytezos.bulk(*route.operations(pytezos, alice_pk, deadline)).send(**send_conf)
+        self.assertIn("18", str(context.exception))
+
+    def test_legs_exceed_amount(self):
+        """The legs of a route cannot take more tez than it was sent"""
+        swap = pytezos.contract(self.router.pools[self.token_out][0].address)
+        other = self.router.pools[self.token_out][1].address
+        with self.assertRaises(MichelsonError) as context:
+            swap.xtzToTokenRoute({
+                "to": alice_pk,
+                "minTokensBought": 0,
+                "tokensBought": 0,
+                "legs": [(other, 2000)],
+                "deadline": deadline,
+            }).with_amount(1000).send(**send_conf)
+        self.assertIn("34", str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
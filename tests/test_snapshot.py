@@ -0,0 +1,103 @@
+import unittest
+
+from tools.indexer import NodeSource
+from tools.snapshot import DexStorage, FactoryStorage, Investment, LqtStorage, Position, StorageReader
+
+from test_dex import alice_pk, backend, bob_pk, pytezos, send_conf, setup_fa2_swaps, setup_swaps
+
+if backend == "interpreter":
+    from test_dex import chain as source
+else:
+    source = NodeSource(pytezos.shell)
+
+deadline = "2029-09-06T15:08:29.000Z"
+
+
+class CountingSource:
+    """`source` counting the requests made through it."""
+
+    def __init__(self, source):
+        self.source = source
+        self.requests = {}
+
+    def __getattr__(self, name):
+        method = getattr(self.source, name)
+
+        def call(*args):
+            self.requests[name] = self.requests.get(name, 0) + 1
+            return method(*args)
+
+        return call
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_typed_storage(self):
+        """Dex, factory and liquidity token storage decode to their types
+        with the requested big_map entries"""
+        (swap, token), = setup_swaps([(10 ** 6, 10 ** 6)])
+        swap.xtzToToken({"to": alice_pk, "minTokensBought": 0, "deadline": deadline}).with_amount(1000).send(**send_conf)
+        storage = swap.storage()
+        snapshot = StorageReader(source).read(
+            [swap.address, storage["manager"], storage["lqtAddress"], token.address],
+            keys={"user_investments": [alice_pk, bob_pk], "user_positions": [alice_pk, bob_pk], "tokens": [alice_pk],
+                  "swaps": [0, 1]},
+        )
+
+        pool = snapshot[swap.address]
+        self.assertIsInstance(pool, DexStorage)
+        self.assertEqual((pool.xtz_pool, pool.token_pool, pool.lqt_total, pool.xtz_volume),
+                         (storage["xtzPool"], storage["tokenPool"], storage["lqtTotal"], 1000))
+        self.assertIsNone(pool.token_id)
+        self.assertEqual((pool.xtz_volume_cumulative, pool.last_update),
+                         (1000, storage["lastUpdate"]))
+        self.assertEqual(pool.user_investments, {alice_pk: Investment(10 ** 6, 10 ** 6, 1)})
+        self.assertEqual(pool.user_investments.ptr, storage["user_investments"])
+        self.assertEqual(pool.user_positions, {alice_pk: Position(10 ** 6, 10 ** 6, 0, 0, 10 ** 6, 10 ** 6, 10 ** 6)})
+        self.assertEqual(snapshot.balances[swap.address], storage["xtzPool"])
+
+        factory = snapshot[storage["manager"]]
+        self.assertIsInstance(factory, FactoryStorage)
+        self.assertEqual((factory.counter, factory.swaps), (1, {0: swap.address}))
+
+        lqt = snapshot[storage["lqtAddress"]]
+        self.assertIsInstance(lqt, LqtStorage)
+        self.assertEqual((lqt.total_supply, lqt.tokens), (10 ** 6, {alice_pk: 10 ** 6}))
+
+        # any other contract keeps the storage pytezos decodes
+        self.assertEqual(snapshot[token.address], token.storage())
+
+    def test_history_pool(self):
+        """A pool of the first dex contracts, with a history big_map instead
+        of xtzVolume, decodes with its history entries"""
+        storage = {
+            "tokenPool": 10 ** 6, "xtzPool": 2 * 10 ** 6, "lqtTotal": 2 * 10 ** 6,
+            "selfIsUpdatingTokenPool": False, "freezeBaker": False, "manager": bob_pk,
+            "tokenAddress": bob_pk, "lqtAddress": bob_pk, "history": 7, "user_investments": 8, "reserve": bob_pk,
+        }
+        entries = {("KT1pool", "history"): {"xtzPool": 2 * 10 ** 6, "xtzVolume": 1000}}
+        pool = StorageReader._typed("KT1pool", storage, entries)
+        self.assertIsInstance(pool, DexStorage)
+        self.assertEqual((pool.xtz_pool, pool.xtz_volume, pool.user_positions), (2 * 10 ** 6, None, None))
+        self.assertEqual(pool.history, {"xtzPool": 2 * 10 ** 6, "xtzVolume": 1000})
+        self.assertEqual(pool.history.ptr, 7)
+
+    def test_fa2_pool(self):
+        (swap, token), = setup_fa2_swaps([(10 ** 6, 10 ** 6)])
+        pool = StorageReader(source).read([swap.address])[swap.address]
+        self.assertEqual((pool.token_address, pool.token_id), (token.address, 0))
+
+    def test_requests(self):
+        """A snapshot costs one request per contract and one per big_map key"""
+        swaps = setup_swaps([(10 ** 6, 10 ** 6)] * 3)
+        counting = CountingSource(source)
+        reader = StorageReader(counting)
+        snapshot = reader.read([swap.address for swap, _ in swaps], keys={"user_investments": [alice_pk, bob_pk]})
+        requests = {name: count for name, count in counting.requests.items() if name in ("contract", "big_map_value", "storage", "code", "balance")}
+        self.assertEqual(requests, {"contract": 3, "big_map_value": 6})
+        self.assertEqual(len(reader.decoders), 1)
+        for swap, _ in swaps:
+            self.assertEqual(snapshot[swap.address].xtz_pool, swap.storage["xtzPool"]())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,2 @@
+"""Python tooling for the DEX contracts: an in-process chain for running the
+compiled `michelson/*.tz` code, plus clients and utilities built on pytezos."""
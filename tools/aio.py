@@ -0,0 +1,201 @@
+"""asyncio client for the pools, tokens and accounts of the dex.
+
+`get_xtz_balance`, `swap.storage()` and `token.getBalance(...).callback_view()`
+block on one node request each, so checking N pools costs N round trips in
+sequence. `AsyncClient` runs the same reads on a bounded pool of worker
+threads and exposes them as coroutines, so they can be gathered:
+
+    async with AsyncClient(HttpSource("http://localhost:8732", connections=32)) as client:
+        checks = await client.check_pools(pools)
+        broken = [check for check in checks if not check.ok]
+
+`HttpSource` reads what a `NodeSource` reads over one keep-alive
+`requests.Session` whose connection pool holds at most `connections`
+connections (pytezos opens a new connection per request); `AsyncClient`
+takes it, a `NodeSource` or a `LocalChain`. Storage decodes to the types of
+tools/snapshot.py.
+
+Token balances are read from the ledger big_map of the token (`ledger`,
+`balances` or `tokens`, keyed by address or by (address, token id)), so an
+FA1.2, FA2 or liquidity token balance costs one request once the token's
+ledger is known, instead of a `run_code` of a callback entrypoint.
+
+`check_pools` pins the block first, so every read of a check sees the same
+state: a pool passes when `xtzPool` is its balance and `tokenPool` is its
+balance of its token.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import requests
+from pytezos.michelson.forge import forge_script_expr
+from pytezos.michelson.types import MichelsonType
+from pytezos.rpc.node import RpcError
+from requests.adapters import HTTPAdapter
+
+from tools.indexer import _Decoder
+from tools.snapshot import DexStorage, StorageReader, pin
+
+LEDGER_FIELDS = ("ledger", "balances", "tokens")
+
+
+class HttpSource:
+    """The state at `block` read from the node at `url` with at most
+    `connections` concurrent keep-alive connections."""
+
+    def __init__(self, url: str, connections: int = 16, block="head", session: Optional[requests.Session] = None,
+                 timeout: float = 30.0):
+        self.url = url.rstrip("/")
+        self.block_id = block
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections, pool_block=True)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+
+    def at(self, block) -> "HttpSource":
+        return HttpSource(self.url, block=block, session=self.session, timeout=self.timeout)
+
+    def _get(self, path: str):
+        res = self.session.get(f"{self.url}/chains/main/{path}", timeout=self.timeout)
+        if res.status_code != 200:
+            raise RpcError.from_response(res)
+        return res.json()
+
+    def head_level(self) -> int:
+        return int(self._get("blocks/head/header")["level"])
+
+    def header(self) -> dict:
+        return self._get(f"blocks/{self.block_id}/header")
+
+    def block(self, level: int) -> dict:
+        return self._get(f"blocks/{level}")
+
+    def contract(self, address: str) -> dict:
+        return self._get(f"blocks/{self.block_id}/context/contracts/{address}")
+
+    def storage(self, address: str):
+        return self._get(f"blocks/{self.block_id}/context/contracts/{address}/storage")
+
+    def code(self, address: str) -> List[dict]:
+        return self._get(f"blocks/{self.block_id}/context/contracts/{address}/script")["code"]
+
+    def balance(self, address: str) -> int:
+        return int(self._get(f"blocks/{self.block_id}/context/contracts/{address}/balance"))
+
+    def big_map_value(self, ptr: int, key_hash: str):
+        try:
+            return self._get(f"blocks/{self.block_id}/context/big_maps/{ptr}/{key_hash}")
+        except RpcError:
+            return None
+
+
+class Ledger(NamedTuple):
+    ptr: int
+    key_type: MichelsonType
+    value_type: MichelsonType
+
+
+class PoolCheck(NamedTuple):
+    pool: str
+    xtz_pool: int
+    balance: int
+    token_pool: int
+    token_balance: int
+
+    @property
+    def ok(self) -> bool:
+        return self.xtz_pool == self.balance and self.token_pool == self.token_balance
+
+
+class AsyncClient:
+    """Coroutines reading `source` on at most `connections` threads."""
+
+    def __init__(self, source, connections: int = 16, executor: Optional[ThreadPoolExecutor] = None,
+                 reader: Optional[StorageReader] = None, ledgers: Optional[Dict[str, Ledger]] = None):
+        self.source = source
+        self.connections = connections
+        self.executor = executor or ThreadPoolExecutor(connections)
+        self.reader = reader or StorageReader(source)
+        # the big_map of a ledger field never changes, so ledgers outlive blocks
+        self.ledgers: Dict[str, Ledger] = {} if ledgers is None else ledgers
+
+    async def __aenter__(self) -> "AsyncClient":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+    def pinned(self) -> "AsyncClient":
+        """A client sharing this one's threads, reading the current block."""
+        source, _ = pin(self.source)
+        return AsyncClient(source, self.connections, self.executor, self.reader, self.ledgers)
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def balance(self, address: str) -> int:
+        """Tez balance of an account or contract, in mutez."""
+        return await self._call(self.source.balance, address)
+
+    async def storage(self, address: str):
+        """Typed storage of `address`, without big_map entries."""
+        contract = await self._call(self.source.contract, address)
+        return self.reader.decode(address, contract)
+
+    async def storages(self, addresses: Iterable[str]) -> list:
+        return await asyncio.gather(*(self.storage(address) for address in addresses))
+
+    async def token_balance(self, token: str, owner: str, token_id: Optional[int] = None) -> int:
+        """Balance of `owner` in the ledger of `token` (FA1.2 when `token_id`
+        is None), 0 without an entry."""
+        ledger = await self._ledger(token)
+        key = owner if token_id is None else (owner, token_id)
+        key_hash = forge_script_expr(ledger.key_type.from_python_object(key).pack(legacy=True))
+        value = await self._call(self.source.big_map_value, ledger.ptr, key_hash)
+        if value is None:
+            return 0
+        value = ledger.value_type.from_micheline_value(value).to_python_object()
+        return value["balance"] if isinstance(value, dict) else value
+
+    async def lqt_balance(self, pool: DexStorage, owner: str) -> int:
+        """Liquidity tokens of `owner` in the pool with storage `pool`."""
+        return await self.token_balance(pool.lqt_address, owner)
+
+    async def _ledger(self, token: str) -> Ledger:
+        if token not in self.ledgers:
+            contract = await self._call(self.source.contract, token)
+            decoder = _Decoder(contract["script"]["code"])
+            storage = decoder.storage(contract["script"]["storage"])
+            name = next((name for name in LEDGER_FIELDS if name in decoder.big_map_types), None)
+            if name is None:
+                raise ValueError(f"{token} has no ledger big_map among {LEDGER_FIELDS}")
+            self.ledgers[token] = Ledger(storage[name], *decoder.big_map_types[name])
+        return self.ledgers[token]
+
+    async def check_pool(self, pool: str) -> PoolCheck:
+        storage, balance = await asyncio.gather(self.storage(pool), self.balance(pool))
+        token_balance = await self.token_balance(storage.token_address, pool, storage.token_id)
+        return PoolCheck(pool, storage.xtz_pool, balance, storage.token_pool, token_balance)
+
+    async def check_pools(self, pools: Iterable[str]) -> List[PoolCheck]:
+        """The balance checks of `pools`, all read at the same block."""
+        client = self.pinned()
+        return await asyncio.gather(*(client.check_pool(pool) for pool in pools))
+
+
+def check_pools(source, pools: Iterable[str], connections: int = 16) -> List[PoolCheck]:
+    """`AsyncClient.check_pools` for callers without an event loop."""
+
+    async def run():
+        async with AsyncClient(source, connections) as client:
+            return await client.check_pools(pools)
+
+    return asyncio.run(run())
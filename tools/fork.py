@@ -0,0 +1,162 @@
+"""Fork mode: run pool calls offline against a snapshot of real pool state.
+
+`export` reads the state of some pools from a node (`NodeSource`) or a
+`LocalChain`, all at the block that was the head when it started: the code,
+storage and balance of every pool, of its token and of its liquidity token,
+and the big_map entries of those contracts that can be keyed by the given
+holders (token balances and allowances, FA2 operators, `user_investments`,
+`user_positions`). Big_maps cannot be listed through the RPC, so only
+entries whose keys are built from the exported addresses and token ids are
+read; each big_map is saved as a literal with those entries.
+
+`load` installs a snapshot into a `LocalChain` at the same addresses, so
+the contracts run the real code on the real state. `LocalClient` can be
+bound to any holder's address, and `LocalChain.snapshot` / `restore` rewind
+the fork between what-if runs:
+
+    snapshot = fork.export(NodeSource(pytezos.shell), [pool], holders=[trader])
+    fork.save(snapshot, "pool.json")
+
+    chain = fork.load(fork.read("pool.json"))
+    swap = LocalClient(chain, trader).contract(pool)
+    start = chain.snapshot()
+    for amount in amounts:
+        swap.xtzToToken({...}).with_amount(amount).send()
+        ...
+        chain.restore(start)
+"""
+
+import itertools
+import json
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Set
+
+from pytezos.michelson.forge import forge_script_expr
+from pytezos.michelson.types import BigMapType, MichelsonType
+from pytezos.rpc.node import RpcError
+
+from tools.local_chain import LocalChain, is_implicit
+from tools.snapshot import pin
+
+
+def _storage_type(code: List[dict]):
+    return MichelsonType.match(next(expr for expr in code if expr["prim"] == "storage")["args"][0])
+
+
+def _candidate_keys(key_type: dict, addresses: List[str], token_ids: List[int]) -> List[dict]:
+    """Values of `key_type` built from `addresses` and `token_ids`, as Micheline."""
+    prim = key_type["prim"]
+    if prim == "address":
+        return [{"string": address} for address in addresses]
+    if prim == "nat":
+        return [{"int": str(token_id)} for token_id in token_ids]
+    if prim == "pair":
+        args = key_type["args"]
+        if len(args) > 2:
+            args = [args[0], {"prim": "pair", "args": args[1:]}]
+        return [
+            {"prim": "Pair", "args": [left, right]}
+            for left, right in itertools.product(*(_candidate_keys(arg, addresses, token_ids) for arg in args))
+        ]
+    return []
+
+
+def export_contract(source, address: str, addresses: List[str], token_ids: List[int]) -> dict:
+    """Script and balance of `address` with its big_maps as literals of the
+    entries keyed by `addresses` and `token_ids`."""
+    code = source.code(address)
+    storage = _storage_type(code).from_micheline_value(source.storage(address))
+    big_maps: List[BigMapType] = []
+    storage.find(lambda item: isinstance(item, BigMapType) and big_maps.append(item))
+    lazy_diff = []
+    for big_map in big_maps:
+        updates = []
+        key_type = big_map.args[0]
+        for key_expr in _candidate_keys(key_type.as_micheline_expr(), addresses, token_ids):
+            key = key_type.from_micheline_value(key_expr)
+            key_hash = forge_script_expr(key.pack(legacy=True))
+            value = source.big_map_value(big_map.ptr, key_hash)
+            if value is not None:
+                updates.append({"key": key_expr, "key_hash": key_hash, "value": value})
+        lazy_diff.append({"kind": "big_map", "id": str(big_map.ptr), "diff": {"action": "update", "updates": updates}})
+    storage = storage.merge_lazy_diff(lazy_diff).to_micheline_value(lazy_diff=True)
+    return {"balance": source.balance(address), "script": {"code": code, "storage": storage}}
+
+
+def export(source, pools: Iterable[str], holders: Iterable[str] = ()) -> dict:
+    """Snapshot of `pools`, their tokens and liquidity tokens and the entries
+    of `holders`, at the head of `source`. Every read is made at the block
+    that was the head when the export started."""
+    source, header = pin(source)
+    pools = list(pools)
+    contracts: List[str] = list(pools)
+    token_ids: Set[int] = {0}
+    for pool in pools:
+        storage = _storage_type(source.code(pool)).from_micheline_value(source.storage(pool)).to_python_object()
+        token_ids.add(storage.get("tokenId", 0))
+        for address in (storage["tokenAddress"], storage["lqtAddress"]):
+            if not is_implicit(address) and address not in contracts and _exists(source, address):
+                contracts.append(address)
+    addresses = list(dict.fromkeys([*holders, *contracts]))
+    return {
+        "level": int(header["level"]),
+        "timestamp": header["timestamp"],
+        "contracts": {
+            address: export_contract(source, address, addresses, sorted(token_ids))
+            for address in contracts
+        },
+        "accounts": {
+            address: source.balance(address)
+            for address in addresses
+            if is_implicit(address)
+        },
+    }
+
+
+def _exists(source, address: str) -> bool:
+    try:
+        source.code(address)
+    except (KeyError, RpcError):
+        return False
+    return True
+
+
+def load(snapshot: dict, chain: Optional[LocalChain] = None) -> LocalChain:
+    """Installs `snapshot` into `chain` (a new chain at the snapshot's level
+    and time by default) and returns the chain."""
+    if chain is None:
+        now = datetime.fromisoformat(snapshot["timestamp"].replace("Z", "+00:00"))
+        chain = LocalChain(now=int(now.astimezone(timezone.utc).timestamp()))
+        chain.level = snapshot["level"]
+    for address, balance in snapshot["accounts"].items():
+        chain.set_balance(address, balance)
+    for address, contract in snapshot["contracts"].items():
+        chain.install(address, contract["script"], contract["balance"])
+    return chain
+
+
+def save(snapshot: dict, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(snapshot, f)
+
+
+def read(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from pytezos import pytezos
+
+    from tools.indexer import NodeSource
+
+    parser = argparse.ArgumentParser(description="Save the state of dex pools for offline runs.")
+    parser.add_argument("snapshot", help="output file")
+    parser.add_argument("--pool", action="append", required=True)
+    parser.add_argument("--holder", action="append", default=[])
+    parser.add_argument("--shell", default="http://localhost:8732")
+    args = parser.parse_args()
+
+    save(export(NodeSource(pytezos.using(shell=args.shell).shell), args.pool, args.holder), args.snapshot)
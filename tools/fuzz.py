@@ -0,0 +1,706 @@
+"""Differential fuzzing of the dex against a reference model.
+
+`generate` draws a `Case`: a pool of random size (log-uniform from one unit
+to 2**60 mutez and 2**80 tokens), one to three traders with random tez,
+tokens and liquidity, and a sequence of `Step`s: `xtzToToken`,
+`tokenToXtz`, `addLiquidity`, `removeLiquidity`, `default`,
+`updateTokenPool` and plain token transfers to the pool. Amounts are drawn
+against the pool or the trader's balance, and minimum-out bounds are the
+model's quote shifted by a small slack, so both sides of every check are
+exercised.
+
+`Runner` installs the case into a `LocalChain` (the compiled
+michelson/dex_fa12.tz or dex_fa2.tz with the test token and
+michelson/lqt_fa12.tz, no factory) and applies the steps to the contract
+and to `Model`, the tools/quote.py arithmetic plus the balances, ledgers and
+failure order of dex.mligo. After every step it compares the outcome (the
+error a step fails with) and the `State` of both sides: the pool storage
+with its price and volume accumulators, `user_investments`,
+`user_positions`, every tez, token and liquidity token balance.
+
+`fuzz` fans the cases out over a process pool, each worker holding one
+runner per build, and shrinks every failing case by dropping steps and
+lowering amounts while the mismatch persists:
+
+    report = fuzz(cases=10000, steps=50, workers=8)
+    for failure in report.failures:
+        print(failure.mismatch, json.dumps(failure.case))
+
+A case is plain data, so `python -m tools.fuzz --replay case.json` runs a
+saved case again.
+"""
+
+import copy
+import json
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from pytezos import ContractInterface
+from pytezos.context.abstract import get_originated_address
+from pytezos.crypto.key import Key
+from pytezos.michelson.forge import forge_script_expr
+from pytezos.rpc.node import RpcError
+
+from tools import quote
+from tools.indexer import INVESTMENT_DIRECTIONS, _Decoder
+from tools.interfaces import default_cache
+from tools.load import failure_code
+from tools.local_chain import LocalChain
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUILDS = ("fa12", "fa2")
+CALLS = {"xtzToToken": 4, "tokenToXtz": 4, "addLiquidity": 2, "removeLiquidity": 2, "default": 1,
+         "updateTokenPool": 1, "transfer": 1}
+MAX_TRADERS = 3
+MAX_XTZ = 2 ** 60  # pools and balances stay far below the 2**63 mutez limit
+MAX_TOKENS = 2 ** 80
+# the fields of a `user_positions` entry, zero for an address without one
+POSITION_FIELDS = ("xtzDeposited", "tokensDeposited", "xtzWithdrawn", "tokensWithdrawn", "lqt", "xtzCost", "tokenCost")
+NO_POSITION = (0,) * len(POSITION_FIELDS)
+INSUFFICIENT_BALANCE = {"fa12": "FA1.2_InsufficientBalance", "fa2": "FA2_INSUFFICIENT_BALANCE"}
+CANNOT_BURN = "Cannot burn more than the target's balance."
+DIV_BY_ZERO = "DIV by 0"
+BALANCE_TOO_LOW = "contract.balance_too_low"
+RUNTIME_ERROR = "michelson_v1.runtime_error"
+
+
+class Step(NamedTuple):
+    call: str
+    trader: int
+    amount: int  # tez sent, tokens sold or transferred, or liquidity burned
+    bounds: Tuple[int, ...] = ()  # minimum out; (minLqtMinted, maxTokensDeposited) for addLiquidity
+
+
+class Case(NamedTuple):
+    build: str  # "fa12" or "fa2"
+    xtz_pool: int
+    token_pool: int
+    lqt_total: int
+    traders: List[Tuple[int, int, int]]  # (tez, tokens, liquidity) per trader
+    steps: List[Step]
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Case":
+        data = dict(data)
+        data["traders"] = [tuple(trader) for trader in data["traders"]]
+        data["steps"] = [Step(call, trader, amount, tuple(bounds)) for call, trader, amount, bounds in data["steps"]]
+        return cls(**data)
+
+    def to_json(self) -> dict:
+        return self._asdict()
+
+
+class State(NamedTuple):
+    xtz_pool: int
+    token_pool: int
+    lqt_total: int
+    xtz_volume: int
+    xtz_price_cumulative: int
+    token_price_cumulative: int
+    xtz_volume_cumulative: int
+    self_is_updating_token_pool: bool
+    investments: Tuple[Optional[Tuple[int, int, int]], ...]  # per trader
+    positions: Tuple[Tuple[int, ...], ...]  # per trader, in POSITION_FIELDS order
+    tez: Tuple[int, ...]  # pool, reserve, traders
+    tokens: Tuple[int, ...]  # pool, traders
+    lqt: Tuple[int, ...]  # traders
+    lqt_supply: int
+
+
+class Mismatch(NamedTuple):
+    step: int  # index of the step after which the sides differ
+    expected_error: Optional[str]
+    error: Optional[str]
+    fields: Dict[str, Tuple[object, object]]  # field -> (model, contract)
+
+
+class Failure(NamedTuple):
+    case: Case
+    mismatch: Mismatch
+
+
+class Model:
+    """What dex.mligo, the test tokens and lqt_fa12.mligo do to `case`."""
+
+    def __init__(self, case: Case):
+        self.build = case.build
+        self.xtz_pool, self.token_pool, self.lqt_total = case.xtz_pool, case.token_pool, case.lqt_total
+        self.xtz_volume = 0
+        self.xtz_price_cumulative = self.token_price_cumulative = self.xtz_volume_cumulative = 0
+        # seconds since the case was installed: every step is a block of one
+        # second, and the failing ones are not baked
+        self.now = self.last_update = 0
+        self.investments: Dict[int, Tuple[int, int, int]] = {}
+        self.positions: Dict[int, Tuple[int, ...]] = {}
+        self.tez = {"pool": case.xtz_pool, "reserve": 0}
+        self.tokens = {"pool": case.token_pool}
+        self.lqt: Dict[object, int] = {"manager": case.lqt_total - sum(lqt for _, _, lqt in case.traders)}
+        for index, (tez, tokens, lqt) in enumerate(case.traders):
+            self.tez[index], self.tokens[index], self.lqt[index] = tez, tokens, lqt
+        self.lqt_supply = case.lqt_total
+
+    def state(self, traders: int) -> State:
+        return State(
+            xtz_pool=self.xtz_pool,
+            token_pool=self.token_pool,
+            lqt_total=self.lqt_total,
+            xtz_volume=self.xtz_volume,
+            xtz_price_cumulative=self.xtz_price_cumulative,
+            token_price_cumulative=self.token_price_cumulative,
+            xtz_volume_cumulative=self.xtz_volume_cumulative,
+            self_is_updating_token_pool=False,
+            investments=tuple(self.investments.get(index) for index in range(traders)),
+            positions=tuple(self.positions.get(index, NO_POSITION) for index in range(traders)),
+            tez=(self.tez["pool"], self.tez["reserve"], *(self.tez[index] for index in range(traders))),
+            tokens=(self.tokens["pool"], *(self.tokens[index] for index in range(traders))),
+            lqt=tuple(self.lqt[index] for index in range(traders)),
+            lqt_supply=self.lqt_supply,
+        )
+
+    # quotes, None when the contract divides by zero ---------------------------
+
+    def xtz_to_token(self, xtz: int) -> Optional[Tuple[int, int]]:
+        if self.xtz_pool == 0 and xtz == 0:
+            return None
+        q = quote.xtz_to_token(self.xtz_pool, self.token_pool, xtz)
+        return int(q.tokens_bought), int(q.reserve_fee)
+
+    def token_to_xtz(self, tokens: int) -> Optional[Tuple[int, int, int]]:
+        if self.token_pool == 0 and tokens == 0:
+            return None
+        q = quote.token_to_xtz(self.xtz_pool, self.token_pool, tokens)
+        return int(q.xtz_bought), int(q.reserve_fee), int(q.xtz_volume)
+
+    def add_liquidity(self, xtz: int) -> Optional[Tuple[int, int]]:
+        if self.xtz_pool == 0:
+            return None
+        q = quote.add_liquidity(self.xtz_pool, self.token_pool, self.lqt_total, xtz)
+        return int(q.lqt_minted), int(q.tokens_deposited)
+
+    def remove_liquidity(self, lqt: int) -> Optional[Tuple[int, int]]:
+        if self.lqt_total == 0:
+            return None
+        q = quote.remove_liquidity(self.xtz_pool, self.token_pool, self.lqt_total, lqt)
+        return int(q.xtz_withdrawn), int(q.tokens_withdrawn)
+
+    # steps -------------------------------------------------------------------
+
+    def apply(self, step: Step) -> Optional[str]:
+        """Applies `step` and returns None, or returns the error it fails
+        with and leaves the model as it was."""
+        saved = copy.deepcopy(self.__dict__)
+        self.now += 1
+        if step.call != "transfer":
+            self._accumulate()
+        error = self._apply(step)
+        if error is not None:
+            self.__dict__ = saved
+        return error
+
+    def _accumulate(self) -> None:
+        """The price accumulators of a dex call, before the call changes the pools."""
+        elapsed = self.now - self.last_update
+        if self.xtz_pool:
+            self.xtz_price_cumulative += (self.token_pool << 64) // self.xtz_pool * elapsed
+        if self.token_pool:
+            self.token_price_cumulative += (self.xtz_pool << 64) // self.token_pool * elapsed
+        self.last_update = self.now
+
+    def _send_tez(self, source, destination, amount: int) -> Optional[str]:
+        if self.tez[source] < amount:
+            return BALANCE_TOO_LOW
+        self.tez[source] -= amount
+        self.tez[destination] += amount
+        return None
+
+    def _send_tokens(self, source, destination, amount: int) -> Optional[str]:
+        if self.tokens[source] < amount:
+            return INSUFFICIENT_BALANCE[self.build]
+        self.tokens[source] -= amount
+        self.tokens[destination] += amount
+        return None
+
+    def _apply(self, step: Step) -> Optional[str]:
+        call, trader, amount = step.call, step.trader, step.amount
+        if call == "xtzToToken":
+            (min_tokens,) = step.bounds
+            error = self._send_tez(trader, "pool", amount)
+            if error:
+                return error
+            amounts = self.xtz_to_token(amount)
+            if amounts is None:
+                return DIV_BY_ZERO
+            bought, fee = amounts
+            if bought < min_tokens:
+                return "18"
+            self.xtz_pool += amount - fee
+            self.token_pool -= bought
+            self.xtz_volume = amount
+            self.xtz_volume_cumulative += amount
+            return self._send_tokens("pool", trader, bought) or (fee and self._send_tez("pool", "reserve", fee)) or None
+        if call == "tokenToXtz":
+            (min_xtz,) = step.bounds
+            amounts = self.token_to_xtz(amount)
+            if amounts is None:
+                return DIV_BY_ZERO
+            bought, fee, volume = amounts
+            if bought < min_xtz:
+                return "8"
+            if bought + fee > self.xtz_pool:
+                # the reserve fee tends to the whole pool like the tez bought, so
+                # selling many times the token pool underflows `xtzPool`
+                return RUNTIME_ERROR
+            self.token_pool += amount
+            self.xtz_pool -= bought + fee
+            self.xtz_volume = volume
+            self.xtz_volume_cumulative += volume
+            return (self._send_tokens(trader, "pool", amount) or self._send_tez("pool", trader, bought)
+                    or (fee and self._send_tez("pool", "reserve", fee)) or None)
+        if call == "addLiquidity":
+            min_lqt, max_tokens = step.bounds
+            error = self._send_tez(trader, "pool", amount)
+            if error:
+                return error
+            amounts = self.add_liquidity(amount)
+            if amounts is None:
+                return DIV_BY_ZERO
+            minted, deposited = amounts
+            if deposited > max_tokens:
+                return "4"
+            if minted < min_lqt:
+                return "5"
+            self.lqt_total += minted
+            self.token_pool += deposited
+            self.xtz_pool += amount
+            self.investments[trader] = (amount, deposited, INVESTMENT_DIRECTIONS["aDD"])
+            xtz_in, tokens_in, xtz_out, tokens_out, held, xtz_cost, token_cost = self.positions.get(trader, NO_POSITION)
+            self.positions[trader] = (xtz_in + amount, tokens_in + deposited, xtz_out, tokens_out, held + minted,
+                                      xtz_cost + amount, token_cost + deposited)
+            error = self._send_tokens(trader, "pool", deposited)
+            if error:
+                return error
+            self.lqt[trader] += minted
+            self.lqt_supply += minted
+            return None
+        if call == "removeLiquidity":
+            min_xtz, min_tokens = step.bounds
+            amounts = self.remove_liquidity(amount)
+            if amounts is None:
+                return DIV_BY_ZERO
+            xtz, tokens = amounts
+            if xtz < min_xtz:
+                return "11"
+            if tokens < min_tokens:
+                return "13"
+            if amount > self.lqt_total:
+                return "14"
+            if tokens > self.token_pool:
+                return "15"
+            self.xtz_pool -= xtz
+            self.lqt_total -= amount
+            self.token_pool -= tokens
+            self.investments[trader] = (xtz, tokens, INVESTMENT_DIRECTIONS["rEMOVE"])
+            xtz_in, tokens_in, xtz_out, tokens_out, held, xtz_cost, token_cost = self.positions.get(trader, NO_POSITION)
+            if held > amount:
+                # the liquidity left keeps its average cost
+                xtz_cost, token_cost = xtz_cost * (held - amount) // held, token_cost * (held - amount) // held
+                held -= amount
+            else:
+                held = xtz_cost = token_cost = 0
+            self.positions[trader] = (xtz_in, tokens_in, xtz_out + xtz, tokens_out + tokens, held, xtz_cost, token_cost)
+            if self.lqt[trader] < amount:
+                return CANNOT_BURN
+            self.lqt[trader] -= amount
+            self.lqt_supply -= amount
+            return self._send_tokens("pool", trader, tokens) or self._send_tez("pool", trader, xtz)
+        if call == "default":
+            error = self._send_tez(trader, "pool", amount)
+            if error:
+                return error
+            self.xtz_pool += amount
+            return None
+        if call == "transfer":
+            return self._send_tokens(trader, "pool", amount)
+        if call == "updateTokenPool":
+            self.token_pool = self.tokens["pool"]
+            return None
+        raise ValueError(call)
+
+
+def _log_uniform(rng: random.Random, high: int) -> int:
+    """An integer in [0, high], uniform in magnitude rather than in value."""
+    return min(high, int(2 ** rng.uniform(0, math.log2(high + 1))) - 1)
+
+
+def _near(rng: random.Random, value: int) -> int:
+    """`value` shifted by a slack that mostly keeps it at the boundary."""
+    slack = rng.choice([0, 0, 0, -1, 1, -_log_uniform(rng, max(value, 1))])
+    return max(0, value + slack)
+
+
+def generate(rng: random.Random, build: str, steps: int) -> Case:
+    """A random case of `steps` steps on the `build` dex."""
+    lqt_total = 1 + _log_uniform(rng, 2 ** 64)
+    traders = []
+    remaining = lqt_total
+    for _ in range(rng.randint(1, MAX_TRADERS)):
+        lqt = rng.randint(0, remaining)
+        remaining -= lqt
+        traders.append((_log_uniform(rng, MAX_XTZ // 8), _log_uniform(rng, MAX_TOKENS), lqt))
+    case = Case(build, 1 + _log_uniform(rng, MAX_XTZ), 1 + _log_uniform(rng, MAX_TOKENS), lqt_total, traders, [])
+    model = Model(case)
+    calls, weights = zip(*CALLS.items())
+    for _ in range(steps):
+        call = rng.choices(calls, weights)[0]
+        trader = rng.randrange(len(traders))
+        held = {"xtzToToken": model.tez[trader], "addLiquidity": model.tez[trader], "default": model.tez[trader],
+                "tokenToXtz": model.tokens[trader], "transfer": model.tokens[trader],
+                "removeLiquidity": model.lqt[trader]}.get(call, 0)
+        pool = {"xtzToToken": model.xtz_pool, "addLiquidity": model.xtz_pool, "default": model.xtz_pool,
+                "tokenToXtz": model.token_pool, "transfer": model.token_pool,
+                "removeLiquidity": model.lqt_total}.get(call, 0)
+        scale = rng.choice([held, held, pool, 0])
+        amount = rng.choice([scale, _log_uniform(rng, scale), _log_uniform(rng, scale + 1)])
+        amount = min(amount, MAX_XTZ // 8) if call in ("xtzToToken", "addLiquidity", "default") else amount
+        bounds: Tuple[int, ...] = ()
+        if call == "xtzToToken":
+            bounds = (_near(rng, (model.xtz_to_token(amount) or (0, 0))[0]),)
+        elif call == "tokenToXtz":
+            bounds = (_near(rng, (model.token_to_xtz(amount) or (0, 0, 0))[0]),)
+        elif call == "addLiquidity":
+            minted, deposited = model.add_liquidity(amount) or (0, 0)
+            bounds = (_near(rng, minted), _near(rng, deposited))
+        elif call == "removeLiquidity":
+            bounds = tuple(_near(rng, value) for value in model.remove_liquidity(amount) or (0, 0))
+        step = Step(call, trader, amount, bounds)
+        model.apply(step)
+        case.steps.append(step)
+    return case
+
+
+class Runner:
+    """Runs cases on the `build` dex in a `LocalChain` of its own."""
+
+    def __init__(self, build: str):
+        self.build = build
+        interfaces = default_cache()
+        self.dex = interfaces.from_file(os.path.join(ROOT, f"michelson/dex_{build}.tz"))
+        self.lqt = interfaces.from_file(os.path.join(ROOT, "michelson/lqt_fa12.tz"))
+        token = "tests/FA12.json" if build == "fa12" else "tests/FA2.tz"
+        self.token = interfaces.from_file(os.path.join(ROOT, token))
+        self.pool, self.token_address, self.lqt_address = (get_originated_address(index) for index in range(3))
+        keys = [Key.from_secret_exponent(bytes([index + 1]) * 32) for index in range(MAX_TRADERS + 2)]
+        self.manager, self.reserve, *self.traders = (key.public_key_hash() for key in keys)
+        self.chain = LocalChain()
+        self.empty = self.chain.snapshot()
+        self.decoders: Dict[str, _Decoder] = {}
+
+    # setup -------------------------------------------------------------------
+
+    def install(self, case: Case) -> None:
+        """Resets the chain to the pool, tokens and balances of `case`."""
+        chain = self.chain
+        chain.restore(self.empty)
+        traders = self.traders[:len(case.traders)]
+        for address, (tez, _, _) in zip(traders, case.traders):
+            chain.set_balance(address, tez)
+        chain.set_balance(self.reserve, 0)
+        token_balances = {self.pool: case.token_pool, **{a: tokens for a, (_, tokens, _) in zip(traders, case.traders)}}
+        metadata = {0: {"token_id": 0, "token_info": {}}}
+        if self.build == "fa12":
+            token_storage = {
+                "administrator": self.manager,
+                "balances": {address: {"balance": balance, "approvals": {self.pool: 2 ** 128}}
+                             for address, balance in token_balances.items()},
+                "metadata": {},
+                "paused": False,
+                "token_metadata": metadata,
+                "totalSupply": sum(token_balances.values()),
+            }
+        else:
+            token_storage = {
+                "administrator": self.manager,
+                "all_tokens": 1,
+                "ledger": {(address, 0): balance for address, balance in token_balances.items()},
+                "metadata": {},
+                "operators": {(address, self.pool, 0): None for address in traders},
+                "paused": False,
+                "token_metadata": metadata,
+            }
+        dex_storage = {
+            "tokenPool": case.token_pool,
+            "xtzPool": case.xtz_pool,
+            "lqtTotal": case.lqt_total,
+            "selfIsUpdatingTokenPool": False,
+            "freezeBaker": False,
+            "manager": self.manager,
+            "tokenAddress": self.token_address,
+            "lqtAddress": self.lqt_address,
+            "xtzVolume": 0,
+            "user_investments": {},
+            "reserve": self.reserve,
+            "xtzPriceCumulative": 0,
+            "tokenPriceCumulative": 0,
+            "xtzVolumeCumulative": 0,
+            "lastUpdate": chain.now,
+            "user_positions": {},
+        }
+        if self.build == "fa2":
+            dex_storage["tokenId"] = 0
+        lqt_balances = {self.manager: case.lqt_total - sum(lqt for _, _, lqt in case.traders)}
+        lqt_balances.update({address: lqt for address, (_, _, lqt) in zip(traders, case.traders)})
+        lqt_storage = {
+            "tokens": lqt_balances,
+            "allowances": {},
+            "admin": self.pool,
+            "total_supply": case.lqt_total,
+            "metadata": {},
+            "token_metadata": {},
+        }
+        chain.install(self.token_address, self.token.script(initial_storage=token_storage))
+        chain.install(self.pool, self.dex.script(initial_storage=dex_storage), case.xtz_pool)
+        chain.install(self.lqt_address, self.lqt.script(initial_storage=lqt_storage))
+
+    # steps -------------------------------------------------------------------
+
+    def _transaction(self, interface: ContractInterface, destination: str, entrypoint: str, arg,
+                     amount: int = 0) -> dict:
+        call = getattr(interface, entrypoint)
+        parameters = (call() if arg is None else call(arg)).parameters
+        return {"kind": "transaction", "destination": destination, "amount": str(amount), "parameters": parameters}
+
+    def transaction(self, step: Step) -> dict:
+        trader = self.traders[step.trader]
+        deadline = "2099-01-01T00:00:00Z"
+        if step.call == "xtzToToken":
+            arg = {"to": trader, "minTokensBought": step.bounds[0], "deadline": deadline}
+            return self._transaction(self.dex, self.pool, step.call, arg, step.amount)
+        if step.call == "tokenToXtz":
+            arg = {"to": trader, "tokensSold": step.amount, "minXtzBought": step.bounds[0], "deadline": deadline}
+            return self._transaction(self.dex, self.pool, step.call, arg)
+        if step.call == "addLiquidity":
+            arg = {"owner": trader, "minLqtMinted": step.bounds[0], "maxTokensDeposited": step.bounds[1],
+                   "deadline": deadline}
+            return self._transaction(self.dex, self.pool, step.call, arg, step.amount)
+        if step.call == "removeLiquidity":
+            arg = {"to": trader, "lqtBurned": step.amount, "minXtzWithdrawn": step.bounds[0],
+                   "minTokensWithdrawn": step.bounds[1], "deadline": deadline}
+            return self._transaction(self.dex, self.pool, step.call, arg)
+        if step.call == "default":
+            return self._transaction(self.dex, self.pool, "default", None, step.amount)
+        if step.call == "updateTokenPool":
+            return self._transaction(self.dex, self.pool, step.call, None)
+        if step.call == "transfer":
+            if self.build == "fa12":
+                arg = {"from": trader, "to": self.pool, "value": step.amount}
+            else:
+                arg = [{"from_": trader, "txs": [{"to_": self.pool, "token_id": 0, "amount": step.amount}]}]
+            return self._transaction(self.token, self.token_address, "transfer", arg)
+        raise ValueError(step.call)
+
+    def apply(self, step: Step) -> Optional[str]:
+        try:
+            self.chain.inject(self.traders[step.trader], [self.transaction(step)])
+        except RpcError as e:
+            return failure_code(e.args[0] if e.args else None)
+        return None
+
+    def _storage(self, address: str) -> dict:
+        if address not in self.decoders:
+            self.decoders[address] = _Decoder(self.chain.code(address))
+        return self.decoders[address].storage(self.chain.storage(address))
+
+    def _entries(self, address: str, storage: dict, name: str, keys: list) -> list:
+        """The values of `keys` in the big_map `name` of `address`, None
+        without an entry."""
+        key_type, value_type = self.decoders[address].big_map_types[name]
+        values = []
+        for key in keys:
+            key_hash = forge_script_expr(key_type.from_python_object(key).pack(legacy=True))
+            value = self.chain.big_map_value(storage[name], key_hash)
+            values.append(None if value is None else value_type.from_micheline_value(value).to_python_object())
+        return values
+
+    def state(self, traders: int) -> State:
+        addresses = self.traders[:traders]
+        holders = [self.pool, *addresses]
+        token = self._storage(self.token_address)
+        if self.build == "fa12":
+            tokens = [entry["balance"] for entry in self._entries(self.token_address, token, "balances", holders)]
+        else:
+            tokens = self._entries(self.token_address, token, "ledger", [(holder, 0) for holder in holders])
+        pool = self._storage(self.pool)
+        lqt = self._storage(self.lqt_address)
+        return State(
+            xtz_pool=pool["xtzPool"],
+            token_pool=pool["tokenPool"],
+            lqt_total=pool["lqtTotal"],
+            xtz_volume=pool["xtzVolume"],
+            xtz_price_cumulative=pool["xtzPriceCumulative"],
+            token_price_cumulative=pool["tokenPriceCumulative"],
+            xtz_volume_cumulative=pool["xtzVolumeCumulative"],
+            self_is_updating_token_pool=pool["selfIsUpdatingTokenPool"],
+            investments=tuple(None if entry is None else
+                              (entry["xtz"], entry["token"], INVESTMENT_DIRECTIONS[entry["direction"]])
+                              for entry in self._entries(self.pool, pool, "user_investments", addresses)),
+            positions=tuple(NO_POSITION if entry is None else tuple(entry[field] for field in POSITION_FIELDS)
+                            for entry in self._entries(self.pool, pool, "user_positions", addresses)),
+            tez=tuple(self.chain.balance(address) for address in (self.pool, self.reserve, *addresses)),
+            tokens=tuple(balance or 0 for balance in tokens),
+            lqt=tuple(balance or 0 for balance in self._entries(self.lqt_address, lqt, "tokens", addresses)),
+            lqt_supply=lqt["total_supply"],
+        )
+
+    # cases -------------------------------------------------------------------
+
+    def run(self, case: Case, model=Model) -> Optional[Mismatch]:
+        """The first step after which the contract and `model` differ."""
+        self.install(case)
+        reference = model(case)
+        traders = len(case.traders)
+        for index, step in enumerate(case.steps):
+            expected_error = reference.apply(step)
+            error = self.apply(step)
+            expected, actual = reference.state(traders), self.state(traders)
+            if error != expected_error or expected != actual:
+                fields = {name: (left, right) for name, left, right in zip(State._fields, expected, actual)
+                          if left != right}
+                return Mismatch(index, expected_error, error, fields)
+        return None
+
+    def shrink(self, case: Case, mismatch: Mismatch, model=Model, budget: int = 500) -> Tuple[Case, Mismatch]:
+        """A smaller case that still mismatches: steps after the mismatch are
+        dropped, then single earlier steps, then amounts, bounds and pool
+        sizes are lowered, while the case keeps failing."""
+        case = case._replace(steps=case.steps[:mismatch.step + 1])
+
+        def attempt(candidate: Case) -> bool:
+            nonlocal case, mismatch, budget
+            if budget <= 0:
+                return False
+            budget -= 1
+            found = self.run(candidate, model)
+            if found is None:
+                return False
+            case, mismatch = candidate._replace(steps=candidate.steps[:found.step + 1]), found
+            return True
+
+        progress = True
+        while progress and budget > 0:
+            progress = False
+            for index in reversed(range(len(case.steps) - 1)):
+                if index < len(case.steps) - 1:
+                    progress |= attempt(case._replace(steps=case.steps[:index] + case.steps[index + 1:]))
+            for index in range(len(case.steps)):
+                step = case.steps[index]
+                for smaller in _smaller(step.amount):
+                    if attempt(case._replace(steps=[*case.steps[:index], step._replace(amount=smaller),
+                                                    *case.steps[index + 1:]])):
+                        progress = True
+                        break
+                step = case.steps[index]
+                for position, bound in enumerate(step.bounds):
+                    for smaller in _smaller(bound):
+                        bounds = step.bounds[:position] + (smaller,) + step.bounds[position + 1:]
+                        if attempt(case._replace(steps=[*case.steps[:index], step._replace(bounds=bounds),
+                                                        *case.steps[index + 1:]])):
+                            progress = True
+                            step = case.steps[index]
+                            break
+            for name in ("xtz_pool", "token_pool"):
+                for smaller in _smaller(getattr(case, name)):
+                    if smaller and attempt(case._replace(**{name: smaller})):
+                        progress = True
+                        break
+        return case, mismatch
+
+
+def _smaller(value: int) -> List[int]:
+    """Candidates below `value`, simplest first."""
+    return [candidate for candidate in dict.fromkeys([0, 1, value // 2, value - 1]) if 0 <= candidate < value]
+
+
+class FuzzReport(NamedTuple):
+    cases: int
+    steps: int
+    elapsed: float
+    failures: List[Failure]
+
+    @property
+    def steps_per_hour(self) -> float:
+        return self.steps * 3600 / self.elapsed if self.elapsed else 0.0
+
+
+_runners: Dict[str, Runner] = {}
+
+
+def _runner(build: str) -> Runner:
+    if build not in _runners:
+        _runners[build] = Runner(build)
+    return _runners[build]
+
+
+def run_seeds(build: str, seeds: List[int], steps: int, shrink: bool = True) -> Tuple[int, List[Failure]]:
+    """Runs the cases generated from `seeds` and returns the steps run and
+    the failures, shrunk. The unit of work of `fuzz`."""
+    runner = _runner(build)
+    done, failures = 0, []
+    for seed in seeds:
+        case = generate(random.Random(seed), build, steps)
+        mismatch = runner.run(case)
+        if mismatch is None:
+            done += len(case.steps)
+            continue
+        done += mismatch.step + 1
+        if shrink:
+            case, mismatch = runner.shrink(case, mismatch)
+        failures.append(Failure(case, mismatch))
+    return done, failures
+
+
+def fuzz(cases: int, steps: int = 50, builds=BUILDS, workers: Optional[int] = None, seed: int = 0,
+         chunk: int = 16, shrink: bool = True) -> FuzzReport:
+    """Runs `cases` random cases of `steps` steps per build on `workers`
+    processes (one per CPU by default)."""
+    start = time.monotonic()
+    total, failures = 0, []
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(run_seeds, build, list(range(seed + first, seed + min(first + chunk, cases))), steps, shrink)
+            for build in builds
+            for first in range(0, cases, chunk)
+        ]
+        for future in futures:
+            done, found = future.result()
+            total += done
+            failures += found
+    return FuzzReport(cases * len(builds), total, time.monotonic() - start, failures)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Differential fuzzing of the dex against a reference model.")
+    parser.add_argument("--cases", type=int, default=1000, help="cases per build")
+    parser.add_argument("--steps", type=int, default=50, help="steps per case")
+    parser.add_argument("--build", action="append", choices=BUILDS, help="builds to run, all by default")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", help="run the case saved in this file and print the mismatch")
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay) as f:
+            case = Case.from_json(json.load(f))
+        print(Runner(case.build).run(case))
+    else:
+        report = fuzz(args.cases, args.steps, args.build or BUILDS, args.workers, args.seed)
+        print(f"{report.cases} cases, {report.steps} steps in {report.elapsed:.0f}s "
+              f"({report.steps_per_hour:,.0f} steps per hour)")
+        for failure in report.failures:
+            print(failure.mismatch)
+            print(json.dumps(failure.case.to_json()))
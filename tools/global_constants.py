@@ -0,0 +1,36 @@
+"""Global constants: expressions registered once per chain with a
+`register_global_constant` operation and referenced from scripts as
+`constant "<expr hash>"`.
+
+The protocol expands the constants of a script when it reads it.
+`LocalChain` registers and expands them the same way, and
+`tools/interfaces.py` expands those of node scripts before parsing them.
+`load` reads a Michelson file as Micheline.
+"""
+
+from typing import Dict, List
+
+from pytezos.michelson.forge import forge_micheline, forge_script_expr
+from pytezos.michelson.parse import michelson_to_micheline
+
+
+def constant_hash(expr) -> str:
+    """The `expr...` hash under which the protocol registers `expr`."""
+    return forge_script_expr(forge_micheline(expr))
+
+
+def load(path: str) -> List[dict]:
+    with open(path) as f:
+        return michelson_to_micheline(f.read())
+
+
+def expand(expr, constants: Dict[str, dict]):
+    """`expr` with every constant replaced by its expression, recursively."""
+    if isinstance(expr, list):
+        return [expand(item, constants) for item in expr]
+    if not isinstance(expr, dict) or "args" not in expr:
+        return expr
+    if expr.get("prim") == "constant":
+        return expand(constants[expr["args"][0]["string"]], constants)
+    return {**expr, "args": [expand(arg, constants) for arg in expr["args"]]}
+
@@ -0,0 +1,22 @@
+"""Compatibility view of the `history` big_map of the first dex contracts.
+
+Dex storage used to hold `history : (string, nat) big_map` with the pools
+under "tokenPool" and "xtzPool" and the tez traded by the last swap under
+"xtzVolume". The pools were always copies of the `tokenPool` and `xtzPool`
+fields and the volume is now the `xtzVolume` field, so the `getHistory` view
+of the dex (and its TZIP-16 twin, tools/views.py) returns the same three
+entries as a map, which contracts and off-chain readers of the old layout
+can switch to. `history` reads either layout.
+"""
+
+from typing import Dict
+
+
+HISTORY_KEYS = ("tokenPool", "xtzPool", "xtzVolume")
+
+
+def history(swap) -> Dict[str, int]:
+    """The `history` entries of the dex contract `swap`, in nat (mutez for tez)."""
+    if "history" in swap.storage():
+        return {key: int(swap.storage["history"][key]()) for key in HISTORY_KEYS}
+    return {key: int(value) for key, value in swap.getHistory().run_view().items()}
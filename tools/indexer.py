@@ -0,0 +1,433 @@
+"""Streaming indexer of the pools launched by a dex factory.
+
+`Indexer` follows the blocks of a node (`NodeSource`) or of an in-process
+`LocalChain`, discovers the pools from the factory's `swaps` and `counter`
+and decodes every applied pool call (trades, liquidity, deposits and token
+pool updates) together with its big_map diffs into one row per call; the
+legs a pool forwards to other pools are internal calls, so each of them is a
+row of its own pool:
+
+    level, timestamp   block of the call
+    pool               index of the pool in the factory's `swaps`
+    entrypoint         index in ENTRYPOINTS ("launchExchange" for the origination);
+                       new entrypoints are appended, so stored indices stay valid
+    sender             index in `ColumnStore.addresses`
+    amount             mutez sent with the call
+    xtz_pool, token_pool, lqt_total, xtz_volume
+                       pool storage after the call
+    investment         +1 / -1 when the call added / removed a `user_investments` entry, else 0
+    investment_xtz, investment_token
+                       the tez and tokens of that entry
+
+Rows go to a `ColumnStore`: a directory with one little-endian file per
+column, `addresses.json` and `pools.json` string tables and `meta.json`,
+which records the last indexed level and the row count. The meta file is
+replaced after the columns are appended, so a crashed run resumes from the
+last complete level and `ColumnStore.read` answers level range queries with
+a binary search over the sorted `level` column instead of a node poll:
+
+    store = ColumnStore("pools")
+    Indexer(NodeSource(pytezos.shell), factory, store).follow()
+    rows = store.read(["timestamp", "xtz_pool", "token_pool"], start_level=1000, pools=[0])
+
+Token amounts are `nat`s, so they are stored as 128-bit words and read back
+as uint64 arrays, or as arrays of Python integers when some value does not
+fit in 64 bits; `tools.quote` accepts either.
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from pytezos.michelson.forge import forge_script_expr
+from pytezos.michelson.types import AddressType, MichelsonType, NatType
+from pytezos.rpc.node import RpcError
+
+
+ENTRYPOINTS = (
+    "launchExchange",
+    "xtzToToken",
+    "tokenToXtz",
+    "tokenToToken",
+    "addLiquidity",
+    "removeLiquidity",
+    "default",
+    "updateTokenPoolInternal",
+    "xtzToTokenRoute",
+    "batchSwap",
+    "updateTokenPool",
+)
+
+NAT = np.dtype([("lo", "<u8"), ("hi", "<u8")])
+COLUMNS = {
+    "level": np.dtype("<i8"),
+    "timestamp": np.dtype("<i8"),
+    "pool": np.dtype("<i4"),
+    "entrypoint": np.dtype("u1"),
+    "sender": np.dtype("<i4"),
+    "amount": np.dtype("<i8"),
+    "xtz_pool": np.dtype("<i8"),
+    "token_pool": NAT,
+    "lqt_total": NAT,
+    "xtz_volume": np.dtype("<i8"),
+    "investment": np.dtype("i1"),
+    "investment_xtz": np.dtype("<i8"),
+    "investment_token": NAT,
+}
+INVESTMENT_DIRECTIONS = {"aDD": 1, "rEMOVE": -1}
+
+
+def _to_nat(values: List[int]) -> np.ndarray:
+    array = np.zeros(len(values), dtype=NAT)
+    for i, value in enumerate(values):
+        if not 0 <= value < 1 << 128:
+            raise OverflowError(f"{value} does not fit in 128 bits")
+        array[i] = (value & (1 << 64) - 1, value >> 64)
+    return array
+
+
+def _from_nat(array: np.ndarray) -> np.ndarray:
+    if not array["hi"].any():
+        return array["lo"].copy()
+    return np.array([int(hi) << 64 | int(lo) for lo, hi in array.tolist()], dtype=object)
+
+
+def _timestamp(value: str) -> int:
+    return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+
+
+class ColumnStore:
+    """Append-only columnar store of indexed pool calls, in `path`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.meta = self._load("meta.json", {"factory": None, "level": None, "rows": 0})
+        self.addresses: List[str] = self._load("addresses.json", [])
+        self.pools: Dict[int, str] = {int(i): address for i, address in self._load("pools.json", {}).items()}
+        self._address_index = {address: i for i, address in enumerate(self.addresses)}
+        # drop rows appended after the last complete level
+        for name, dtype in COLUMNS.items():
+            column = self._column_path(name)
+            if not os.path.exists(column):
+                open(column, "wb").close()
+            size = self.rows * dtype.itemsize
+            if os.path.getsize(column) != size:
+                os.truncate(column, size)
+
+    @property
+    def rows(self) -> int:
+        return self.meta["rows"]
+
+    @property
+    def level(self) -> Optional[int]:
+        """Last level whose calls are all in the store."""
+        return self.meta["level"]
+
+    def address_index(self, address: str) -> int:
+        if address not in self._address_index:
+            self._address_index[address] = len(self.addresses)
+            self.addresses.append(address)
+        return self._address_index[address]
+
+    def append(self, rows: Dict[str, list], level: int) -> None:
+        """Appends `rows` (column name -> values) and marks `level` as indexed."""
+        count = len(rows["level"])
+        for name, dtype in COLUMNS.items():
+            values = _to_nat(rows[name]) if dtype == NAT else np.asarray(rows[name], dtype=dtype)
+            assert len(values) == count, name
+            with open(self._column_path(name), "ab") as f:
+                f.write(values.tobytes())
+        self._save("addresses.json", self.addresses)
+        self._save("pools.json", {str(i): address for i, address in sorted(self.pools.items())})
+        self.meta = {**self.meta, "level": level, "rows": self.rows + count}
+        self._save("meta.json", self.meta)
+
+    def read(self, columns: Optional[Iterable[str]] = None, start_level: Optional[int] = None,
+             end_level: Optional[int] = None, pools: Optional[Iterable[int]] = None) -> Dict[str, np.ndarray]:
+        """Columns of the rows with start_level <= level <= end_level, optionally
+        of some pools only."""
+        columns = list(columns or COLUMNS)
+        levels = self._memmap("level")
+        start = 0 if start_level is None else int(np.searchsorted(levels, start_level, side="left"))
+        end = self.rows if end_level is None else int(np.searchsorted(levels, end_level, side="right"))
+        mask = None
+        if pools is not None:
+            mask = np.isin(self._memmap("pool")[start:end], list(pools))
+        result = {}
+        for name in columns:
+            values = np.array(self._memmap(name)[start:end])
+            if mask is not None:
+                values = values[mask]
+            result[name] = _from_nat(values) if COLUMNS[name] == NAT else values
+        return result
+
+    def _memmap(self, name: str) -> np.ndarray:
+        if self.rows == 0:
+            return np.zeros(0, dtype=COLUMNS[name])
+        return np.memmap(self._column_path(name), dtype=COLUMNS[name], mode="r", shape=(self.rows,))
+
+    def _column_path(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.bin")
+
+    def _load(self, name: str, default):
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            return default
+        with open(path) as f:
+            return json.load(f)
+
+    def _save(self, name: str, value) -> None:
+        path = os.path.join(self.path, name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(value, f)
+        os.replace(path + ".tmp", path)
+
+
+class NodeSource:
+    """Blocks and the state at `block` (the head by default) read from a
+    node through a pytezos `ShellQuery`."""
+
+    def __init__(self, shell, block="head"):
+        self.shell = shell
+        self.block_id = block
+
+    def at(self, block) -> "NodeSource":
+        """The same node with its state read at `block`, a level or a hash."""
+        return NodeSource(self.shell, block)
+
+    def head_level(self) -> int:
+        return int(self.shell.head.header()["level"])
+
+    def header(self) -> dict:
+        return self.shell.blocks[self.block_id].header()
+
+    def block(self, level: int) -> dict:
+        return self.shell.blocks[level]()
+
+    def contract(self, address: str) -> dict:
+        """Balance, code and storage of `address` in one request."""
+        return self.shell.blocks[self.block_id].context.contracts[address]()
+
+    def storage(self, address: str):
+        return self.shell.blocks[self.block_id].context.contracts[address].storage()
+
+    def code(self, address: str) -> List[dict]:
+        return self.shell.blocks[self.block_id].context.contracts[address].script()["code"]
+
+    def balance(self, address: str) -> int:
+        return int(self.shell.blocks[self.block_id].context.contracts[address].balance())
+
+    def big_map_value(self, ptr: int, key_hash: str):
+        try:
+            return self.shell.blocks[self.block_id].context.big_maps[ptr][key_hash]()
+        except RpcError:
+            return None
+
+
+class _Decoder:
+    """Storage and `user_investments` decoding of one contract code."""
+
+    def __init__(self, code: List[dict]):
+        # only the storage type: the code of a node script may hold global constants
+        storage_type = next(expr for expr in code if expr["prim"] == "storage")["args"][0]
+        self.storage_type = MichelsonType.match(storage_type)
+        self.big_map_types = {
+            annot[1:]: (MichelsonType.match(expr["args"][0]), MichelsonType.match(expr["args"][1]))
+            for expr, annot in self._fields(storage_type)
+            if expr["prim"] == "big_map"
+        }
+
+    @classmethod
+    def _fields(cls, expr):
+        if expr["prim"] == "pair" and not expr.get("annots"):
+            for arg in expr["args"]:
+                yield from cls._fields(arg)
+        else:
+            yield expr, next(iter(expr.get("annots", [])), "%")
+
+    def storage(self, value) -> dict:
+        return self.storage_type.from_micheline_value(value).to_python_object()
+
+    def updates(self, lazy_diff: List[dict], storage: dict, name: str):
+        """Decoded (key, value) updates of the big_map field `name`."""
+        key_type, value_type = self.big_map_types[name]
+        for item in lazy_diff or []:
+            if item["kind"] != "big_map" or int(item["id"]) != storage[name]:
+                continue
+            for update in item["diff"].get("updates", []):
+                value = update.get("value")
+                yield (key_type.from_micheline_value(update["key"]).to_python_object(),
+                       None if value is None else value_type.from_micheline_value(value).to_python_object())
+
+
+def read_storage(source, address: str) -> dict:
+    """Head storage of `address` as Python objects (big_maps as their ids)."""
+    return _Decoder(source.code(address)).storage(source.storage(address))
+
+
+def factory_pools(source, factory: str, start: int = 0) -> List[str]:
+    """The pools `swaps[start .. counter - 1]` of `factory` at the head of `source`."""
+    storage = read_storage(source, factory)
+    addresses = []
+    for index in range(start, storage["counter"]):
+        key_hash = forge_script_expr(NatType.from_value(index).pack(legacy=True))
+        address = source.big_map_value(storage["swaps"], key_hash)
+        addresses.append(AddressType.from_micheline_value(address).to_python_object())
+    return addresses
+
+
+class Indexer:
+    """Indexes the calls to the pools of `factory` from `source` into `store`.
+
+    `source` is a `NodeSource` or a `LocalChain`. A new store starts at
+    `start_level` with the pools the factory has at the head; later pools are
+    found in the `swaps` updates of the factory calls. Levels newer than
+    `head - confirmations` are left for the next `sync`. Pools that keep a
+    `history` big_map instead of `xtzVolume` raise a ValueError."""
+
+    def __init__(self, source, factory: str, store: ColumnStore, start_level: int = 1, confirmations: int = 0):
+        if store.meta["factory"] not in (None, factory):
+            raise ValueError(f"{store.path} indexes the pools of {store.meta['factory']}")
+        self.source = source
+        self.factory = factory
+        self.store = store
+        self.start_level = start_level
+        self.confirmations = confirmations
+        self._decoders: Dict[str, _Decoder] = {}  # by address
+        self._pool_index = {address: i for i, address in store.pools.items()}
+        store.meta["factory"] = factory
+        if store.level is None:
+            self._register_pools()
+
+    def sync(self, batch: int = 100) -> int:
+        """Indexes every new level; returns the number of rows added."""
+        head = self.source.head_level() - self.confirmations
+        level = self.start_level if self.store.level is None else self.store.level + 1
+        added = 0
+        rows = {name: [] for name in COLUMNS}
+        while level <= head:
+            self._index_block(self.source.block(level), rows)
+            if level == head or level % batch == 0:
+                added += len(rows["level"])
+                self.store.append(rows, level)
+                rows = {name: [] for name in COLUMNS}
+            level += 1
+        return added
+
+    def follow(self, interval: float = 5.0) -> None:
+        """Syncs forever, every `interval` seconds."""
+        while True:
+            self.sync()
+            time.sleep(interval)
+
+    # pools -------------------------------------------------------------------
+
+    def _decoder(self, address: str, code: Optional[List[dict]] = None) -> _Decoder:
+        if address not in self._decoders:
+            self._decoders[address] = _Decoder(code or self.source.code(address))
+        return self._decoders[address]
+
+    def _add_pool(self, index: int, address: str) -> None:
+        self.store.pools[index] = address
+        self._pool_index[address] = index
+
+    def _register_pools(self) -> None:
+        try:
+            addresses = factory_pools(self.source, self.factory)
+        except (KeyError, RpcError):
+            return  # not originated yet
+        for index, address in enumerate(addresses):
+            self._add_pool(index, address)
+
+    # blocks ------------------------------------------------------------------
+
+    def _index_block(self, block: dict, rows: Dict[str, list]) -> None:
+        level, timestamp = int(block["header"]["level"]), _timestamp(block["header"]["timestamp"])
+        for group in block["operations"][-1]:
+            for content in group["contents"]:
+                metadata = content.get("metadata", {})
+                if "operation_result" not in metadata:
+                    continue
+                origin = content["source"]
+                self._index_result(content, metadata["operation_result"], origin, level, timestamp, rows)
+                for internal in metadata.get("internal_operation_results", []):
+                    self._index_result(internal, internal["result"], origin, level, timestamp, rows)
+
+    def _index_result(self, op: dict, result: dict, origin: str, level: int, timestamp: int,
+                      rows: Dict[str, list]) -> None:
+        if result.get("status") != "applied":
+            return
+        if op["kind"] == "transaction" and op["destination"] == self.factory:
+            decoder = self._decoder(self.factory)
+            storage = decoder.storage(result["storage"])
+            for index, address in decoder.updates(result.get("lazy_storage_diff"), storage, "swaps"):
+                if address is not None:
+                    self._add_pool(index, address)
+        elif op["kind"] == "origination":
+            for address in result.get("originated_contracts", []):
+                if address in self._pool_index:
+                    storage = self._decoder(address, op["script"]["code"]).storage(op["script"]["storage"])
+                    row = self._row(address, "launchExchange", origin, int(op.get("balance", 0)), storage, level, timestamp)
+                    row.update(investment=1, investment_xtz=storage["xtzPool"], investment_token=storage["tokenPool"])
+                    self._append(rows, row)
+        elif op["kind"] == "transaction" and op["destination"] in self._pool_index:
+            entrypoint = op.get("parameters", {}).get("entrypoint", "default")
+            if entrypoint not in ENTRYPOINTS:
+                return
+            decoder = self._decoder(op["destination"])
+            storage = decoder.storage(result["storage"])
+            row = self._row(op["destination"], entrypoint, op["source"], int(op.get("amount", 0)), storage, level, timestamp)
+            for _, investment in decoder.updates(result.get("lazy_storage_diff"), storage, "user_investments"):
+                if investment is not None:
+                    row.update(investment=INVESTMENT_DIRECTIONS[investment["direction"]],
+                               investment_xtz=investment["xtz"], investment_token=investment["token"])
+            self._append(rows, row)
+
+    def _row(self, pool: str, entrypoint: str, sender: str, amount: int, storage: dict,
+             level: int, timestamp: int) -> dict:
+        if "xtzVolume" not in storage:
+            raise ValueError(f"pool {pool} keeps its volume in a history big_map; "
+                             f"only factories launching pools with xtzVolume can be indexed")
+        return {
+            "level": level,
+            "timestamp": timestamp,
+            "pool": self._pool_index[pool],
+            "entrypoint": ENTRYPOINTS.index(entrypoint),
+            "sender": self.store.address_index(sender),
+            "amount": amount,
+            "xtz_pool": storage["xtzPool"],
+            "token_pool": storage["tokenPool"],
+            "lqt_total": storage["lqtTotal"],
+            "xtz_volume": storage["xtzVolume"],
+            "investment": 0,
+            "investment_xtz": 0,
+            "investment_token": 0,
+        }
+
+    @staticmethod
+    def _append(rows: Dict[str, list], row: dict) -> None:
+        for name, value in row.items():
+            rows[name].append(value)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from pytezos import pytezos
+
+    parser = argparse.ArgumentParser(description="Index the pools of a dex factory into a column store.")
+    parser.add_argument("store", help="store directory, resumed when it exists")
+    parser.add_argument("--factory", required=True)
+    parser.add_argument("--shell", default="http://localhost:8732")
+    parser.add_argument("--start-level", type=int, default=1)
+    parser.add_argument("--confirmations", type=int, default=0)
+    parser.add_argument("--interval", type=float, default=5.0)
+    args = parser.parse_args()
+
+    indexer = Indexer(NodeSource(pytezos.using(shell=args.shell).shell), args.factory, ColumnStore(args.store),
+                      start_level=args.start_level, confirmations=args.confirmations)
+    indexer.follow(args.interval)
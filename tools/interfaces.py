@@ -0,0 +1,260 @@
+"""Contract interfaces cached by code hash.
+
+`pytezos.contract(address)` downloads the script of `address` and matches
+its code into Michelson types, and `ContractInterface.from_michelson`
+parses the source text first: about a quarter of a second for a factory,
+paid again by every test setup, every pool of a router and every trader
+of a load test. A contract's code never changes and its address is derived
+from the hash of the operation that originated it, so an address always
+names the same code. `InterfaceCache` keeps:
+
+- the Micheline code of every contract it saw, with its entrypoint types
+  and the code hashes of the contracts it originates (`CREATE_CONTRACT`),
+  in `<directory>/<code hash>.json`;
+- the code hash of every address it resolved, in `<directory>/addresses`,
+  and of every source file or text it parsed, in `<directory>/sources`
+  (append-only, one `<name> <code hash>` line each, so concurrent
+  processes can share a directory);
+- the matched `MichelsonProgram` of every code hash, in memory.
+
+A known address is bound without fetching its script and a known code
+without parsing or matching it again, which leaves building the entrypoint
+proxies, a few milliseconds:
+
+    interfaces = InterfaceCache()
+    factory = interfaces.contract(pytezos, factory_address)
+    dex = interfaces.spawned(factory_address, "xtzToToken")
+    pools = [interfaces.contract(pytezos, pool, key=dex) for pool in pool_addresses]
+
+The pools and liquidity tokens a factory launches run the code of its
+`CREATE_CONTRACT`s, so `key=` binds them before the first fetch. Nothing
+checks such a binding against the node, so it is kept in memory and never
+written to the `addresses` index. Code that
+references global constants is expanded with the constants of the node
+(cached by their hash, which is the hash of their value) before it is
+matched, as the protocol does; the code hash is that of the code as stored.
+
+The directory is `DEX_INTERFACE_CACHE`, `~/.cache/dex/interfaces` by
+default; `InterfaceCache(None)` keeps everything in memory. A
+`LocalClient` is returned its own contracts: the in-process chain already
+caches interfaces by code hash (tools/local_chain.py).
+"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Iterator, List, Optional
+
+from pytezos import ContractInterface
+from pytezos.context.impl import ExecutionContext
+from pytezos.michelson.parse import michelson_to_micheline
+from pytezos.michelson.program import MichelsonProgram
+
+from tools.global_constants import expand
+from tools.local_chain import LocalClient, code_hash
+
+DEFAULT_DIRECTORY = os.environ.get(
+    "DEX_INTERFACE_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "dex", "interfaces"))
+
+
+def _digest(source: bytes) -> str:
+    return hashlib.sha256(source).hexdigest()
+
+
+def _created(expr) -> Iterator[List[dict]]:
+    """The scripts of the `CREATE_CONTRACT`s of `expr`, in code order."""
+    if isinstance(expr, list):
+        for item in expr:
+            yield from _created(item)
+    elif isinstance(expr, dict) and "args" in expr:
+        if expr.get("prim") == "CREATE_CONTRACT":
+            yield expr["args"][0]
+        else:
+            for arg in expr["args"]:
+                yield from _created(arg)
+
+
+def _constants(expr) -> Iterator[str]:
+    """The hashes of the global constants `expr` references."""
+    if isinstance(expr, list):
+        for item in expr:
+            yield from _constants(item)
+    elif isinstance(expr, dict) and "args" in expr:
+        if expr.get("prim") == "constant":
+            yield expr["args"][0]["string"]
+        else:
+            for arg in expr["args"]:
+                yield from _constants(arg)
+
+
+class InterfaceCache:
+    def __init__(self, directory: Optional[str] = DEFAULT_DIRECTORY):
+        self.directory = directory
+        self.entries: Dict[str, dict] = {}  # code hash -> {"code", "entrypoints", "spawns"}
+        self.programs: Dict[str, type] = {}  # code hash -> matched MichelsonProgram
+        self.addresses: Dict[str, str] = {}  # address -> code hash
+        self.sources: Dict[str, str] = {}  # sha256 of a source -> code hash
+        self.codes: Dict[str, List[dict]] = {}  # code hash -> code with its constants expanded
+        self.constants: Dict[str, dict] = {}  # global constant hash -> expression
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.addresses.update(self._read_index("addresses"))
+            self.sources.update(self._read_index("sources"))
+
+    # storage -----------------------------------------------------------------
+
+    def _read_index(self, name: str) -> Dict[str, str]:
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            # a line cut short by a crash has no hash
+            return dict(line.split() for line in f if len(line.split()) == 2)
+
+    def _append_index(self, name: str, key: str, value: str) -> None:
+        if self.directory:
+            # one short write in append mode, whole even with other writers
+            with open(os.path.join(self.directory, name), "a") as f:
+                f.write(f"{key} {value}\n")
+
+    def _write_entry(self, key: str, entry: dict) -> None:
+        path = os.path.join(self.directory, f"{key}.json")
+        if os.path.exists(path):
+            return
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+
+    def entry(self, key: str) -> Optional[dict]:
+        """The stored code, entrypoint types and spawned code hashes of the
+        code hash `key`, or None for an unknown code."""
+        if key not in self.entries and self.directory:
+            path = os.path.join(self.directory, f"{key}.json")
+            if os.path.exists(path):
+                with open(path) as f:
+                    self.entries[key] = json.load(f)
+        return self.entries.get(key)
+
+    # code --------------------------------------------------------------------
+
+    def add(self, code: List[dict], shell=None) -> str:
+        """Stores `code` and the contracts it originates, expanding its global
+        constants with those of `shell`; returns its code hash."""
+        key = code_hash(code)
+        if self.entry(key) is None:
+            expanded = self._expand(key, code, shell)
+            program = self.program(key)
+            entry = {
+                "code": code,
+                "entrypoints": {
+                    name: ty.as_micheline_expr() for name, ty in program.parameter.list_entrypoints().items()
+                },
+                "spawns": [self.add(script) for script in _created(expanded)],
+            }
+            with self._lock:
+                self.entries[key] = entry
+                if self.directory:
+                    self._write_entry(key, entry)
+        return key
+
+    def _expand(self, key: str, code: List[dict], shell=None) -> List[dict]:
+        if key not in self.codes:
+            for constant in set(_constants(code)) - set(self.constants):
+                if shell is None:
+                    raise KeyError(f"Constant {constant} is not known")
+                self.constants[constant] = shell.head.context.raw.json.global_constant[constant]()
+            self.codes[key] = expand(code, self.constants) if any(_constants(code)) else code
+        return self.codes[key]
+
+    def code(self, key: str, shell=None) -> List[dict]:
+        """The code of the code hash `key`, with its global constants expanded."""
+        return self._expand(key, self.entry(key)["code"], shell)
+
+    def program(self, key: str):
+        """The matched `MichelsonProgram` of the code hash `key`."""
+        if key not in self.programs:
+            # `add` matches the code before storing it
+            self.programs[key] = MichelsonProgram.match(self.codes[key] if key in self.codes else self.code(key))
+        return self.programs[key]
+
+    def entrypoints(self, key: str) -> Dict[str, dict]:
+        """The parameter type of each entrypoint of the code hash `key`."""
+        return self.entry(key)["entrypoints"]
+
+    def spawned(self, address: str, entrypoint: str) -> Optional[str]:
+        """The code hash of the contract with `entrypoint` that the contract
+        at `address` originates, if it is known to originate one."""
+        key = self.addresses.get(address)
+        entry = key and self.entry(key)
+        for child in entry["spawns"] if entry else []:
+            if entrypoint in self.entrypoints(child):
+                return child
+        return None
+
+    def bind(self, address: str, key: str, persist: bool = True) -> None:
+        """Records that the contract at `address` runs the code hash `key`, in
+        the `addresses` index too unless `persist` is False."""
+        if self.addresses.get(address) != key:
+            with self._lock:
+                self.addresses[address] = key
+                if persist:
+                    self._append_index("addresses", address, key)
+
+    # interfaces --------------------------------------------------------------
+
+    def interface(self, key: str, client=None, address: Optional[str] = None) -> ContractInterface:
+        """A `ContractInterface` of the code hash `key`, bound to `address`
+        through `client` when given."""
+        script = {"code": self.code(key, client and client.shell)}
+        context = client._spawn_context(address=address, script=script) if client else ExecutionContext(script=script)
+        cls = type(ContractInterface.__name__, (ContractInterface,), {"program": self.program(key)})
+        return cls(context)
+
+    def from_micheline(self, code: List[dict]) -> ContractInterface:
+        return self.interface(self.add(code))
+
+    def _source(self, source: str, parse) -> ContractInterface:
+        digest = _digest(source.encode())
+        if digest not in self.sources or self.entry(self.sources[digest]) is None:
+            key = self.add(parse(source))
+            with self._lock:
+                self.sources[digest] = key
+                self._append_index("sources", digest, key)
+        return self.interface(self.sources[digest])
+
+    def from_michelson(self, source: str) -> ContractInterface:
+        """Like `ContractInterface.from_michelson`, parsing each text once."""
+        return self._source(source, michelson_to_micheline)
+
+    def from_file(self, path: str) -> ContractInterface:
+        """The interface of a `.tz` (Michelson) or `.json` (Micheline) file."""
+        with open(path) as f:
+            return self._source(f.read(), json.loads if path.endswith(".json") else michelson_to_micheline)
+
+    def contract(self, client, address: str, key: Optional[str] = None) -> ContractInterface:
+        """Like `client.contract(address)`, without the script request when
+        `address` is known or its code hash is given as `key`, and without
+        matching the code when its hash is known."""
+        if isinstance(client, LocalClient):
+            return client.contract(address)
+        if key is not None:
+            self.bind(address, key, persist=False)
+        key = self.addresses.get(address)
+        if key is None or self.entry(key) is None:
+            key = self.add(client.shell.contracts[address].script()["code"], client.shell)
+            self.bind(address, key)
+        return self.interface(key, client, address)
+
+
+_default: Optional[InterfaceCache] = None
+
+
+def default_cache() -> InterfaceCache:
+    """The process-wide cache in `DEFAULT_DIRECTORY`."""
+    global _default
+    if _default is None:
+        _default = InterfaceCache()
+    return _default
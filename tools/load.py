@@ -0,0 +1,485 @@
+"""Load generator for one pool under many concurrent traders.
+
+`LoadTest` derives `traders` accounts from a seed, funds them from the
+client's account with tez, tokens and liquidity tokens, approves the pool
+for their tokens, and then sends a weighted mix of calls at a target rate,
+each from a trader with no operation pending:
+
+    test = LoadTest(pytezos, pool, other_pool, traders=64, rate=20, mix={"xtzToToken": 4, "updateTokenPool": 1})
+    test.fund(xtz=10 ** 8, tokens=10 ** 6, lqt=10 ** 4)
+    print(test.run(duration=60).format())
+
+Calls are `xtzToToken`, `tokenToXtz`, `tokenToToken` (into `other_pool`),
+`addLiquidity`, `removeLiquidity` and `updateTokenPool`. Each trades a
+random fraction (`trade_size`) of the reserve it sells, with minimum-out
+bounds quoted by tools/quote.py from a storage snapshot refreshed at most
+every `quote_interval` seconds, the way traders quote off a recent block
+rather than the state their operation meets. A call fails with the error
+number the dex fails with (2 for `updateTokenPool` pending, 8 and 18 for
+slippage, ...), counted in the report whether the node refused it at
+simulation or included it as failed.
+
+Against a node, operations are injected without waiting, and one thread
+follows the blocks to record the inclusion, status and gas of every group,
+and frees its trader. The report gives the throughput, the inclusion latency
+percentiles in seconds and blocks, the failures by code, the gas per call
+against `hard_gas_limit_per_block`, and the final pool invariants
+(`tools.aio.check_pools` and `lqtTotal` against the liquidity token
+supply). On a `LocalClient` calls are applied one at a time, each in its
+own block and without gas metering, so only the failures and invariants
+are meaningful there.
+"""
+
+import hashlib
+import queue
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from pytezos.crypto.key import Key
+from pytezos.rpc.node import RpcError
+
+from tools import quote
+from tools.aio import PoolCheck, check_pools
+from tools.indexer import NodeSource
+from tools.interfaces import default_cache
+from tools.local_chain import LocalClient
+from tools.snapshot import DexStorage, StorageReader
+
+CALLS = ("xtzToToken", "tokenToXtz", "tokenToToken", "addLiquidity", "removeLiquidity", "updateTokenPool")
+DEFAULT_MIX = {"xtzToToken": 4, "tokenToXtz": 4, "tokenToToken": 1, "addLiquidity": 1, "removeLiquidity": 1,
+               "updateTokenPool": 1}
+PERCENTILES = (50, 90, 99)
+
+
+class Result(NamedTuple):
+    call: str
+    trader: str
+    sent: float  # seconds from the start of the run
+    status: str  # "applied", "failed" (included, failed or backtracked), "rejected" (refused at simulation), "dropped"
+    error: Optional[str]  # FAILWITH value (the dex error number) or protocol error id
+    latency: Optional[float]  # seconds from sending to inclusion
+    blocks: Optional[int]  # blocks from the head at sending to the inclusion block
+    gas: int
+
+
+class LqtCheck(NamedTuple):
+    pool: str
+    lqt_total: int
+    total_supply: int
+
+    @property
+    def ok(self) -> bool:
+        return self.lqt_total == self.total_supply
+
+
+class Report(NamedTuple):
+    duration: float
+    results: List[Result]
+    pools: List[PoolCheck]
+    lqt: List[LqtCheck]
+    hard_gas_limit_per_block: Optional[int]  # None on a LocalChain
+
+    @property
+    def applied(self) -> List[Result]:
+        return [result for result in self.results if result.status == "applied"]
+
+    @property
+    def throughput(self) -> float:
+        """Applied calls per second."""
+        return len(self.applied) / self.duration if self.duration else 0.0
+
+    def latency(self, blocks: bool = False) -> Dict[int, float]:
+        """Percentiles of the inclusion latency of the included calls, in
+        seconds or in blocks."""
+        values = [result.blocks if blocks else result.latency for result in self.results if result.latency is not None]
+        if not values:
+            return {}
+        return dict(zip(PERCENTILES, np.percentile(values, PERCENTILES).tolist()))
+
+    @property
+    def failures(self) -> Counter:
+        """Failed, rejected and dropped calls by error code."""
+        return Counter(result.error or result.status for result in self.results if result.status != "applied")
+
+    def calls(self) -> Dict[str, Tuple[int, int]]:
+        """(sent, applied) by call."""
+        counts: Dict[str, Tuple[int, int]] = {}
+        for result in self.results:
+            sent, applied = counts.get(result.call, (0, 0))
+            counts[result.call] = (sent + 1, applied + (result.status == "applied"))
+        return counts
+
+    def gas(self) -> Dict[str, int]:
+        """Median gas of the applied calls, by call."""
+        by_call: Dict[str, List[int]] = {}
+        for result in self.applied:
+            by_call.setdefault(result.call, []).append(result.gas)
+        return {call: int(np.median(values)) for call, values in by_call.items()}
+
+    def calls_per_block(self) -> Dict[str, int]:
+        """How many of each call fit in the gas limit of a block."""
+        if not self.hard_gas_limit_per_block:
+            return {}
+        return {call: self.hard_gas_limit_per_block // gas for call, gas in self.gas().items() if gas}
+
+    @property
+    def ok(self) -> bool:
+        return all(check.ok for check in self.pools) and all(check.ok for check in self.lqt)
+
+    def format(self) -> str:
+        lines = [f"{len(self.results)} calls in {self.duration:.1f}s, {len(self.applied)} applied, "
+                 f"{self.throughput:.2f}/s"]
+        for unit, percentiles in (("s", self.latency()), (" blocks", self.latency(blocks=True))):
+            if percentiles:
+                lines.append("latency " + ", ".join(f"p{p} {value:.2f}{unit}" for p, value in percentiles.items()))
+        gas, per_block = self.gas(), self.calls_per_block()
+        for call, (sent, applied) in sorted(self.calls().items()):
+            line = f"{call}: {applied}/{sent} applied"
+            if gas.get(call):
+                line += f", gas {gas[call]}"
+            if call in per_block:
+                line += f", {per_block[call]} per block"
+            lines.append(line)
+        for error, count in self.failures.most_common():
+            lines.append(f"failed with {error}: {count}")
+        for check in self.pools:
+            lines.append(f"{check.pool}: xtzPool {check.xtz_pool} balance {check.balance}, "
+                         f"tokenPool {check.token_pool} token balance {check.token_balance}"
+                         + ("" if check.ok else " MISMATCH"))
+        for check in self.lqt:
+            if not check.ok:
+                lines.append(f"{check.pool}: lqtTotal {check.lqt_total} total supply {check.total_supply} MISMATCH")
+        return "\n".join(lines)
+
+
+def trader_key(seed: str, index: int) -> Key:
+    return Key.from_secret_exponent(hashlib.sha256(f"{seed}/{index}".encode()).digest())
+
+
+def failure_code(error) -> str:
+    """The value a script failed with (`'18'` for the dex error 18), or the
+    id of any other error without its protocol prefix."""
+    if not isinstance(error, dict):
+        return str(error)
+    if "with" in error:
+        value = error["with"]
+        if isinstance(value, dict) and ("int" in value or "string" in value):
+            return value.get("int", value.get("string"))
+        return str(value)
+    parts = str(error.get("id", "unknown")).split(".")
+    return ".".join(parts[2:] if parts[0] == "proto" else parts)
+
+
+def group_result(contents: List[dict]) -> Tuple[str, Optional[str], int]:
+    """Status, failure code and gas of an included operation group."""
+    status, error, milligas = "applied", None, 0
+    for content in contents:
+        metadata = content.get("metadata", {})
+        results = [metadata.get("operation_result", {})]
+        results += [internal["result"] for internal in metadata.get("internal_operation_results", [])]
+        for result in results:
+            milligas += int(result.get("consumed_milligas", 0))
+            if result.get("status", "applied") != "applied":
+                status = "failed"
+                if error is None and result.get("errors"):
+                    error = failure_code(result["errors"][-1])
+    return status, error, -(-milligas // 1000)
+
+
+class _Pending(NamedTuple):
+    call: str
+    trader: int
+    sent: float
+    sent_at: float
+    level: int
+
+
+class LoadTest:
+    """Traders of `pool`, funded by the account of `client` (a pytezos client
+    or a `LocalClient`); `tokenToToken` trades into `other_pool`."""
+
+    def __init__(self, client, pool: str, other_pool: Optional[str] = None, traders: int = 16,
+                 mix: Optional[Dict[str, float]] = None, rate: float = 10.0,
+                 trade_size: Tuple[float, float] = (0.0001, 0.001), slippage: int = 50,
+                 quote_interval: float = 1.0, workers: int = 16, seed: str = "dex-load",
+                 deadline: Optional[str] = None, ttl: int = 60, poll: float = 0.5):
+        mix = dict(DEFAULT_MIX if mix is None else mix)
+        if other_pool is None:
+            mix.pop("tokenToToken", None)
+        unknown = set(mix) - set(CALLS)
+        if unknown:
+            raise ValueError(f"unknown calls {sorted(unknown)}, expected some of {CALLS}")
+        self.client = client
+        self.pool = pool
+        self.other_pool = other_pool
+        self.mix = mix
+        self.rate = rate
+        self.trade_size = trade_size
+        self.slippage = slippage
+        self.quote_interval = quote_interval
+        self.local = isinstance(client, LocalClient)
+        # a LocalChain applies one group at a time
+        self.workers = 1 if self.local else workers
+        self.ttl = ttl
+        self.poll = poll
+        self.deadline = deadline or (datetime.now(timezone.utc) + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.random = random.Random(seed)
+        self.keys = [trader_key(seed, index) for index in range(traders)]
+        self.clients = [client.using(key=key) for key in self.keys]
+        self.source = client.chain if self.local else NodeSource(client.shell)
+        self.reader = StorageReader(self.source)
+        self.interfaces = default_cache()
+        self._lock = threading.Lock()
+        self._pools: Dict[str, DexStorage] = {}
+        self._quoted_at = -float("inf")
+
+    @property
+    def traders(self) -> List[str]:
+        return [key.public_key_hash() for key in self.keys]
+
+    # setup -------------------------------------------------------------------
+
+    def fund(self, xtz: int, tokens: int, lqt: int = 0, batch: int = 40) -> None:
+        """Sends every trader `xtz` mutez, `tokens` of the pool's token and
+        `lqt` liquidity tokens, then makes the pool an operator (FA2) or an
+        unbounded spender (FA1.2) of each trader's tokens."""
+        storage = self.quotes(refresh=True)[self.pool]
+        token = self.interfaces.contract(self.client, storage.token_address)
+        funder = self.client.key.public_key_hash() if self.client.key else self.client.address
+        operations = [self.client.transaction(destination=trader, amount=xtz) for trader in self.traders]
+        if storage.token_id is None:
+            operations += [token.transfer({"from": funder, "to": trader, "value": tokens}) for trader in self.traders]
+        else:
+            operations.append(token.transfer([{"from_": funder, "txs": [
+                {"to_": trader, "token_id": storage.token_id, "amount": tokens} for trader in self.traders
+            ]}]))
+        if lqt:
+            lqt_token = self.interfaces.contract(self.client, storage.lqt_address)
+            operations += [lqt_token.transfer({"from": funder, "to": trader, "value": lqt}) for trader in self.traders]
+        for start in range(0, len(operations), batch):
+            self._confirm([self.client.bulk(*operations[start:start + batch])])
+
+        groups = []
+        for trader, client in zip(self.traders, self.clients):
+            token = self.interfaces.contract(client, storage.token_address)
+            if storage.token_id is None:
+                approval = token.approve({"spender": self.pool, "value": 2 ** 128})
+            else:
+                approval = token.update_operators([{"add_operator": {
+                    "owner": trader, "operator": self.pool, "token_id": storage.token_id}}])
+            reveal = [] if self.local or self._revealed(trader) else [client.reveal()]
+            groups.append(client.bulk(*reveal, approval))
+        self._confirm(groups)
+
+    def _revealed(self, address: str) -> bool:
+        return self.client.shell.head.context.contracts[address].manager_key() is not None
+
+    def _confirm(self, groups: list) -> None:
+        """Sends `groups` (from different accounts) together and waits for
+        all of them to be included."""
+        if self.local:
+            for group in groups:
+                group.send()
+            return
+        with ThreadPoolExecutor(self.workers) as executor:
+            hashes = list(executor.map(lambda group: group.send(min_confirmations=0).opg_hash, groups))
+        for contents in self.client.shell.wait_operations(hashes, ttl=self.ttl, min_confirmations=1):
+            status, error, _ = group_result(contents["contents"])
+            if status != "applied":
+                raise RpcError(f"setup operation {contents['hash']} failed with {error}")
+
+    # calls -------------------------------------------------------------------
+
+    def quotes(self, refresh: bool = False) -> Dict[str, DexStorage]:
+        """Storage of the pools, read again once `quote_interval` has passed."""
+        with self._lock:
+            if refresh or time.monotonic() - self._quoted_at >= self.quote_interval:
+                addresses = [self.pool] + ([self.other_pool] if self.other_pool else [])
+                snapshot = self.reader.read(addresses)
+                self._pools = {address: snapshot[address] for address in addresses}
+                self._quoted_at = time.monotonic()
+            return self._pools
+
+    def call(self, index: int, name: str, size: float):
+        """The call `name` of the trader `index`, selling `size` of the
+        reserve it sells."""
+        pools = self.quotes()
+        p = pools[self.pool]
+        trader = self.traders[index]
+        swap = self.interfaces.contract(self.clients[index], self.pool)
+        if name == "xtzToToken":
+            xtz = max(1, int(p.xtz_pool * size))
+            q = quote.xtz_to_token(p.xtz_pool, p.token_pool, xtz, self.slippage)
+            return swap.xtzToToken({"to": trader, "minTokensBought": int(q.min_tokens_bought),
+                                    "deadline": self.deadline}).with_amount(xtz)
+        if name == "tokenToXtz":
+            tokens = max(1, int(p.token_pool * size))
+            q = quote.token_to_xtz(p.xtz_pool, p.token_pool, tokens, self.slippage)
+            return swap.tokenToXtz({"to": trader, "tokensSold": tokens, "minXtzBought": int(q.min_xtz_bought),
+                                    "deadline": self.deadline})
+        if name == "tokenToToken":
+            out = pools[self.other_pool]
+            tokens = max(1, int(p.token_pool * size))
+            q = quote.token_to_token(p.xtz_pool, p.token_pool, out.xtz_pool, out.token_pool, tokens, self.slippage)
+            return swap.tokenToToken({"outputDexterContract": self.other_pool, "to": trader, "tokensSold": tokens,
+                                      "minTokensBought": int(q.min_tokens_bought), "deadline": self.deadline})
+        if name == "addLiquidity":
+            xtz = max(1, int(p.xtz_pool * size))
+            q = quote.add_liquidity(p.xtz_pool, p.token_pool, p.lqt_total, xtz, self.slippage)
+            max_tokens = int(quote.ceildiv(int(q.tokens_deposited) * (quote.FEE_DENOMINATOR + self.slippage),
+                                           quote.FEE_DENOMINATOR))
+            return swap.addLiquidity({"owner": trader, "minLqtMinted": int(q.min_lqt_minted),
+                                      "maxTokensDeposited": max_tokens, "deadline": self.deadline}).with_amount(xtz)
+        if name == "removeLiquidity":
+            lqt = max(1, int(p.lqt_total * size))
+            q = quote.remove_liquidity(p.xtz_pool, p.token_pool, p.lqt_total, lqt, self.slippage)
+            return swap.removeLiquidity({"to": trader, "lqtBurned": lqt, "minXtzWithdrawn": int(q.min_xtz_withdrawn),
+                                         "minTokensWithdrawn": int(q.min_tokens_withdrawn), "deadline": self.deadline})
+        if name == "updateTokenPool":
+            return swap.updateTokenPool()
+        raise ValueError(name)
+
+    # run ---------------------------------------------------------------------
+
+    def run(self, duration: float) -> Report:
+        """Sends `rate * duration` calls at `rate` per second, waits for the
+        pending ones and checks the pools."""
+        self._results: List[Result] = []
+        self._pending: Dict[str, _Pending] = {}
+        self._free: "queue.Queue[int]" = queue.Queue()
+        for index in range(len(self.keys)):
+            self._free.put(index)
+        self._level = self.source.head_level()
+        self._sending = True
+        names, weights = zip(*self.mix.items())
+        start = time.monotonic()
+        tracker = None if self.local else threading.Thread(target=self._track, daemon=True)
+        if tracker:
+            tracker.start()
+        with ThreadPoolExecutor(self.workers) as executor:
+            for i in range(int(self.rate * duration)):
+                delay = start + i / self.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                index = self._free.get()
+                name = self.random.choices(names, weights)[0]
+                size = self.random.uniform(*self.trade_size)
+                executor.submit(self._send, index, name, size, start)
+        self._sending = False
+        if tracker:
+            tracker.join()
+        elapsed = time.monotonic() - start
+        return Report(elapsed, sorted(self._results, key=lambda result: result.sent), *self.check(),
+                      self._gas_limit())
+
+    def _record(self, pending: _Pending, status: str, error: Optional[str], level: Optional[int], gas: int) -> None:
+        latency = None if level is None else time.monotonic() - pending.sent_at
+        blocks = None if level is None else level - pending.level
+        with self._lock:
+            self._results.append(Result(pending.call, self.traders[pending.trader], pending.sent, status, error,
+                                        latency, blocks, gas))
+        self._free.put(pending.trader)
+
+    def _send(self, index: int, name: str, size: float, start: float) -> None:
+        sent_at = time.monotonic()
+        level = self.source.head_level() if self.local else self._level
+        pending = _Pending(name, index, sent_at - start, sent_at, level)
+        try:
+            operation = self.call(index, name, size).send(min_confirmations=0)
+        except RpcError as e:
+            self._record(pending, "rejected", failure_code(e.args[0] if e.args else None), None, 0)
+            return
+        except Exception as e:  # a failed quote or signature must not stall the trader
+            self._record(pending, "rejected", type(e).__name__, None, 0)
+            return
+        if self.local:
+            status, error, gas = group_result(operation.opg_result["contents"])
+            self._record(pending, status, error, self.source.head_level(), gas)
+            return
+        with self._lock:
+            self._pending[operation.opg_hash] = pending
+
+    def _track(self) -> None:
+        """Follows the blocks until no call is pending, recording the groups
+        of the pending calls as they are included."""
+        last_send = self._level
+        while True:
+            head = self.source.head_level()
+            for level in range(self._level + 1, head + 1):
+                for group in self.source.block(level)["operations"][-1]:
+                    with self._lock:
+                        pending = self._pending.pop(group["hash"], None)
+                    if pending is not None:
+                        status, error, gas = group_result(group["contents"])
+                        self._record(pending, status, error, level, gas)
+            self._level = head
+            with self._lock:
+                idle = not self._pending
+            if self._sending:
+                last_send = head
+            elif idle:
+                return
+            elif head - last_send > self.ttl:
+                with self._lock:
+                    dropped, self._pending = list(self._pending.values()), {}
+                for pending in dropped:
+                    self._record(pending, "dropped", None, None, 0)
+                return
+            time.sleep(self.poll)
+
+    def _gas_limit(self) -> Optional[int]:
+        if self.local:
+            return None
+        return int(self.client.shell.head.context.constants()["hard_gas_limit_per_block"])
+
+    def check(self) -> Tuple[List[PoolCheck], List[LqtCheck]]:
+        """Balance and liquidity token supply checks of the pools."""
+        addresses = [self.pool] + ([self.other_pool] if self.other_pool else [])
+        pools = self.quotes(refresh=True)
+        lqt_supply = self.reader.read([pools[address].lqt_address for address in addresses])
+        lqt = [LqtCheck(address, pools[address].lqt_total, lqt_supply[pools[address].lqt_address].total_supply)
+               for address in addresses]
+        return check_pools(self.source, addresses), lqt
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """`xtzToToken=4,updateTokenPool=1` as weights by call."""
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from pytezos import pytezos
+
+    parser = argparse.ArgumentParser(description="Drive a dex pool with many concurrent traders.")
+    parser.add_argument("--pool", required=True)
+    parser.add_argument("--other-pool", help="output pool of tokenToToken calls")
+    parser.add_argument("--key", required=True, help="key of the account funding the traders")
+    parser.add_argument("--shell", default="http://localhost:8732")
+    parser.add_argument("--traders", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=10.0, help="calls per second")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds")
+    parser.add_argument("--mix", type=parse_mix, help="weights by call, e.g. xtzToToken=4,tokenToXtz=4,updateTokenPool=1")
+    parser.add_argument("--slippage", type=int, default=50, help="basis points")
+    parser.add_argument("--fund-xtz", type=int, default=10 ** 8, help="mutez per trader, 0 to skip funding")
+    parser.add_argument("--fund-tokens", type=int, default=10 ** 6)
+    parser.add_argument("--fund-lqt", type=int, default=0)
+    parser.add_argument("--seed", default="dex-load")
+    args = parser.parse_args()
+
+    test = LoadTest(pytezos.using(shell=args.shell, key=args.key), args.pool, args.other_pool, traders=args.traders,
+                    mix=args.mix, rate=args.rate, slippage=args.slippage, seed=args.seed)
+    if args.fund_xtz:
+        test.fund(args.fund_xtz, args.fund_tokens, args.fund_lqt)
+    print(test.run(args.duration).format())
@@ -0,0 +1,837 @@
+"""In-process chain that runs compiled Michelson contracts without a node.
+
+`LocalChain` keeps balances, contract storage and big_maps in memory and
+applies operation groups the way the protocol does: the amount is credited
+before the code runs, the emitted internal operations (token transfers,
+`mintOrBurn`, reserve payouts, `CREATE_CONTRACT` children) are applied
+depth-first, and a failure anywhere in the group rolls the whole group back.
+
+Each result carries `paid_storage_size_diff` and `storage_size`, counted as
+the forged bytes of code, storage and big_map entries (without the
+protocol's fixed per-entry overheads), and `executed_instructions`, the
+instructions the interpreter ran for the call. The interpreter does not
+meter gas, so results have no `consumed_milligas`.
+
+`register_global_constant` operations fill a table of constants. As in the
+protocol, an origination stores and pays for its code as sent, while the
+code that runs has every `constant` expanded.
+
+Contract code is executed by the pytezos interpreter (`MichelsonProgram`,
+`MichelsonStack`) under `LocalContext`, an `ExecutionContext` that resolves
+other contracts, big_map lookups and originated addresses against the chain
+instead of an RPC node. The `VIEW` instruction runs the view of the target
+contract in that contract's own context, and its instructions count as
+executed by the caller. The overridden instructions (`CONTRACT`,
+`CREATE_CONTRACT`, `FAILWITH`, `VIEW`) and big_map updates behave as in
+pytezos under any other context, so importing this module changes nothing
+for clients of a node.
+
+`LocalClient` and `LocalContract` mirror the subset of the pytezos client
+that tests/test_dex.py uses (`contract()`, `origination()`, `transaction()`, `bulk()`,
+`.storage[...]()`, entrypoint calls with `.with_amount()`, `.send()` and
+`.callback_view()`, on-chain views with `.run_view()`), and results and errors use the RPC shapes, so callers
+can read
+`opg_result["contents"][0]["metadata"]` or catch `MichelsonError` exactly as
+they would against a sandbox node.
+"""
+
+import hashlib
+import json
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from pytezos import ContractInterface
+from pytezos.context.abstract import get_originated_address
+from pytezos.context.impl import ExecutionContext
+from pytezos.contract.data import ContractData
+from pytezos.crypto.key import Key
+from pytezos.michelson.forge import forge_micheline
+from pytezos.michelson.instructions.base import format_stdout
+from pytezos.michelson.instructions.control import FailwithInstruction
+from pytezos.michelson.instructions.tezos import ContractInstruction, CreateContractInstruction, ViewInstruction
+from pytezos.michelson.micheline import Micheline, MichelsonRuntimeError
+from pytezos.michelson.program import MichelsonProgram
+from pytezos.michelson.repl import Interpreter
+from pytezos.michelson.sections import ParameterSection
+from pytezos.michelson.stack import MichelsonStack
+from pytezos.michelson.types import AddressType, BigMapType, ContractType, OptionType
+from pytezos.operation.content import format_mutez
+from pytezos.rpc.node import RpcError
+
+from tools.global_constants import constant_hash, expand
+
+
+CHAIN_ID = "NetXdQprcVkpaWU"
+PROTOCOL = "local"
+IMPLICIT_PARAMETER = {"prim": "parameter", "args": [{"prim": "unit"}]}
+IMPLICIT_ENTRYPOINTS = ParameterSection.match(IMPLICIT_PARAMETER).list_entrypoints()
+UNIT = {"prim": "Unit"}
+# pytezos encodes a `None` callback as the dummy originated address 0
+DUMMY_CALLBACK = get_originated_address(0)
+
+
+def is_implicit(address: str) -> bool:
+    return address.startswith("tz")
+
+
+def code_hash(code: List[dict]) -> str:
+    return hashlib.sha256(json.dumps(code, sort_keys=True).encode()).hexdigest()
+
+
+def expr_size(expr) -> int:
+    return len(forge_micheline(expr))
+
+
+class ScriptRejected(MichelsonRuntimeError):
+    """FAILWITH reached; keeps the rejected value as Micheline."""
+
+    def __init__(self, value):
+        super().__init__(repr(value))
+        self.value = value.to_micheline_value()
+
+
+class OperationFailed(Exception):
+    def __init__(self, errors: List[dict]):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def _instruction_records(stdout: List[str]) -> int:
+    """The records of executed instructions in an interpreter trace, which
+    also has the BEGIN, END and RET of every call and view and notes such as
+    skipped type checks."""
+    return sum(
+        1 for line in stdout
+        if " / " in line and " => " in line and not line.startswith(("BEGIN %", "END %", "RET %"))
+    )
+
+
+def _error(kind: str, **kwargs) -> dict:
+    return {"kind": "temporary", "id": f"proto.{PROTOCOL}.{kind}", **kwargs}
+
+
+def _runtime_errors(exc: Exception) -> List[dict]:
+    cause: Optional[BaseException] = exc
+    while cause is not None:
+        if isinstance(cause, ScriptRejected):
+            return [_error("michelson_v1.script_rejected", location=0, **{"with": cause.value})]
+        cause = cause.__cause__
+    message = " -> ".join(map(str, exc.args))
+    return [_error("michelson_v1.runtime_error", message=message)]
+
+
+@dataclass
+class BigMap:
+    key_type: dict
+    value_type: dict
+    values: Dict[str, Tuple[dict, dict]] = field(default_factory=dict)
+
+    def copy(self) -> "BigMap":
+        return BigMap(self.key_type, self.value_type, dict(self.values))
+
+    def size(self) -> int:
+        return expr_size(self.key_type) + expr_size(self.value_type) + sum(
+            expr_size(key) + expr_size(value) for key, value in self.values.values())
+
+
+@dataclass
+class Account:
+    balance: int = 0
+    code: Optional[List[dict]] = None
+    storage: Any = None
+    counter: int = 0
+    storage_size: int = 0
+    paid_storage_size: int = 0
+    code_size: int = 0
+    code_id: Optional[str] = None  # code_hash(code), computed once at origination
+
+    def pay_storage(self, size_diff: int) -> int:
+        """Grows `storage_size`; returns the bytes above the most ever paid for."""
+        self.storage_size += size_diff
+        paid = max(0, self.storage_size - self.paid_storage_size)
+        self.paid_storage_size += paid
+        return paid
+
+
+class LocalContext(ExecutionContext):
+    """Execution context of one contract call on a `LocalChain`."""
+
+    def __init__(self, chain: "LocalChain", address: str, sender=None, source=None, amount=0, balance=0):
+        super().__init__(
+            amount=amount,
+            chain_id=CHAIN_ID,
+            sender=sender,
+            source=source,
+            balance=balance,
+            now=chain.now,
+            level=chain.level,
+            address=address,
+            script={"code": chain.accounts[address].code},
+        )
+        self.chain = chain
+        self.copies: Dict[int, int] = {}
+        self.originations: Dict[int, str] = {}
+        self.origination_diffs: List[dict] = []
+        self.force_copy = False
+        self.executed_instructions = 0
+
+    def get_parameter_expr(self, address=None):
+        if address is None:
+            return super().get_parameter_expr()
+        address = address.split("%")[0]
+        if address == DUMMY_CALLBACK:
+            return None
+        if is_implicit(address):
+            return IMPLICIT_PARAMETER
+        return self.chain.section(address, "parameter")
+
+    def get_storage_expr(self, address=None):
+        if address is None:
+            return super().get_storage_expr()
+        return self.chain.section(address, "storage")
+
+    def get_storage_value(self, address=None):
+        return self.chain.accounts[address or self.address].storage
+
+    def get_originated_address(self) -> str:
+        return self.chain.next_address()
+
+    def get_big_map_diff(self, ptr: int) -> Tuple[Optional[int], int, str]:
+        if ptr in self.big_maps and ptr >= 0:
+            src, copy = self.big_maps[ptr]
+            if not (copy or self.force_copy):
+                return src, src, "update"
+            dst = self.chain.next_big_map_id()
+            self.copies[dst] = src
+            return src, dst, "copy"
+        return None, self.chain.next_big_map_id(), "alloc"
+
+    def get_big_map_value(self, ptr: int, key_hash: str):
+        if ptr not in self.big_maps:
+            return None
+        src, _ = self.big_maps[ptr]
+        return self.chain.big_map_value(src, key_hash)
+
+    def detach_origination(self, origination, initial_storage, address: str) -> None:
+        """Give the child its own copies of the big_maps passed to CREATE_CONTRACT."""
+        diff: List[dict] = []
+        self.force_copy = True
+        try:
+            storage = initial_storage.aggregate_lazy_diff(diff)
+        finally:
+            self.force_copy = False
+        origination.content["script"]["storage"] = storage.to_micheline_value()
+        self.origination_diffs.extend(diff)
+        self.originations[id(origination.content)] = address
+
+
+class _ContractInstruction(ContractInstruction):
+    """CONTRACT that returns None for missing contracts and entrypoints."""
+
+    @classmethod
+    def execute(cls, stack, stdout, context):
+        if not isinstance(context, LocalContext):
+            return super().execute(stack, stdout, context)
+        entrypoint = next(iter(cls.field_names), "default")
+        address = stack.pop1()
+        address.assert_type_in(AddressType)
+        contract_type = ContractType.create_type(args=cls.args)
+        res = OptionType.none(contract_type)
+        target, _, suffix = str(address).partition("%")
+        if suffix and entrypoint == "default":
+            entrypoint = suffix
+        entrypoint_type = context.chain.entrypoint_type(target, entrypoint)
+        if entrypoint_type is not None and not (suffix and cls.field_names):
+            try:
+                entrypoint_type.assert_type_equal(cls.args[0])
+                res = OptionType.from_some(contract_type.from_value(f"{target}%{entrypoint}"))
+            except AssertionError:
+                pass
+        stack.push(res)
+        stdout.append(format_stdout(cls.prim, [address], [res]))
+        return cls(stack_items_added=1)
+
+
+class _CreateContractInstruction(CreateContractInstruction):
+    """CREATE_CONTRACT that copies big_maps into the child as the protocol does."""
+
+    @classmethod
+    def execute(cls, stack, stdout, context):
+        initial_storage = stack.items[stack.protected + 2]
+        res = super().execute(stack, stdout, context)
+        if isinstance(context, LocalContext):
+            origination, address = stack.items[stack.protected], stack.items[stack.protected + 1]
+            context.detach_origination(origination, initial_storage, str(address))
+        return res
+
+
+class _ViewInstruction(ViewInstruction):
+    """VIEW that runs the view of another contract against that contract's
+    storage, big_maps and balance, and returns None for missing contracts,
+    missing views and mismatched types."""
+
+    @classmethod
+    def execute(cls, stack, stdout, context):
+        if not isinstance(context, LocalContext):
+            return super().execute(stack, stdout, context)
+        input_value, view_address = stack.pop2()
+        view_address.assert_type_in(AddressType)
+        name = cls.args[0].get_string()
+        return_type = cls.args[1]
+        result = context.chain.call_view(str(view_address), name, input_value, return_type, stdout,
+                                         sender=context.address, source=context.source)
+        res = OptionType.none(return_type) if result is None else OptionType.from_some(result)
+        stack.push(res)
+        stdout.append(format_stdout(cls.prim, [input_value, view_address], [res]))
+        return cls(stack_items_added=1)
+
+
+class _FailwithInstruction(FailwithInstruction):
+    """FAILWITH that keeps the rejected value for the operation result."""
+
+    @classmethod
+    def execute(cls, stack, stdout, context):
+        if not isinstance(context, LocalContext):
+            return super().execute(stack, stdout, context)
+        value = stack.pop1()
+        assert value.is_packable(), f"expected packable type, got {value.prim}"
+        raise ScriptRejected(value)
+
+
+def _big_map_update(self, key, val):
+    """`BigMapType.update` that keeps updates of keys only present on chain.
+
+    The pytezos version rebuilds the in-memory diff from the keys it already
+    holds, so overwriting a key that was read from the node is silently lost.
+    """
+    if not isinstance(getattr(self, "context", None), LocalContext):
+        return _pytezos_big_map_update(self, key, val)
+    removed_keys = set(self.removed_keys)
+    prev_val = self.get(key, dup=False)
+    items = [(k, v) for k, v in self.items if k != key]
+    if val is not None:
+        items = sorted(items + [(key, val)], key=lambda x: x[0])
+        removed_keys.discard(key)
+    elif prev_val is not None:
+        removed_keys.add(key)
+    res = type(self)(items=items, ptr=self.ptr, removed_keys=list(removed_keys))
+    res.context = self.context
+    return prev_val, res
+
+
+# the overrides only apply under a LocalContext: every other context, such
+# as a pytezos client of a node, keeps the pytezos semantics
+_pytezos_big_map_update = BigMapType.update
+BigMapType.update = _big_map_update
+Micheline.classes[("CONTRACT", 1)] = _ContractInstruction
+Micheline.classes[("CREATE_CONTRACT", 1)] = _CreateContractInstruction
+Micheline.classes[("FAILWITH", 0)] = _FailwithInstruction
+Micheline.classes[("VIEW", 2)] = _ViewInstruction
+
+
+class LocalChain:
+    """Balances, contracts and big_maps of a private chain held in memory.
+
+    Every operation group is baked into its own block: `level` increases by
+    one and `now` by `block_time` seconds. `block(level)` returns the block in
+    the RPC shape, so tools that follow a node (tools/indexer.py) can follow
+    the in-process chain as well.
+    """
+
+    def __init__(self, now: int = 1600000000, block_time: int = 1):
+        self.now = now
+        self.level = 1
+        self.block_time = block_time
+        self.blocks: Dict[int, dict] = {}
+        self.constants: Dict[str, dict] = {}
+        self.accounts: Dict[str, Account] = {}
+        self.big_maps: Dict[int, BigMap] = {}
+        self.programs: Dict[str, Any] = {}
+        self.interfaces: Dict[str, ContractInterface] = {}
+        self._big_map_id = 0
+        self._origination_index = 1
+        self._sections: Dict[str, Dict[str, dict]] = {}
+        self._bake([])
+
+    # state -------------------------------------------------------------------
+
+    def snapshot(self) -> tuple:
+        return (
+            {address: replace(account) for address, account in self.accounts.items()},
+            {ptr: big_map.copy() for ptr, big_map in self.big_maps.items()},
+            self._big_map_id,
+            self._origination_index,
+            self.level,
+            self.now,
+            dict(self.blocks),
+            dict(self.constants),
+        )
+
+    def restore(self, snapshot: tuple) -> None:
+        accounts, big_maps, self._big_map_id, self._origination_index, self.level, self.now, blocks, constants = snapshot
+        self.accounts = {address: replace(account) for address, account in accounts.items()}
+        self.big_maps = {ptr: big_map.copy() for ptr, big_map in big_maps.items()}
+        self.blocks = dict(blocks)
+        self.constants = dict(constants)
+
+    def next_address(self) -> str:
+        address = get_originated_address(self._origination_index)
+        self._origination_index += 1
+        return address
+
+    def next_big_map_id(self) -> int:
+        ptr = self._big_map_id
+        self._big_map_id += 1
+        return ptr
+
+    def set_balance(self, address: str, amount: int) -> None:
+        self.accounts.setdefault(address, Account()).balance = amount
+
+    def balance(self, address: str) -> int:
+        account = self.accounts.get(address)
+        return account.balance if account else 0
+
+    def storage(self, address: str):
+        return self.accounts[address].storage
+
+    def big_map_value(self, ptr: int, key_hash: str):
+        big_map = self.big_maps.get(ptr)
+        if big_map is None or key_hash not in big_map.values:
+            return None
+        return big_map.values[key_hash][1]
+
+    def code(self, address: str) -> List[dict]:
+        return self.accounts[address].code
+
+    def contract(self, address: str) -> dict:
+        account = self.accounts[address]
+        return {"balance": str(account.balance), "script": {"code": account.code, "storage": account.storage}}
+
+    # blocks ------------------------------------------------------------------
+
+    def head_level(self) -> int:
+        return self.level
+
+    def block(self, level: int) -> dict:
+        return self.blocks[level]
+
+    def _bake(self, groups: List[dict]) -> None:
+        timestamp = datetime.fromtimestamp(self.now, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.blocks[self.level] = {
+            "protocol": PROTOCOL,
+            "chain_id": CHAIN_ID,
+            "header": {"level": self.level, "timestamp": timestamp},
+            # consensus, voting, anonymous and manager operations
+            "operations": [[], [], [], groups],
+        }
+
+    # code --------------------------------------------------------------------
+
+    def program(self, address: str):
+        account = self.accounts[address]
+        code, key = account.code, account.code_id
+        if key not in self.programs:
+            self.programs[key] = MichelsonProgram.match(code)
+        return self.programs[key]
+
+    def interface(self, address: str) -> ContractInterface:
+        account = self.accounts[address]
+        code, key = account.code, account.code_id
+        if key not in self.interfaces:
+            self.interfaces[key] = ContractInterface.from_micheline(code)
+        return self.interfaces[key]
+
+    def section(self, address: str, name: str) -> Optional[dict]:
+        account = self.accounts.get(address)
+        if account is None or account.code is None:
+            return None
+        return next(expr for expr in account.code if expr["prim"] == name)
+
+    def entrypoint_type(self, address: str, entrypoint: str):
+        if is_implicit(address):
+            return IMPLICIT_ENTRYPOINTS.get(entrypoint)
+        if self.section(address, "parameter") is None:
+            return None
+        return self.program(address).parameter.list_entrypoints().get(entrypoint)
+
+    # execution ---------------------------------------------------------------
+
+    def inject(self, source: str, contents: List[dict]) -> dict:
+        """Apply an operation group signed by `source` and return it with metadata.
+
+        Raises the same `RpcError` subclass a node would (`MichelsonError`
+        for rejected scripts) and leaves the chain untouched on failure.
+        """
+        snapshot = self.snapshot()
+        self.level += 1
+        self.now += self.block_time
+        group = {"protocol": PROTOCOL, "chain_id": CHAIN_ID, "contents": []}
+        try:
+            for content in contents:
+                content = {"source": source, "fee": "0", **content}
+                self.accounts.setdefault(source, Account()).counter += 1
+                content["counter"] = str(self.accounts[source].counter)
+                group["contents"].append(content)
+                internal: List[dict] = []
+                content["metadata"] = {"operation_result": {}, "internal_operation_results": internal}
+                content["metadata"]["operation_result"] = self._apply(content, source)
+                self._apply_internal(content["metadata"]["operation_result"].pop("_emitted"), source, internal)
+        except OperationFailed as e:
+            self.restore(snapshot)
+            raise RpcError.from_errors(e.errors) from None
+        self._bake([group])
+        return group
+
+    def _apply_internal(self, emitted: List[dict], origin: str, results: List[dict]) -> None:
+        for op in emitted:
+            address = op.pop("_address", None)
+            entry = {**op, "nonce": len(results)}
+            results.append(entry)
+            entry["result"] = self._apply(op, origin, address)
+            self._apply_internal(entry["result"].pop("_emitted"), origin, results)
+
+    def _apply(self, content: dict, origin: str, address: Optional[str] = None) -> dict:
+        kind = content["kind"]
+        if kind == "transaction":
+            return self._transaction(content, origin)
+        if kind == "origination":
+            return self._origination(content, address)
+        if kind == "register_global_constant":
+            return self._register_global_constant(content)
+        if kind == "delegation":
+            return {"status": "applied", "_emitted": []}
+        raise OperationFailed([_error("operation.unsupported", message=kind)])
+
+    def _debit(self, address: str, amount: int) -> None:
+        account = self.accounts.get(address)
+        if account is None or account.balance < amount:
+            balance = account.balance if account else 0
+            raise OperationFailed([_error("contract.balance_too_low", contract=address,
+                                          balance=str(balance), amount=str(amount))])
+        account.balance -= amount
+
+    def _transaction(self, content: dict, origin: str) -> dict:
+        source, destination = content["source"], content["destination"]
+        amount = int(content.get("amount", 0))
+        parameters = content.get("parameters") or {"entrypoint": "default", "value": UNIT}
+        self._debit(source, amount)
+        if is_implicit(destination):
+            if parameters["entrypoint"] != "default" or parameters["value"] != UNIT:
+                raise OperationFailed([_error("michelson_v1.bad_contract_parameter", contract=destination)])
+            self.accounts.setdefault(destination, Account()).balance += amount
+            return {"status": "applied", "_emitted": []}
+        account = self.accounts.get(destination)
+        if account is None or account.code is None:
+            raise OperationFailed([_error("contract.non_existing_contract", contract=destination)])
+        account.balance += amount
+        context = LocalContext(self, destination, sender=source, source=origin,
+                               amount=amount, balance=account.balance)
+        operations, storage, lazy_diff = self.execute(
+            destination, parameters["entrypoint"], parameters["value"], account.storage, context)
+        size_diff = expr_size(storage) - expr_size(account.storage)
+        account.storage = storage
+        lazy_diff = context.origination_diffs + lazy_diff
+        size_diff += self.apply_lazy_diff(lazy_diff, context)
+        for op in operations:
+            if op["kind"] == "origination":
+                op["_address"] = context.originations[id(op)]
+        paid = account.pay_storage(size_diff)
+        return {
+            "status": "applied",
+            "storage": storage,
+            "lazy_storage_diff": lazy_diff,
+            "storage_size": str(account.storage_size),
+            "paid_storage_size_diff": str(paid),
+            "executed_instructions": str(context.executed_instructions),
+            "_emitted": operations,
+        }
+
+    def _register_global_constant(self, content: dict) -> dict:
+        value = content["value"]
+        key = constant_hash(value)
+        if key in self.constants:
+            raise OperationFailed([_error("Expression_already_registered")])
+        self.constants[key] = value
+        return {
+            "status": "applied",
+            "global_address": key,
+            "storage_size": str(expr_size(value)),
+            "_emitted": [],
+        }
+
+    def _origination(self, content: dict, address: Optional[str] = None) -> dict:
+        balance = int(content.get("balance", 0))
+        self._debit(content["source"], balance)
+        return self.install(address or self.next_address(), content["script"], balance)
+
+    def install(self, address: str, script: dict, balance: int = 0) -> dict:
+        """Creates the contract `address` with `script` and `balance` as an
+        origination would, without a source to pay for it (tools/fork.py)."""
+        try:
+            code = expand(script["code"], self.constants)
+        except KeyError as e:
+            raise OperationFailed([_error("Expression_not_found", hash=e.args[0])]) from None
+        self.accounts[address] = Account(balance=balance, code=code, code_size=expr_size(script["code"]),
+                                         code_id=code_hash(code))
+        context = LocalContext(self, address)
+        storage = self.program(address).storage.from_micheline_value(script["storage"])
+        storage.attach_context(context)
+        lazy_diff: List[dict] = []
+        storage = storage.item.aggregate_lazy_diff(lazy_diff)
+        account = self.accounts[address]
+        account.storage = storage.to_micheline_value()
+        size_diff = account.code_size + expr_size(account.storage) + self.apply_lazy_diff(lazy_diff, context)
+        paid = account.pay_storage(size_diff)
+        return {
+            "status": "applied",
+            "originated_contracts": [address],
+            "lazy_storage_diff": lazy_diff,
+            "storage_size": str(account.storage_size),
+            "paid_storage_size_diff": str(paid),
+            "_emitted": [],
+        }
+
+    def execute(self, address: str, entrypoint: str, parameter, storage, context: LocalContext):
+        """Run `address` code without committing; returns (operations, storage, lazy_diff)."""
+        program = self.program(address)
+        stack = MichelsonStack()
+        stdout: List[str] = []
+        try:
+            res = program.instantiate(entrypoint=entrypoint, parameter=parameter, storage=storage)
+            res.begin(stack, stdout, context)
+            res.execute(stack, stdout, context)
+            operations, storage, lazy_diff, _ = res.end(stack, stdout)
+        except MichelsonRuntimeError as e:
+            raise OperationFailed(_runtime_errors(e)) from e
+        finally:
+            context.executed_instructions = _instruction_records(stdout)
+        return operations, storage, lazy_diff
+
+    def apply_lazy_diff(self, lazy_diff: List[dict], context: LocalContext) -> int:
+        """Applies `lazy_diff`; returns the change in big_map bytes."""
+        size_diff = 0
+        for item in lazy_diff:
+            if item["kind"] != "big_map":
+                continue
+            ptr, diff = int(item["id"]), item["diff"]
+            if diff["action"] == "alloc":
+                self.big_maps[ptr] = BigMap(diff["key_type"], diff["value_type"])
+                size_diff += self.big_maps[ptr].size()
+            elif diff["action"] == "copy":
+                diff["source"] = str(context.copies[ptr])
+                self.big_maps[ptr] = self.big_maps[context.copies[ptr]].copy()
+                size_diff += self.big_maps[ptr].size()
+            elif diff["action"] == "remove":
+                removed = self.big_maps.pop(ptr, None)
+                size_diff -= removed.size() if removed else 0
+                continue
+            values = self.big_maps[ptr].values
+            for update in diff.get("updates", []):
+                previous = values.pop(update["key_hash"], None)
+                if previous is not None:
+                    size_diff -= expr_size(previous[0]) + expr_size(previous[1])
+                if update.get("value") is not None:
+                    values[update["key_hash"]] = (update["key"], update["value"])
+                    size_diff += expr_size(update["key"]) + expr_size(update["value"])
+        return size_diff
+
+    def run_callback(self, address: str, parameters: dict, sender: str) -> list:
+        """Run a callback-style getter and decode the operations it emits."""
+        context = LocalContext(self, address, sender=sender, source=sender,
+                               balance=self.balance(address))
+        operations, _, stdout, error = Interpreter.run_callback(
+            entrypoint=parameters["entrypoint"],
+            parameter=parameters["value"],
+            storage=self.storage(address),
+            context=context,
+        )
+        if error:
+            raise OperationFailed(_runtime_errors(error)) from error
+        return operations
+
+    def call_view(self, address: str, name: str, parameter, return_type, stdout: List[str], sender: str, source: str):
+        """Run the on-chain view `name` of `address` for the VIEW instruction
+        of a running contract; None where VIEW pushes None. The instructions
+        of the view count as executed by the caller."""
+        if is_implicit(address) or self.section(address, "parameter") is None:
+            return None
+        program = self.program(address)
+        view = next((view for view in program.views if view.name == name), None)
+        if view is None:
+            return None
+        try:
+            view.args[1].assert_type_equal(type(parameter))
+            return_type.assert_type_equal(view.args[2])
+        except AssertionError:
+            return None
+        context = LocalContext(self, address, sender=sender, source=source, balance=self.balance(address))
+        stack = MichelsonStack()
+        res = program.instantiate_view(name=name, parameter=parameter.to_micheline_value(), storage=self.storage(address))
+        res.begin(stack, stdout, context)
+        res.execute_view(stack, stdout, context)
+        return res.ret(stack, stdout)
+
+    def run_view(self, address: str, name: str, parameter, sender: str):
+        """Run the on-chain view `name` of `address` on its current storage
+        and decode the result."""
+        context = LocalContext(self, address, sender=sender, source=sender,
+                               balance=self.balance(address))
+        stack = MichelsonStack()
+        stdout: List[str] = []
+        try:
+            res = self.program(address).instantiate_view(name=name, parameter=parameter, storage=self.storage(address))
+            res.begin(stack, stdout, context)
+            res.execute_view(stack, stdout, context)
+            return res.ret(stack, stdout).to_python_object()
+        except MichelsonRuntimeError as e:
+            raise OperationFailed(_runtime_errors(e)) from e
+
+
+class LocalOperation:
+    """Result of `LocalCall.send()`, shaped like a pytezos `OperationGroup`."""
+
+    def __init__(self, opg_result: dict):
+        self.opg_result = opg_result
+
+
+class LocalOperationGroup:
+    """Unsent operation group built by `LocalClient.origination()` or `LocalClient.bulk()`."""
+
+    def __init__(self, client: "LocalClient", contents: List[dict]):
+        self.client = client
+        self.contents = contents
+
+    def send(self, **kwargs) -> LocalOperation:
+        return LocalOperation(self.client.chain.inject(self.client.address, self.contents))
+
+
+class LocalCall:
+    def __init__(self, contract: "LocalContract", parameters: dict, amount: Union[int, Decimal] = 0):
+        self.contract = contract
+        self.parameters = parameters
+        self.amount = amount
+
+    def with_amount(self, amount: Union[int, Decimal]) -> "LocalCall":
+        return LocalCall(self.contract, self.parameters, amount)
+
+    def as_transaction(self) -> dict:
+        return {
+            "kind": "transaction",
+            "destination": self.contract.address,
+            "amount": format_mutez(self.amount),
+            "parameters": self.parameters,
+        }
+
+    def send(self, **kwargs) -> LocalOperation:
+        return LocalOperationGroup(self.contract.client, [self.as_transaction()]).send(**kwargs)
+
+    def callback_view(self):
+        client = self.contract.client
+        try:
+            operations = client.chain.run_callback(self.contract.address, self.parameters, client.address)
+        except OperationFailed as e:
+            raise RpcError.from_errors(e.errors) from None
+        if len(operations) != 1:
+            raise Exception(f"Expected a single callback operation, got {len(operations)}")
+        return operations[0]
+
+    def view(self):
+        return self.callback_view()
+
+
+class LocalViewCall:
+    def __init__(self, contract: "LocalContract", name: str, parameter):
+        self.contract = contract
+        self.name = name
+        self.parameter = parameter
+
+    def run_view(self, **kwargs):
+        client = self.contract.client
+        try:
+            return client.chain.run_view(self.contract.address, self.name, self.parameter, client.address)
+        except OperationFailed as e:
+            raise RpcError.from_errors(e.errors) from None
+
+
+class LocalContract:
+    """Deployed contract on a `LocalChain`; entrypoints and on-chain views
+    are attributes."""
+
+    def __init__(self, client: "LocalClient", address: str):
+        self.client = client
+        self.address = address
+        self.interface = client.chain.interface(address)
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in self.interface.entrypoints:
+            entrypoint = self.interface.entrypoint[name]
+
+            def call(*args, **kwargs) -> LocalCall:
+                return LocalCall(self, entrypoint(*args, **kwargs).parameters)
+
+            return call
+        if name in self.interface.views:
+            view = self.interface.view[name]
+
+            def view_call(*args, **kwargs) -> LocalViewCall:
+                return LocalViewCall(self, name, view(*args, **kwargs).param_expr)
+
+            return view_call
+        raise AttributeError(name)
+
+    @property
+    def storage(self) -> ContractData:
+        chain = self.client.chain
+        context = LocalContext(chain, self.address)
+        storage = chain.program(self.address).storage.from_micheline_value(chain.storage(self.address))
+        storage.attach_context(context)
+        return ContractData(context, storage.item, title="storage")
+
+
+class LocalClient:
+    """The subset of `PyTezosClient` used by the test harness, bound to one key.
+
+    Nothing is signed, so the client can also be bound to a bare implicit
+    address and send operations as that account (tools/fork.py)."""
+
+    def __init__(self, chain: LocalChain, key: Union[str, Key]):
+        self.chain = chain
+        if isinstance(key, str) and is_implicit(key):
+            self.key, self.address = None, key
+        else:
+            self.key = key if isinstance(key, Key) else Key.from_encoded_key(key)
+            self.address = self.key.public_key_hash()
+
+    def using(self, key: Union[str, Key, None] = None, **kwargs) -> "LocalClient":
+        return LocalClient(self.chain, key or self.key or self.address)
+
+    def contract(self, address: str) -> LocalContract:
+        return LocalContract(self, address)
+
+    def account(self, address: str) -> dict:
+        account = self.chain.accounts.get(address, Account())
+        return {"balance": str(account.balance), "counter": str(account.counter)}
+
+    def origination(self, script: dict, balance: int = 0) -> LocalOperationGroup:
+        content = {"kind": "origination", "balance": str(balance), "script": script}
+        return LocalOperationGroup(self, [content])
+
+    def transaction(self, destination: str, amount: Union[int, Decimal] = 0) -> LocalOperationGroup:
+        content = {"kind": "transaction", "destination": destination, "amount": format_mutez(amount)}
+        return LocalOperationGroup(self, [content])
+
+    def register_global_constant(self, value: dict) -> LocalOperationGroup:
+        return LocalOperationGroup(self, [{"kind": "register_global_constant", "value": value}])
+
+    def bulk(self, *operations: Union[LocalOperationGroup, LocalCall]) -> LocalOperationGroup:
+        contents: List[dict] = []
+        for operation in operations:
+            if isinstance(operation, LocalCall):
+                contents.append(operation.as_transaction())
+            else:
+                contents.extend(operation.contents)
+        return LocalOperationGroup(self, contents)
@@ -0,0 +1,333 @@
+"""Pipelined submission of operation groups.
+
+`group.send(min_confirmations=1)` reads the signer's counter, simulates,
+injects and then blocks until the group is included, so a setup of ten
+dependent groups takes ten blocks of the caller's time, and nothing can be
+forged while one waits. `Pipeline.submit` returns at once with a
+`Submission`; a background thread sends the groups and follows the blocks
+(`NodeSource`), and `Submission.wait()` blocks only where the caller needs
+a result:
+
+    with Pipeline(pytezos) as pipeline:
+        factory = pipeline.submit(pytezos.origination(script=factory_script))
+        tokens = [pipeline.submit(pytezos.origination(script=script)) for script in token_scripts]
+        factory_address = factory.wait().originated_contracts[0]
+
+A `Submission` has the `opg_hash` and `opg_result` of an `OperationGroup`
+sent with confirmations: its own contents, with metadata, once included,
+so `OperationResult.from_operation_group(submission.opg_result)` and
+`originated_contracts` work as before. `wait()` raises the `RpcError`
+`inject` would raise: a `MichelsonError` whose `args[0]["with"]` is the
+value a script failed with.
+
+Counters are tracked per source: the first group of a source reads its
+counter from the node, and every later one takes the next counters
+locally. At most `depth` groups per source are in flight. The default of
+one is the limit of the mempool since Jakarta (one manager operation per
+source and block); older protocols take deeper pipelines. With `merge`,
+the groups queued behind an in-flight group of the same source are sent as
+one group, up to `max_operation_data_length`, so a source still gets all
+of its queued operations into the next block. A failure then backtracks
+the whole merged group, and every submission in it fails with the errors
+of the group.
+
+A group is simulated for its gas and storage limits when its source has
+nothing in flight. If the simulation fails while other groups are in
+flight, it may depend on them, so the group is sent with the hard limits
+of the protocol and its receipt decides. Otherwise the simulation error
+is the submission's error, as with `send`. A group not included within
+`ttl` blocks is dropped. Its source then sends nothing more until its
+other groups are resolved, and reads its counter again.
+
+Any other error, such as a node that cannot be reached, stops the sending
+thread: every submission not yet resolved fails with it, and the pipeline
+is closed, so `submit` raises.
+
+On a `LocalClient` every group is applied when it is submitted
+(tools/local_chain.py).
+"""
+
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from pytezos.operation import DEFAULT_BURN_RESERVE, DEFAULT_GAS_RESERVE
+from pytezos.operation.forge import forge_operation
+from pytezos.operation.result import OperationResult
+from pytezos.rpc.node import RpcError
+
+from tools.indexer import NodeSource
+from tools.local_chain import LocalClient
+
+# branch and signature of a forged group
+GROUP_OVERHEAD = 32 + 64
+# room for the counter, fee and limits of a content forged with zeros
+CONTENT_MARGIN = 16
+UNFILLED = {"fee": "0", "counter": "0", "gas_limit": "0", "storage_limit": "0"}
+
+
+class Submission:
+    """An operation group submitted to a `Pipeline`."""
+
+    def __init__(self, client, group):
+        self.client = client
+        self.group = group
+        self.opg_hash: Optional[str] = None
+        self.opg_result: Optional[dict] = None
+        self.level: Optional[int] = None  # of the block that included it
+        self.error: Optional[Exception] = None
+        self._done = threading.Event()
+
+    @property
+    def source(self) -> str:
+        return self.client.key.public_key_hash() if self.client.key else self.client.address
+
+    @property
+    def originated_contracts(self) -> List[str]:
+        return [address for result in OperationResult.from_operation_group(self.opg_result)
+                for address in result.originated_contracts]
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> "Submission":
+        """Blocks until the group is included or has failed; raises its error."""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"operation {self.opg_hash} is still pending")
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def _resolve(self, opg_result: dict, level: Optional[int] = None) -> None:
+        self.opg_result, self.level = opg_result, level
+        if not OperationResult.is_applied(opg_result):
+            self.error = RpcError.from_errors(OperationResult.errors(opg_result))
+        self._done.set()
+
+    def _fail(self, error: Exception) -> None:
+        self.error = error
+        self._done.set()
+
+
+class _Account:
+    def __init__(self):
+        self.queue: Deque[Submission] = deque()
+        self.in_flight: List["_Sent"] = []
+        self.counter: Optional[int] = None  # last counter used
+        self.paused = False
+
+
+class _Sent:
+    def __init__(self, submissions: List[Submission], opg_hash: str, level: int):
+        self.submissions = submissions
+        self.opg_hash = opg_hash
+        self.level = level
+
+
+class Pipeline:
+    def __init__(self, client, depth: int = 1, merge: bool = True, ttl: int = 60, poll: float = 0.5,
+                 gas_reserve: int = DEFAULT_GAS_RESERVE, burn_reserve: int = DEFAULT_BURN_RESERVE):
+        self.client = client
+        self.depth = depth
+        self.merge = merge
+        self.ttl = ttl
+        self.poll = poll
+        self.gas_reserve = gas_reserve
+        self.burn_reserve = burn_reserve
+        self.local = isinstance(client, LocalClient)
+        self.submissions: List[Submission] = []
+        self._accounts: Dict[str, _Account] = {}
+        self._sent: Dict[str, _Sent] = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._error: Optional[Exception] = None
+        self._thread: Optional[threading.Thread] = None
+        self._constants: Optional[dict] = None
+        if not self.local:
+            self.node = NodeSource(client.shell)
+            self._level = self.node.head_level()
+
+    def __enter__(self) -> "Pipeline":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def submit(self, *operations, client=None) -> Submission:
+        """Queues `operations` (groups or contract calls) as one group signed
+        by `client`, the pipeline's client by default."""
+        client = client or self.client
+        submission = Submission(client, client.bulk(*operations))
+        if self.local:
+            self.submissions.append(submission)
+            try:
+                submission._resolve(submission.group.send().opg_result, self.client.chain.level)
+            except RpcError as e:
+                submission._fail(e)
+            return submission
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("the pipeline is closed") from self._error
+            self.submissions.append(submission)
+            self._accounts.setdefault(submission.source, _Account()).queue.append(submission)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return submission
+
+    def wait(self) -> List[Submission]:
+        """Waits for every submission so far; raises the first error."""
+        for submission in list(self.submissions):
+            submission.wait()
+        return self.submissions
+
+    def close(self) -> None:
+        """Sends what is queued, waits for it and stops the thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    # sending -----------------------------------------------------------------
+
+    def _run(self) -> None:
+        try:
+            self._loop()
+        except Exception as e:
+            self._abort(e)
+
+    def _abort(self, error: Exception) -> None:
+        """Fails every pending submission with `error`, which stopped the
+        thread, and closes the pipeline."""
+        with self._cond:
+            self._closed = True
+            self._error = error
+            for account in self._accounts.values():
+                account.queue.clear()
+                account.in_flight.clear()
+            self._sent.clear()
+            pending = [submission for submission in self.submissions if not submission.done()]
+            self._cond.notify_all()
+        for submission in pending:
+            submission._fail(error)
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._sendable() and not self._sent and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._sent and not any(a.queue for a in self._accounts.values()):
+                    return
+                ready = [a for a in self._accounts.values()
+                         if a.queue and not a.paused and len(a.in_flight) < self.depth]
+            for account in ready:
+                self._send(account)
+            if self._sent:
+                self._follow()
+                with self._cond:
+                    self._cond.wait(self.poll)
+
+    def _sendable(self) -> bool:
+        return any(a.queue and not a.paused and len(a.in_flight) < self.depth for a in self._accounts.values())
+
+    def _hard_limits(self) -> dict:
+        if self._constants is None:
+            self._constants = self.client.shell.head.context.constants()
+        return self._constants
+
+    def _take(self, account: _Account, merge: bool) -> List[Submission]:
+        """The queued submissions of `account` to send as the next group."""
+        with self._cond:
+            batch = [account.queue.popleft()]
+            if not merge:
+                return batch
+            limit = int(self._hard_limits().get("max_operation_data_length", 32768)) - GROUP_OVERHEAD
+            size = self._size(batch[0])
+            while account.queue and size + self._size(account.queue[0]) <= limit:
+                size += self._size(account.queue[0])
+                batch.append(account.queue.popleft())
+            return batch
+
+    @staticmethod
+    def _size(submission: Submission) -> int:
+        return sum(len(forge_operation({**UNFILLED, **content, "source": submission.source})) + CONTENT_MARGIN
+                   for content in submission.group.contents)
+
+    def _send(self, account: _Account, merge: Optional[bool] = None) -> None:
+        batch = self._take(account, self.merge if merge is None else merge)
+        first = batch[0]
+        group = first.client.bulk(*[submission.group for submission in batch])
+        try:
+            if account.counter is None:
+                account.counter = int(first.client.shell.head.context.contracts[first.source].counter())
+            counter = account.counter + 1
+            opg = None
+            if not account.in_flight:
+                try:
+                    opg = group.autofill(gas_reserve=self.gas_reserve, burn_reserve=self.burn_reserve,
+                                         counter=counter, ttl=self.ttl)
+                except RpcError:
+                    if len(batch) > 1:
+                        # simulate the groups one by one, so that only the failing one fails
+                        with self._cond:
+                            account.queue.extendleft(reversed(batch))
+                        return self._send(account, merge=False)
+                    if not self._sent:
+                        raise
+            if opg is None:
+                constants = self._hard_limits()
+                opg = group.fill(counter=counter, ttl=self.ttl,
+                                 gas_limit=int(constants["hard_gas_limit_per_operation"]),
+                                 storage_limit=int(constants["hard_storage_limit_per_operation"]))
+            level = self.node.head_level()
+            opg_hash = opg.sign().inject(min_confirmations=0, prevalidate=not account.in_flight)["hash"]
+        except RpcError as e:
+            account.counter = None
+            for submission in batch:
+                submission._fail(e)
+            return
+        account.counter += len(opg.contents)
+        sent = _Sent(batch, opg_hash, level)
+        for submission in batch:
+            submission.opg_hash = opg_hash
+        with self._cond:
+            account.in_flight.append(sent)
+            self._sent[opg_hash] = sent
+
+    # tracking ----------------------------------------------------------------
+
+    def _follow(self) -> None:
+        """Resolves the groups included in the blocks since the last call,
+        and drops those older than `ttl` blocks."""
+        head = self.node.head_level()
+        for level in range(self._level + 1, head + 1):
+            for group in self.node.block(level)["operations"][-1]:
+                sent = self._sent.get(group["hash"])
+                if sent is not None:
+                    start = 0
+                    for submission in sent.submissions:
+                        end = start + len(submission.group.contents)
+                        result = {**group, "contents": group["contents"][start:end]}
+                        if not OperationResult.is_applied(group):
+                            # a merged group fails as a whole
+                            result["contents"] = group["contents"]
+                        submission._resolve(result, level)
+                        start = end
+                    self._finish(sent, dropped=False)
+        self._level = head
+        for sent in [sent for sent in self._sent.values() if head - sent.level > self.ttl]:
+            for submission in sent.submissions:
+                submission._fail(RpcError(f"operation {sent.opg_hash} was not included within {self.ttl} blocks"))
+            self._finish(sent, dropped=True)
+
+    def _finish(self, sent: _Sent, dropped: bool) -> None:
+        with self._cond:
+            del self._sent[sent.opg_hash]
+            account = self._accounts[sent.submissions[0].source]
+            account.in_flight.remove(sent)
+            account.paused = account.paused or dropped
+            if account.paused and not account.in_flight:
+                account.paused, account.counter = False, None
+            self._cond.notify_all()
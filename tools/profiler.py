@@ -0,0 +1,276 @@
+"""Instruction profiles of contract calls in the in-process chain.
+
+The benchmark (tests/test_benchmark.py) tells how many instructions a call
+executes, not which ones. `Profiler` patches a `LocalChain` and the
+interpreter's sequence execution while it is active, and attributes every
+executed instruction to its call stack:
+
+    contract%entrypoint (ligo function)   one frame per contract call
+      prologue (ligo functions)          what main runs before its match
+      ITER / MAP / LOOP / LOOP_LEFT      loop bodies
+      EXEC / VIEW get_balance            lambdas and on-chain views
+        instruction                       e.g. "CONTRACT %transfer (token_transfer)", "UPDATE big_map"
+
+Branches (IF, IF_LEFT, ...) get no frame of their own, so the entrypoint
+dispatch of a contract does not bury its instructions. Each frame holds two
+metrics: `instructions`, one per executed instruction, and `time`, the
+interpreter's wall time in nanoseconds, so `instructions` adds up to the
+`executed_instructions` of the calls, which the benchmark reports. The
+interpreter does not meter gas, so these stand in for it.
+`time` also has the `[decode and encode]` leaf of each call: decoding the
+parameter and storage before the code runs, and encoding the storage, big_map
+diffs and operations after it.
+
+Contract code inlines every LIGO function, so `ligo_map` recovers what it
+can from the source:
+- the function `main` calls for each entrypoint;
+- the functions main calls before its match;
+- the functions that emit each `CONTRACT %entrypoint`, `SELF %entrypoint` and `VIEW`.
+
+    profiler = Profiler(chain, names={code_hash: "dex_fa12"}, sources={code_hash: ligo_map("dex.mligo")})
+    with profiler:
+        swap.xtzToToken(...).send()
+    profiler.write_collapsed("xtzToToken.folded")  # for flamegraph.pl or speedscope
+    profiler.table()  # [(instruction, instructions, share), ...]
+
+`python -m tools.profiler` profiles the dex entrypoints on the pool of a
+fuzz case (tools/fuzz.py).
+"""
+
+import os
+import re
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from pytezos.michelson.micheline import MichelineLiteral, MichelineSequence
+from pytezos.michelson.types import BigMapType
+
+METRICS = ("instructions", "time")
+LOOPS = {"ITER", "MAP", "LOOP", "LOOP_LEFT"}
+CALLS = {"EXEC", "VIEW"}
+# the stack position of the collection each instruction reads or writes
+COLLECTIONS = {"GET": 1, "MEM": 1, "UPDATE": 2, "GET_AND_UPDATE": 2}
+DECODE_AND_ENCODE = "[decode and encode]"
+
+
+class LigoMap(NamedTuple):
+    entrypoints: Dict[str, str]  # entrypoint -> the function main calls for it
+    prologue: Tuple[str, ...]  # functions main calls before its match
+    instructions: Dict[str, Tuple[str, ...]]  # instruction label -> the functions that emit it
+
+
+def _read_ligo(path: str) -> str:
+    """The text of `path` with its `#include`s inlined."""
+    with open(path) as f:
+        text = f.read()
+
+    def include(match):
+        return _read_ligo(os.path.join(os.path.dirname(path), match.group(1)))
+
+    return re.sub(r'^#include "([^"]+)"', include, text, flags=re.M)
+
+
+def ligo_map(path: str) -> LigoMap:
+    """What the CameLIGO contract at `path` tells about its compiled code."""
+    text = _read_ligo(path)
+    starts = [(match.start(), match.group(1)) for match in re.finditer(r"^let (?:rec )?(\w+)", text, flags=re.M)]
+    bodies = {name: text[start:end] for (start, name), (end, _) in zip(starts, starts[1:] + [(len(text), None)])}
+    main = bodies.get("main", "")
+    head, _, cases = main.partition("match ")
+    entrypoints = {
+        constructor[0].lower() + constructor[1:]: function
+        for constructor, function in re.findall(r"\|\s*(\w+)(?:\s+\w+)?\s*->\s*\(?\s*(\w+)", cases)
+    }
+    prologue = tuple(name for name in re.findall(r"=\s*(\w+)\s+\w+\s+in\b", head) if name in bodies)
+    instructions: Dict[str, Tuple[str, ...]] = {}
+    anchors = [(r'get_entrypoint_opt\s+"%(\w+)"', "CONTRACT %{}"), (r'Tezos\.self\s+"%(\w+)"', "SELF %{}"),
+               (r'Tezos\.call_view\s+"(\w+)"', "VIEW {}")]
+    for name, body in bodies.items():
+        for pattern, label in anchors:
+            for found in re.findall(pattern, body):
+                functions = instructions.get(label.format(found), ())
+                if name not in functions:
+                    instructions[label.format(found)] = functions + (name,)
+    return LigoMap(entrypoints, prologue, instructions)
+
+
+class _Call:
+    def __init__(self, frame: str, ligo: Optional[LigoMap]):
+        self.frame = frame
+        self.ligo = ligo
+        self.depth = 0  # of the stack below the call frame
+        self.dispatched = False  # past the prologue
+
+
+class Profiler:
+    """Collects the instruction profile of the calls `chain` runs while the
+    profiler is active. `names` and `sources` give the contract name and the
+    `LigoMap` of code hashes; other contracts are named by address."""
+
+    def __init__(self, chain, names: Optional[Dict[str, str]] = None, sources: Optional[Dict[str, LigoMap]] = None):
+        self.chain = chain
+        self.names = names or {}
+        self.sources = sources or {}
+        self.samples: Dict[Tuple[str, ...], List[int]] = {}  # stack -> [instructions, nanoseconds]
+        self._stack: List[str] = []
+        self._children: List[int] = [0]  # nanoseconds spent in the frames below each frame
+        self._calls: List[_Call] = []
+        self._patched = None
+
+    def __enter__(self) -> "Profiler":
+        if "execute" in vars(self.chain):
+            raise RuntimeError("another profiler is active on this chain")
+        profiler = self
+
+        def sequence(cls, stack, stdout, context):
+            return cls([profiler._step(arg, stack, stdout, context) for arg in cls.args])
+
+        self._patched = MichelineSequence.__dict__["execute"]
+        MichelineSequence.execute = classmethod(sequence)
+        self.chain.execute = self._call
+        return self
+
+    def __exit__(self, *exc) -> None:
+        MichelineSequence.execute = self._patched
+        del self.chain.execute
+
+    # collection --------------------------------------------------------------
+
+    def _call(self, address: str, entrypoint: str, parameter, storage, context):
+        key = self.chain.accounts[address].code_id
+        ligo = self.sources.get(key)
+        frame = f"{self.names.get(key, address)}%{entrypoint}"
+        function = ligo and ligo.entrypoints.get(entrypoint)
+        call = _Call(f"{frame} ({function})" if function else frame, ligo)
+        self._calls.append(call)
+        self._stack.append(call.frame)
+        self._children.append(0)
+        start = time.perf_counter_ns()
+        try:
+            return type(self.chain).execute(self.chain, address, entrypoint, parameter, storage, context)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self._add((*self._stack, DECODE_AND_ENCODE), 0, elapsed - self._children.pop())
+            self._stack.pop()
+            self._calls.pop()
+            self._children[-1] += elapsed
+
+    def _step(self, instruction, stack, stdout, context):
+        if issubclass(instruction, MichelineSequence) or not self._calls:
+            return instruction.execute(stack, stdout, context)
+        call = self._calls[-1]
+        frames = []
+        if call.depth == 0 and not call.dispatched:
+            if instruction.prim == "IF_LEFT":
+                call.dispatched = True
+            else:
+                prologue = call.ligo.prologue if call.ligo else ()
+                frames.append(f"prologue ({', '.join(prologue)})" if prologue else "prologue")
+        frames.append(self._label(instruction, stack, call.ligo))
+        self._stack.extend(frames)
+        self._children.append(0)
+        call.depth += 1
+        start = time.perf_counter_ns()
+        try:
+            return instruction.execute(stack, stdout, context)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            call.depth -= 1
+            self._add(tuple(self._stack), 1, elapsed - self._children.pop())
+            del self._stack[-len(frames):]
+            self._children[-1] += elapsed
+
+    def _add(self, stack: Tuple[str, ...], instructions: int, nanoseconds: int) -> None:
+        sample = self.samples.setdefault(stack, [0, 0])
+        sample[0] += instructions
+        sample[1] += nanoseconds
+
+    @staticmethod
+    def _label(instruction, stack, ligo: Optional[LigoMap]) -> str:
+        args = getattr(instruction, "args", [])
+        literals = [str(arg.literal) for arg in args if isinstance(arg, type) and issubclass(arg, MichelineLiteral)]
+        if instruction.prim == "VIEW":
+            literals = literals[:1]
+        elif len(literals) < len(args):
+            literals = []  # PUSH, NIL, LAMBDA...: the types and values are left out
+        label = " ".join([instruction.prim, *[f"%{name}" for name in getattr(instruction, "field_names", [])], *literals])
+        if instruction.prim in COLLECTIONS and not literals:
+            position = stack.protected + COLLECTIONS[instruction.prim]
+            if position < len(stack.items) and isinstance(stack.items[position], BigMapType):
+                label += " big_map"
+        functions = ligo and ligo.instructions.get(label)
+        return f"{label} ({', '.join(functions)})" if functions else label
+
+    # reports -----------------------------------------------------------------
+
+    def collapsed(self, metric: str = "instructions") -> List[str]:
+        """Stacks in the collapsed format of flamegraph.pl: frames joined by
+        ";", then the metric of the innermost frame."""
+        index = METRICS.index(metric)
+        folded: Dict[str, int] = {}
+        for stack, sample in self.samples.items():
+            # branches are dropped; the instruction stays the leaf
+            frames = [frame for i, frame in enumerate(stack)
+                      if i in (0, len(stack) - 1) or frame.startswith("prologue") or frame.split(" ")[0] in LOOPS | CALLS]
+            folded[";".join(frames)] = folded.get(";".join(frames), 0) + sample[index]
+        return [f"{frames} {value}" for frames, value in sorted(folded.items()) if value]
+
+    def write_collapsed(self, path: str, metric: str = "instructions") -> None:
+        with open(path, "w") as f:
+            f.writelines(line + "\n" for line in self.collapsed(metric))
+
+    def total(self, metric: str = "instructions") -> int:
+        index = METRICS.index(metric)
+        return sum(sample[index] for sample in self.samples.values())
+
+    def table(self, metric: str = "instructions", frames: Optional[Iterable[str]] = None) -> List[Tuple[str, int, float]]:
+        """(instruction, metric, share of the total) for every instruction
+        label, largest first, optionally within the stacks containing one of
+        `frames`."""
+        index = METRICS.index(metric)
+        frames = set(frames or ())
+        totals: Dict[str, int] = {}
+        for stack, sample in self.samples.items():
+            if frames and not frames & set(stack):
+                continue
+            totals[stack[-1]] = totals.get(stack[-1], 0) + sample[index]
+        total = sum(totals.values()) or 1
+        return sorted(((label, value, value / total) for label, value in totals.items() if value),
+                      key=lambda row: (-row[1], row[0]))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from tools.fuzz import ROOT, Case, Runner, Step
+
+    parser = argparse.ArgumentParser(description="Profile a dex entrypoint in the in-process chain.")
+    parser.add_argument("call", choices=["xtzToToken", "tokenToXtz", "addLiquidity", "removeLiquidity", "default",
+                                         "updateTokenPool"])
+    parser.add_argument("--build", choices=["fa12", "fa2"], default="fa12")
+    parser.add_argument("--amount", type=int, default=10 ** 6,
+                        help="tez sent, tokens sold or liquidity burned")
+    parser.add_argument("--metric", choices=METRICS, default="instructions")
+    parser.add_argument("--collapsed", help="write the collapsed stacks to this file")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    runner = Runner(args.build)
+    bounds = {"addLiquidity": (0, 2 ** 80), "removeLiquidity": (0, 0)}.get(args.call, (0,))
+    pool = 10 ** 12
+    runner.install(Case(args.build, pool, pool, pool, [(pool, pool, pool)], []))
+    chain = runner.chain
+    names = {chain.accounts[runner.pool].code_id: f"dex_{args.build}", chain.accounts[runner.lqt_address].code_id: "lqt_fa12",
+             chain.accounts[runner.token_address].code_id: "token"}
+    sources = {chain.accounts[runner.pool].code_id: ligo_map(os.path.join(ROOT, "dex.mligo")),
+               chain.accounts[runner.lqt_address].code_id: ligo_map(os.path.join(ROOT, "lqt_fa12.mligo"))}
+    profiler = Profiler(chain, names, sources)
+    with profiler:
+        error = runner.apply(Step(args.call, 0, args.amount, bounds))
+    if error:
+        raise SystemExit(f"{args.call} failed: {error}")
+    if args.collapsed:
+        profiler.write_collapsed(args.collapsed, args.metric)
+    print(f"{profiler.total(args.metric)} {args.metric}")
+    for label, value, share in profiler.table(args.metric)[:args.top]:
+        print(f"{value:>12} {share:6.1%}  {label}")
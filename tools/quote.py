@@ -0,0 +1,176 @@
+"""Batch quotes computed with the exact integer arithmetic of dex.mligo.
+
+Every function takes pool states and trade sizes as scalars or array-likes,
+broadcasts them against each other and returns NumPy arrays, so one call
+quotes a whole grid of trade sizes or pools. Amounts are in the units the
+contract stores: mutez for tez, the token's smallest unit for tokens.
+
+Results are bit-for-bit those of the contract: divisions are the
+truncating `nat` divisions of Michelson and `ceildiv` rounds up as in
+`add_liquidity`. Arrays are computed as int64 while every intermediate
+product fits, and as Python integers (object arrays) otherwise, so pools
+above 2**63 are quoted exactly.
+
+`slippage` is a tolerance in basis points used to derive the minimum-out
+parameter (`minTokensBought`, `minXtzBought`, ...) to send with the trade.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+
+FEE = 9972  # out of FEE_DENOMINATOR, kept by the pool on every swap
+RESERVE_FEE = 3  # out of FEE_DENOMINATOR, paid to the reserve on every swap
+FEE_DENOMINATOR = 10000
+INT64_MAX = np.iinfo(np.int64).max
+
+
+class XtzToTokenQuote(NamedTuple):
+    tokens_bought: np.ndarray
+    reserve_fee: np.ndarray
+    xtz_pool: np.ndarray
+    token_pool: np.ndarray
+    xtz_volume: np.ndarray
+    min_tokens_bought: np.ndarray
+
+
+class TokenToXtzQuote(NamedTuple):
+    xtz_bought: np.ndarray
+    reserve_fee: np.ndarray
+    xtz_pool: np.ndarray
+    token_pool: np.ndarray
+    xtz_volume: np.ndarray
+    min_xtz_bought: np.ndarray
+
+
+class TokenToTokenQuote(NamedTuple):
+    sold: TokenToXtzQuote
+    bought: XtzToTokenQuote
+    tokens_bought: np.ndarray
+    reserve_fee: np.ndarray
+    min_tokens_bought: np.ndarray
+
+
+class AddLiquidityQuote(NamedTuple):
+    lqt_minted: np.ndarray
+    tokens_deposited: np.ndarray
+    xtz_pool: np.ndarray
+    token_pool: np.ndarray
+    lqt_total: np.ndarray
+    min_lqt_minted: np.ndarray
+
+
+class RemoveLiquidityQuote(NamedTuple):
+    xtz_withdrawn: np.ndarray
+    tokens_withdrawn: np.ndarray
+    xtz_pool: np.ndarray
+    token_pool: np.ndarray
+    lqt_total: np.ndarray
+    min_xtz_withdrawn: np.ndarray
+    min_tokens_withdrawn: np.ndarray
+
+
+def _nat(value) -> np.ndarray:
+    array = np.asarray(value)
+    if array.dtype.kind not in "iuO":
+        raise TypeError(f"expected integers, got {array.dtype}")
+    if array.size and array.min() < 0:
+        raise ValueError("amounts must be natural numbers")
+    return array
+
+
+def _operands(*values):
+    """Broadcasts `values` to int64 arrays, or to Python integers when some
+    intermediate product could overflow.
+
+    Every formula multiplies at most two operands and a constant below
+    FEE_DENOMINATOR, then adds two such products."""
+    arrays = np.broadcast_arrays(*map(_nat, values))
+    largest = max((int(array.max()) for array in arrays if array.size), default=0)
+    if 2 * FEE_DENOMINATOR * largest * largest <= INT64_MAX:
+        return [array.astype(np.int64) for array in arrays]
+    return [array.astype(object) for array in arrays]
+
+
+def ceildiv(numerator, denominator):
+    return -(-numerator // denominator)
+
+
+def min_out(amount, slippage=0):
+    """Smallest amount accepted when `amount` may slip by `slippage` basis points."""
+    amount, slippage = _operands(amount, slippage)
+    return amount * (FEE_DENOMINATOR - slippage) // FEE_DENOMINATOR
+
+
+def xtz_to_token(xtz_pool, token_pool, xtz_sold, slippage=0) -> XtzToTokenQuote:
+    xtz_pool, token_pool, xtz_sold = _operands(xtz_pool, token_pool, xtz_sold)
+    tokens_bought = (xtz_sold * FEE * token_pool) // (xtz_pool * FEE_DENOMINATOR + xtz_sold * FEE)
+    reserve_fee = xtz_sold * RESERVE_FEE // FEE_DENOMINATOR
+    return XtzToTokenQuote(
+        tokens_bought=tokens_bought,
+        reserve_fee=reserve_fee,
+        xtz_pool=xtz_pool + xtz_sold - reserve_fee,
+        token_pool=token_pool - tokens_bought,
+        xtz_volume=xtz_sold,
+        min_tokens_bought=min_out(tokens_bought, slippage),
+    )
+
+
+def token_to_xtz(xtz_pool, token_pool, tokens_sold, slippage=0) -> TokenToXtzQuote:
+    xtz_pool, token_pool, tokens_sold = _operands(xtz_pool, token_pool, tokens_sold)
+    xtz_bought = (tokens_sold * FEE * xtz_pool) // (token_pool * FEE_DENOMINATOR + tokens_sold * FEE)
+    reserve_fee = (tokens_sold * RESERVE_FEE * xtz_pool) // (token_pool * FEE_DENOMINATOR + tokens_sold * RESERVE_FEE)
+    return TokenToXtzQuote(
+        xtz_bought=xtz_bought,
+        reserve_fee=reserve_fee,
+        xtz_pool=xtz_pool - xtz_bought - reserve_fee,
+        token_pool=token_pool + tokens_sold,
+        xtz_volume=(tokens_sold * xtz_pool) // (token_pool + tokens_sold),
+        min_xtz_bought=min_out(xtz_bought, slippage),
+    )
+
+
+def token_to_token(xtz_pool_in, token_pool_in, xtz_pool_out, token_pool_out, tokens_sold,
+                   slippage=0) -> TokenToTokenQuote:
+    """`tokenToToken` on the input pool followed by the `xtzToToken` it sends
+    to the output pool with the tez bought."""
+    sold = token_to_xtz(xtz_pool_in, token_pool_in, tokens_sold)
+    bought = xtz_to_token(xtz_pool_out, token_pool_out, sold.xtz_bought)
+    return TokenToTokenQuote(
+        sold=sold,
+        bought=bought,
+        tokens_bought=bought.tokens_bought,
+        reserve_fee=sold.reserve_fee + bought.reserve_fee,
+        min_tokens_bought=min_out(bought.tokens_bought, slippage),
+    )
+
+
+def add_liquidity(xtz_pool, token_pool, lqt_total, xtz_deposited, slippage=0) -> AddLiquidityQuote:
+    """`maxTokensDeposited` must be at least `tokens_deposited`."""
+    xtz_pool, token_pool, lqt_total, xtz_deposited = _operands(xtz_pool, token_pool, lqt_total, xtz_deposited)
+    lqt_minted = xtz_deposited * lqt_total // xtz_pool
+    tokens_deposited = ceildiv(xtz_deposited * token_pool, xtz_pool)
+    return AddLiquidityQuote(
+        lqt_minted=lqt_minted,
+        tokens_deposited=tokens_deposited,
+        xtz_pool=xtz_pool + xtz_deposited,
+        token_pool=token_pool + tokens_deposited,
+        lqt_total=lqt_total + lqt_minted,
+        min_lqt_minted=min_out(lqt_minted, slippage),
+    )
+
+
+def remove_liquidity(xtz_pool, token_pool, lqt_total, lqt_burned, slippage=0) -> RemoveLiquidityQuote:
+    xtz_pool, token_pool, lqt_total, lqt_burned = _operands(xtz_pool, token_pool, lqt_total, lqt_burned)
+    xtz_withdrawn = lqt_burned * xtz_pool // lqt_total
+    tokens_withdrawn = lqt_burned * token_pool // lqt_total
+    return RemoveLiquidityQuote(
+        xtz_withdrawn=xtz_withdrawn,
+        tokens_withdrawn=tokens_withdrawn,
+        xtz_pool=xtz_pool - xtz_withdrawn,
+        token_pool=token_pool - tokens_withdrawn,
+        lqt_total=lqt_total - lqt_burned,
+        min_xtz_withdrawn=min_out(xtz_withdrawn, slippage),
+        min_tokens_withdrawn=min_out(tokens_withdrawn, slippage),
+    )
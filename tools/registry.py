@@ -0,0 +1,236 @@
+"""Registry of the pools of dex factories, cached on disk.
+
+Finding the pools of a factory means reading `swaps[0 .. counter - 1]` one
+big_map entry at a time and then the storage of every pool: minutes for a
+few hundred pools, paid again by every router and dashboard process.
+`PoolRegistry` keeps the pools of some factories in one JSON file, each
+with its token, liquidity token, `tokenPool`, `xtzPool`, `lqtTotal` and
+`reserve`, all as of one level. `refresh` brings it up to the head of a
+node (`NodeSource`) or of a `LocalChain`:
+
+- from the blocks since that level, as tools/indexer.py reads them: the
+  storage left by every applied call to a pool, and the `swaps` updates of
+  the factory calls, whose pools are originated in the same operation;
+- or, when more than `max_blocks` blocks have passed or a factory is new,
+  from the head: the entries of `swaps` from the saved `counter` to the
+  current one, then the storage of every pool at that block
+  (tools/snapshot.py).
+
+Both read only what changed. `snapshot` is a `Registry`, replaced as a
+whole by `refresh`, and the file is replaced in one step, so readers in
+this process or another one always see every pool at one level:
+
+    registry = PoolRegistry("pools.json", NodeSource(pytezos.shell), [factory])
+    registry.refresh()
+    pool, = registry.snapshot.tokens[(token, None)]
+    pool.xtz_pool, pool.lqt_address
+
+`PoolRegistry("pools.json")` without a source only reads the file. Tokens
+are `(address, token_id)` pairs with a `None` token id for FA1.2 tokens,
+as in tools/router.py.
+"""
+
+import json
+import os
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from tools.indexer import _Decoder, factory_pools
+from tools.snapshot import StorageReader, pin
+
+Token = Tuple[str, Optional[int]]
+
+
+class PoolEntry(NamedTuple):
+    address: str
+    factory: str
+    index: int  # in the factory's swaps
+    token: Token
+    lqt_address: str
+    token_pool: int
+    xtz_pool: int
+    lqt_total: int
+    reserve: str
+
+
+class Registry:
+    """The pools of a `PoolRegistry` at one level; not to be modified."""
+
+    def __init__(self, level: Optional[int], counters: Dict[str, Optional[int]], pools: Dict[str, PoolEntry]):
+        self.level = level
+        self.counters = counters  # factory -> its counter, None before the first read
+        self.pools = pools  # by address
+        self.tokens: Dict[Token, Tuple[PoolEntry, ...]] = {}
+        for pool in sorted(pools.values(), key=lambda pool: (pool.factory, pool.index)):
+            self.tokens[pool.token] = self.tokens.get(pool.token, ()) + (pool,)
+
+    def __getitem__(self, address: str) -> PoolEntry:
+        return self.pools[address]
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.pools
+
+    def __len__(self) -> int:
+        return len(self.pools)
+
+
+def _entry(address: str, factory: str, index: int, storage: dict) -> PoolEntry:
+    return PoolEntry(address, factory, index, (storage["tokenAddress"], storage.get("tokenId")), storage["lqtAddress"],
+                     storage["tokenPool"], storage["xtzPool"], storage["lqtTotal"], storage["reserve"])
+
+
+class PoolRegistry:
+    """The pools of `factories` (and of those already in the file at `path`)
+    read from `source`; levels newer than `head - confirmations` are left for
+    the next `refresh`."""
+
+    def __init__(self, path: str, source=None, factories: Iterable[str] = (), confirmations: int = 0,
+                 max_blocks: int = 1000):
+        self.path = path
+        self.source = source
+        self.confirmations = confirmations
+        self.max_blocks = max_blocks
+        self._decoders: Dict[str, _Decoder] = {}  # by address
+        self.snapshot = self._load()
+        new = [factory for factory in factories if factory not in self.snapshot.counters]
+        if new:
+            counters = {**self.snapshot.counters, **{factory: None for factory in new}}
+            self.snapshot = Registry(self.snapshot.level, counters, self.snapshot.pools)
+
+    def refresh(self) -> Registry:
+        """Reads what changed since the saved level and saves the registry."""
+        if self.source is None:
+            raise ValueError("the registry has no source to refresh from")
+        head = self.source.head_level() - self.confirmations
+        level = self.snapshot.level
+        if level is not None and level >= head:
+            return self.snapshot
+        if level is None or head - level > self.max_blocks or None in self.snapshot.counters.values():
+            self.snapshot = self._read_head()
+        else:
+            self.snapshot = self._read_blocks(level + 1, head)
+        self._save()
+        return self.snapshot
+
+    # file --------------------------------------------------------------------
+
+    def _load(self) -> Registry:
+        if not os.path.exists(self.path):
+            return Registry(None, {}, {})
+        with open(self.path) as f:
+            saved = json.load(f)
+        pools = {}
+        for pool in saved["pools"]:
+            pool = PoolEntry(**{**pool, "token": tuple(pool["token"])})
+            pools[pool.address] = pool
+        return Registry(saved["level"], saved["counters"], pools)
+
+    def _save(self) -> None:
+        saved = {
+            "level": self.snapshot.level,
+            "counters": self.snapshot.counters,
+            "pools": [pool._asdict() for pool in sorted(self.snapshot.pools.values(),
+                                                        key=lambda pool: (pool.factory, pool.index))],
+        }
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(saved, f)
+        os.replace(tmp, self.path)
+
+    # head --------------------------------------------------------------------
+
+    def _read_head(self) -> Registry:
+        """The new pools from `swaps[counter ..]` and every pool's storage, at
+        one block."""
+        source, header = pin(self.source)
+        indices = {address: (pool.factory, pool.index) for address, pool in self.snapshot.pools.items()}
+        counters = {}
+        for factory, counter in self.snapshot.counters.items():
+            start = counter or 0
+            addresses = factory_pools(source, factory, start)
+            indices.update({address: (factory, start + i) for i, address in enumerate(addresses)})
+            counters[factory] = start + len(addresses)
+        snapshot = StorageReader(source).read(indices)
+        pools = {}
+        for address, (factory, index) in indices.items():
+            storage = snapshot[address]
+            pools[address] = PoolEntry(address, factory, index, (storage.token_address, storage.token_id),
+                                       storage.lqt_address, storage.token_pool, storage.xtz_pool,
+                                       storage.lqt_total, storage.reserve)
+        return Registry(int(header["level"]), counters, pools)
+
+    # blocks ------------------------------------------------------------------
+
+    def _read_blocks(self, start: int, end: int) -> Registry:
+        counters = dict(self.snapshot.counters)
+        pools = dict(self.snapshot.pools)
+        launched: Dict[str, Tuple[str, int]] = {}  # address -> (factory, index), until originated
+        for level in range(start, end + 1):
+            for group in self.source.block(level)["operations"][-1]:
+                for content in group["contents"]:
+                    metadata = content.get("metadata", {})
+                    if "operation_result" not in metadata:
+                        continue
+                    self._apply(content, metadata["operation_result"], counters, pools, launched)
+                    for internal in metadata.get("internal_operation_results", []):
+                        self._apply(internal, internal["result"], counters, pools, launched)
+        if launched:
+            raise ValueError(f"the originations of {sorted(launched)} were not found")
+        return Registry(end, counters, pools)
+
+    def _decoder(self, address: str, code: Optional[List[dict]] = None) -> _Decoder:
+        if address not in self._decoders:
+            self._decoders[address] = _Decoder(code or self.source.code(address))
+        return self._decoders[address]
+
+    def _apply(self, op: dict, result: dict, counters: Dict[str, int], pools: Dict[str, PoolEntry],
+               launched: Dict[str, Tuple[str, int]]) -> None:
+        if result.get("status") != "applied":
+            return
+        if op["kind"] == "transaction" and op["destination"] in counters:
+            decoder = self._decoder(op["destination"])
+            storage = decoder.storage(result["storage"])
+            counters[op["destination"]] = storage["counter"]
+            for index, address in decoder.updates(result.get("lazy_storage_diff"), storage, "swaps"):
+                if address is not None:
+                    launched[address] = (op["destination"], index)
+        elif op["kind"] == "origination":
+            for address in result.get("originated_contracts", []):
+                if address in launched:
+                    factory, index = launched.pop(address)
+                    storage = self._decoder(address, op["script"]["code"]).storage(op["script"]["storage"])
+                    pools[address] = _entry(address, factory, index, storage)
+        elif op["kind"] == "transaction" and op["destination"] in pools:
+            pool = pools[op["destination"]]
+            storage = self._decoder(pool.address).storage(result["storage"])
+            pools[pool.address] = _entry(pool.address, pool.factory, pool.index, storage)
+
+
+def read_registry(path: str) -> Registry:
+    """The registry saved at `path`."""
+    return PoolRegistry(path).snapshot
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from pytezos import pytezos
+
+    from tools.indexer import NodeSource
+
+    parser = argparse.ArgumentParser(description="Keep a registry of the pools of dex factories.")
+    parser.add_argument("path", help="registry file, refreshed when it exists")
+    parser.add_argument("--factory", action="append", default=[])
+    parser.add_argument("--shell", default="http://localhost:8732")
+    parser.add_argument("--confirmations", type=int, default=0)
+    parser.add_argument("--interval", type=float, default=0, help="refresh every INTERVAL seconds, 0 to refresh once")
+    args = parser.parse_args()
+
+    registry = PoolRegistry(args.path, NodeSource(pytezos.using(shell=args.shell).shell), args.factory,
+                            confirmations=args.confirmations)
+    while True:
+        snapshot = registry.refresh()
+        print(f"level {snapshot.level}: {len(snapshot)} pools")
+        if not args.interval:
+            break
+        time.sleep(args.interval)
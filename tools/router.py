@@ -0,0 +1,201 @@
+"""Order routing across the pools of dex factories.
+
+Every pool trades one token against tez, so an order between two tokens
+goes token -> tez -> token, and a token with pools in several factories can
+fill a part of the order in each of them. `Router` loads the pools of the
+factories (`swaps[0 .. counter - 1]`) and quotes the split of an order with
+the exact arithmetic of `tools.quote`:
+
+- the tez sold for a token are split across the pools of that token so that
+  the marginal price is the same in every pool used (the closed form of the
+  constant product with the 0.28% fee), floored to mutez and kept only if
+  it beats the best single pool under the exact integer quote;
+- the tokens sold for tez are split across the pools of the input token in
+  the same way.
+
+`Route.operations` builds the calls of a single operation group: one
+`tokenToXtz` per input pool paying the trader, then one `xtzToTokenRoute`
+call to the first output pool, which swaps its share and forwards the rest
+of the tez along the `legs` of the route; the last leg checks
+`minTokensBought` against the tokens bought by the whole route, so the
+route fails or fills as a whole:
+
+    router = Router.from_factories(NodeSource(pytezos.shell), [factory_fa12, factory_fa2])
+    route = router.quote((token, None), (other_token, 0), 10 ** 6, slippage=50)
+    pytezos.bulk(*route.operations(pytezos, trader, deadline)).send()
+
+`Router.from_registry` takes the pools of a saved registry instead
+(tools/registry.py).
+
+Tokens are `(address, token_id)` pairs with a `None` token id for FA1.2
+tokens, and `XTZ` stands for tez. The sales of a token to token route ask
+for exactly the quoted tez (`minXtzBought`), which the route then spends,
+so the trader never pays tez of their own; the slippage tolerance applies to
+the tokens bought.
+"""
+
+import math
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from tools import quote
+from tools.indexer import factory_pools
+from tools.interfaces import default_cache
+from tools.snapshot import read_snapshot
+
+Token = Optional[Tuple[str, Optional[int]]]
+XTZ: Token = None
+
+
+class Pool(NamedTuple):
+    address: str
+    token: Tuple[str, Optional[int]]
+    xtz_pool: int
+    token_pool: int
+
+
+class Leg(NamedTuple):
+    pool: str
+    amount_in: int
+    amount_out: int
+
+
+class Route(NamedTuple):
+    token_in: Token
+    token_out: Token
+    sells: List[Leg]  # tokens sold for tez, per pool of token_in
+    buys: List[Leg]  # tez sold for tokens, per pool of token_out
+    amount_in: int
+    amount_out: int
+    min_out: int
+    slippage: int
+
+    def operations(self, client, trader: str, deadline, to: Optional[str] = None) -> list:
+        """The calls of the route, to send in one group signed by `trader`,
+        who sells the input and receives the tez of the sales. The output
+        goes to `to`, the trader by default."""
+        to = to or trader
+        interfaces = default_cache()
+        calls = []
+        for leg in self.sells:
+            min_xtz_bought = leg.amount_out if self.buys else int(quote.min_out(leg.amount_out, self.slippage))
+            calls.append(interfaces.contract(client, leg.pool).tokenToXtz({
+                "to": trader if self.buys else to,
+                "tokensSold": leg.amount_in,
+                "minXtzBought": min_xtz_bought,
+                "deadline": deadline,
+            }))
+        if self.buys:
+            first, *next_legs = self.buys
+            calls.append(interfaces.contract(client, first.pool).xtzToTokenRoute({
+                "to": to,
+                "minTokensBought": self.min_out,
+                "tokensBought": 0,
+                "legs": [(leg.pool, leg.amount_in) for leg in next_legs],
+                "deadline": deadline,
+            }).with_amount(sum(leg.amount_in for leg in self.buys)))
+        return calls
+
+
+def split(amount: int, reserves_in: Sequence[int], reserves_out: Sequence[int]) -> np.ndarray:
+    """Integer amounts summing to `amount` that maximize the total output of
+    the swaps `out = FEE * r_out * a / (FEE_DENOMINATOR * r_in + FEE * a)`.
+
+    At the optimum the marginal output is the same in every pool that gets
+    a share, which gives `a_j = (s * g_j - FEE_DENOMINATOR * r_in_j) / FEE`
+    with `g_j = sqrt(FEE * FEE_DENOMINATOR * r_in_j * r_out_j)`; pools are
+    added by decreasing spot price while their share stays positive."""
+    fee, denominator = quote.FEE, quote.FEE_DENOMINATOR
+    g = [math.sqrt(fee * denominator * r_in * r_out) for r_in, r_out in zip(reserves_in, reserves_out)]
+    order = sorted(range(len(g)), key=lambda j: reserves_out[j] / reserves_in[j], reverse=True)
+    active: List[int] = []
+    scale = 0.0
+    for j in order:
+        candidate = active + [j]
+        s = (fee * amount + denominator * sum(reserves_in[k] for k in candidate)) / sum(g[k] for k in candidate)
+        if active and s * g[j] <= denominator * reserves_in[j]:
+            break
+        active, scale = candidate, s
+    amounts = np.zeros(len(g), dtype=object)
+    for j in active:
+        amounts[j] = max(0, int((scale * g[j] - denominator * reserves_in[j]) / fee))
+    amounts[max(active, key=lambda j: amounts[j])] += amount - sum(amounts)
+    return amounts
+
+
+class Router:
+    """Quotes orders across `pools`, grouped by token."""
+
+    def __init__(self, pools: Iterable[Pool]):
+        self.pools: Dict[Tuple[str, Optional[int]], List[Pool]] = {}
+        for pool in pools:
+            if pool.xtz_pool > 0 and pool.token_pool > 0:
+                self.pools.setdefault(pool.token, []).append(pool)
+
+    @classmethod
+    def from_factories(cls, source, factories: Iterable[str]) -> "Router":
+        """The pools of `factories` at the head of `source` (a `NodeSource`
+        or a `LocalChain`)."""
+        addresses = [address for factory in factories for address in factory_pools(source, factory)]
+        snapshot = read_snapshot(source, addresses)
+        pools = []
+        for address in addresses:
+            storage = snapshot[address]
+            pools.append(Pool(address, (storage.token_address, storage.token_id), storage.xtz_pool, storage.token_pool))
+        return cls(pools)
+
+    @classmethod
+    def from_registry(cls, registry) -> "Router":
+        """The pools of a `tools.registry.Registry`, without reading a node."""
+        return cls(Pool(pool.address, pool.token, pool.xtz_pool, pool.token_pool) for pool in registry.pools.values())
+
+    def quote(self, token_in: Token, token_out: Token, amount: int, slippage: int = 0) -> Route:
+        """Best route selling `amount` of `token_in` for `token_out`;
+        `slippage` in basis points sets the route's `min_out`."""
+        if token_in == token_out:
+            raise ValueError("the input and output tokens are the same")
+        sells: List[Leg] = []
+        xtz = amount
+        if token_in is not XTZ:
+            sells = self._fill(self._token_pools(token_in), amount, selling=True)
+            xtz = sum(leg.amount_out for leg in sells)
+        buys: List[Leg] = []
+        amount_out = xtz
+        if token_out is not XTZ:
+            buys = self._fill(self._token_pools(token_out), xtz, selling=False)
+            amount_out = sum(leg.amount_out for leg in buys)
+        return Route(token_in, token_out, sells, buys, amount, amount_out,
+                     int(quote.min_out(amount_out, slippage)), slippage)
+
+    def _token_pools(self, token) -> List[Pool]:
+        try:
+            return self.pools[token]
+        except KeyError:
+            raise ValueError(f"no pool trades {token}") from None
+
+    @staticmethod
+    def _fill(pools: List[Pool], amount: int, selling: bool) -> List[Leg]:
+        """Legs of the best of the split and of the best single pool under the exact quotes."""
+        xtz_pools = np.array([pool.xtz_pool for pool in pools], dtype=object)
+        token_pools = np.array([pool.token_pool for pool in pools], dtype=object)
+
+        def outputs(amounts):
+            if selling:
+                return quote.token_to_xtz(xtz_pools, token_pools, amounts).xtz_bought
+            return quote.xtz_to_token(xtz_pools, token_pools, amounts).tokens_bought
+
+        reserves_in, reserves_out = (token_pools, xtz_pools) if selling else (xtz_pools, token_pools)
+        amounts = split(amount, list(reserves_in), list(reserves_out))
+        bought = outputs(amounts)
+        single = outputs(np.full(len(pools), amount, dtype=object))
+        best = int(np.argmax(single))
+        if single[best] > sum(bought):
+            amounts = np.zeros(len(pools), dtype=object)
+            amounts[best] = amount
+            bought = outputs(amounts)
+        return [
+            Leg(pool.address, int(amount_in), int(amount_out))
+            for pool, amount_in, amount_out in sorted(zip(pools, amounts, bought), key=lambda leg: -leg[1])
+            if amount_in > 0
+        ]
@@ -0,0 +1,241 @@
+"""Typed storage snapshots of dex, factory and liquidity token contracts.
+
+`swap.storage["xtzPool"]()` costs one RPC call and one storage decode per
+field, and reading a big_map entry costs another pair, so a test or a
+monitor that checks a few fields of many pools issues dozens of requests per
+block, each possibly at a different head. `StorageReader.read` pins the
+block once, fetches every contract (balance, code and storage) with one
+request, fetches the requested big_map keys concurrently at that block,
+decodes each storage once with types cached by code hash, and returns a
+`Snapshot` of typed storage:
+
+    reader = StorageReader(NodeSource(pytezos.shell))
+    snapshot = reader.read([pool, factory, lqt], keys={"user_investments": [trader], "tokens": [trader]})
+    snapshot[pool].xtz_pool, snapshot[pool].user_investments[trader].xtz, snapshot.balances[pool]
+
+Dex, factory and `lqt_fa12` storage decode to `DexStorage`,
+`FactoryStorage` and `LqtStorage`, with the fields in snake case; any other
+contract's storage is returned as the Python object pytezos decodes.
+Big_maps are `BigMap`s holding the entries read for the keys of `keys`
+(by field name, tried on every contract with a big_map of that name).
+Fields a contract predates are None: pools of the first dex contracts have
+no `xtz_volume` but a `history` big_map (`keys={"history": ["xtzVolume"]}`).
+
+The source is a `NodeSource` (or any source with `header` and `at`), read
+at the block it was made for (`NodeSource.at(level)` reads a past block),
+or a `LocalChain`, read at its head.
+"""
+
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from pytezos.michelson.forge import forge_script_expr
+
+from tools.indexer import INVESTMENT_DIRECTIONS, _Decoder
+from tools.local_chain import code_hash
+
+
+class BigMap(dict):
+    """The entries of the big_map `ptr` read for a snapshot, by key."""
+
+    def __init__(self, ptr: int, entries=()):
+        super().__init__(entries)
+        self.ptr = ptr
+
+
+class Investment(NamedTuple):
+    xtz: int
+    token: int
+    direction: int  # +1 for ADD, -1 for REMOVE
+
+
+class Position(NamedTuple):
+    xtz_deposited: int
+    tokens_deposited: int
+    xtz_withdrawn: int
+    tokens_withdrawn: int
+    lqt: int  # minted by the deposits and not burned since
+    xtz_cost: int  # of `lqt`
+    token_cost: int
+
+
+class DexStorage(NamedTuple):
+    token_pool: int
+    xtz_pool: int
+    lqt_total: int
+    self_is_updating_token_pool: bool
+    freeze_baker: bool
+    manager: str
+    token_address: str
+    token_id: Optional[int]  # None for FA1.2 pools
+    lqt_address: str
+    xtz_volume: Optional[int]  # None for pools launched before it, which keep `history`
+    user_investments: BigMap  # address -> Investment
+    reserve: str
+    # price and volume accumulators, None for pools launched before them
+    xtz_price_cumulative: Optional[int]
+    token_price_cumulative: Optional[int]
+    xtz_volume_cumulative: Optional[int]
+    last_update: Optional[int]
+    user_positions: Optional[BigMap]  # address -> Position, None for pools launched before them
+    history: Optional[BigMap]  # "tokenPool", "xtzPool", "xtzVolume" -> nat, on the first pools only
+
+
+class FactoryStorage(NamedTuple):
+    swaps: BigMap  # index -> pool address
+    token_to_swaps: BigMap  # token address, or (address, token id) for FA2 -> pool address
+    counter: int
+    empty_user_investments: BigMap
+    empty_user_positions: Optional[BigMap]  # None for factories deployed before it
+    empty_tokens: BigMap
+    empty_allowances: BigMap
+    default_reserve: str
+    default_token_metadata: BigMap
+    default_metadata: BigMap
+
+
+class LqtStorage(NamedTuple):
+    tokens: BigMap  # address -> balance
+    allowances: BigMap  # (owner, spender) -> allowance
+    admin: str
+    total_supply: int
+    metadata: BigMap
+    token_metadata: BigMap
+
+
+# storage classes by a field only their contract has
+STORAGE_TYPES = {"xtzPool": DexStorage, "swaps": FactoryStorage, "total_supply": LqtStorage}
+DEFAULTS = {"token_id": None, "xtz_price_cumulative": None, "token_price_cumulative": None,
+            "xtz_volume_cumulative": None, "last_update": None, "user_positions": None,
+            "empty_user_positions": None, "xtz_volume": None, "history": None}
+
+
+def _field_name(name: str) -> str:
+    """The storage annotation of the field `name`: `xtz_pool` is `xtzPool`,
+    `user_investments` is itself."""
+    return re.sub(r"_([a-z])", lambda match: match.group(1).upper(), name)
+
+
+class Snapshot:
+    """Storage and balances of some contracts at one block."""
+
+    def __init__(self, level: int, timestamp: str, block_hash: Optional[str],
+                 storages: Dict[str, Any], balances: Dict[str, int]):
+        self.level = level
+        self.timestamp = timestamp
+        self.block_hash = block_hash  # None on a LocalChain
+        self.storages = storages
+        self.balances = balances
+
+    def __getitem__(self, address: str):
+        return self.storages[address]
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.storages
+
+
+class StorageReader:
+    """Reads snapshots from `source` with up to `workers` concurrent requests."""
+
+    def __init__(self, source, workers: int = 8):
+        self.source = source
+        self.workers = workers
+        self.decoders: Dict[str, _Decoder] = {}
+
+    def read(self, addresses: Iterable[str], keys: Optional[Dict[str, Iterable]] = None) -> Snapshot:
+        """Storage of `addresses` with the entries of `keys` in their big_maps."""
+        source, header = self._pin()
+        addresses = list(dict.fromkeys(addresses))
+        with ThreadPoolExecutor(self.workers) as pool:
+            contracts = list(pool.map(source.contract, addresses))
+            storages = {
+                address: self._decoder(contract["script"]["code"]).storage(contract["script"]["storage"])
+                for address, contract in zip(addresses, contracts)
+            }
+            lookups = list(self._lookups(addresses, contracts, storages, keys or {}))
+            values = list(pool.map(lambda lookup: source.big_map_value(lookup[2], lookup[3]), lookups))
+        entries: Dict[Tuple[str, str], dict] = {}
+        for (address, name, _, _, key, value_type), value in zip(lookups, values):
+            if value is not None:
+                entries.setdefault((address, name), {})[key] = value_type.from_micheline_value(value).to_python_object()
+        return Snapshot(
+            level=int(header["level"]),
+            timestamp=header["timestamp"],
+            block_hash=header.get("hash"),
+            storages={
+                address: self._typed(address, storage, entries)
+                for address, storage in storages.items()
+            },
+            balances={address: int(contract["balance"]) for address, contract in zip(addresses, contracts)},
+        )
+
+    def decode(self, address: str, contract: dict):
+        """Typed storage of the `contract` (as returned by `source.contract`)
+        at `address`, without big_map entries."""
+        script = contract["script"]
+        return self._typed(address, self._decoder(script["code"]).storage(script["storage"]), {})
+
+    def _pin(self):
+        return pin(self.source)
+
+    def _decoder(self, code: List[dict]) -> _Decoder:
+        key = code_hash(code)
+        if key not in self.decoders:
+            self.decoders[key] = _Decoder(code)
+        return self.decoders[key]
+
+    def _lookups(self, addresses, contracts, storages, keys: Dict[str, Iterable]):
+        """(address, field, ptr, key hash, key, value type) of every big_map entry to read."""
+        keys = {name: list(values) for name, values in keys.items()}
+        for address, contract in zip(addresses, contracts):
+            decoder = self._decoder(contract["script"]["code"])
+            for name, values in keys.items():
+                if name not in decoder.big_map_types:
+                    continue
+                key_type, value_type = decoder.big_map_types[name]
+                for key in values:
+                    key_hash = forge_script_expr(key_type.from_python_object(key).pack(legacy=True))
+                    yield address, name, storages[address][name], key_hash, key, value_type
+
+    @staticmethod
+    def _typed(address: str, storage, entries: Dict[Tuple[str, str], dict]):
+        cls = next((cls for field, cls in STORAGE_TYPES.items() if isinstance(storage, dict) and field in storage), None)
+        if cls is None:
+            return storage
+        fields = {}
+        for name in cls._fields:
+            field = name if name in storage else _field_name(name)
+            if field not in storage:
+                fields[name] = DEFAULTS[name]
+                continue
+            value = storage[field]
+            if cls.__annotations__[name] in (BigMap, Optional[BigMap]):
+                values = entries.get((address, field), {})
+                if name == "user_investments":
+                    values = {
+                        key: Investment(entry["xtz"], entry["token"], INVESTMENT_DIRECTIONS[entry["direction"]])
+                        for key, entry in values.items()
+                    }
+                elif name == "user_positions":
+                    values = {
+                        key: Position(*(entry[_field_name(field)] for field in Position._fields))
+                        for key, entry in values.items()
+                    }
+                value = BigMap(value, values)
+            fields[name] = value
+        return cls(**fields)
+
+
+def pin(source):
+    """`source` read at its current block, and the header of that block. A
+    `LocalChain` only has its head, which cannot move during a read."""
+    if hasattr(source, "at"):
+        header = source.header()
+        return source.at(header["hash"]), header
+    return source, source.block(source.head_level())["header"]
+
+
+def read_snapshot(source, addresses: Iterable[str], keys: Optional[Dict[str, Iterable]] = None) -> Snapshot:
+    """One `StorageReader(source).read(addresses, keys)`."""
+    return StorageReader(source).read(addresses, keys)
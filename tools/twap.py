@@ -0,0 +1,86 @@
+"""Time-weighted average prices and window volumes of a dex pool.
+
+Dex storage keeps, besides the pools, three accumulators and the time they
+were last brought up to date (`lastUpdate`):
+
+- `xtzPriceCumulative`: the sum of the token per mutez prices of the pools,
+  `tokenPool * 2**64 // xtzPool`, each times the seconds it held;
+- `tokenPriceCumulative`: the same for the mutez per token prices,
+  `xtzPool * 2**64 // tokenPool`;
+- `xtzVolumeCumulative`: the tez traded by every swap, in mutez.
+
+Every call of the dex adds the prices of the pools it starts from before it
+changes them, so the accumulators grow linearly between calls and two reads
+of the `getCumulatives` view, which brings them up to the current block,
+give the averages and the volume between the reads without following the
+blocks in between:
+
+    start = read(swap)
+    ...
+    window = average(start, read(swap))
+    window.xtz_price, window.token_price, window.xtz_volume
+
+The two prices are averaged separately: the average of the mutez per token
+price is not the inverse of the average of the token per mutez price.
+"""
+
+from datetime import datetime
+from fractions import Fraction
+from typing import NamedTuple, Optional, Union
+
+PRICE_SCALE = 2 ** 64
+
+
+class Cumulatives(NamedTuple):
+    xtz_price: int  # xtzPriceCumulative
+    token_price: int  # tokenPriceCumulative
+    xtz_volume: int  # xtzVolumeCumulative, in mutez
+    timestamp: int  # seconds since the epoch
+
+
+class Window(NamedTuple):
+    seconds: int
+    xtz_price: Optional[Fraction]  # tokens per mutez, None for an empty window
+    token_price: Optional[Fraction]  # mutez per token, None for an empty window
+    xtz_volume: int  # in mutez
+
+
+def _seconds(timestamp: Union[int, str]) -> int:
+    if isinstance(timestamp, int):
+        return timestamp
+    return int(datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp())
+
+
+def read(swap) -> Cumulatives:
+    """The accumulators of the dex contract `swap` at the current block,
+    from its `getCumulatives` view."""
+    view = swap.getCumulatives().run_view()
+    return Cumulatives(int(view["xtzPriceCumulative"]), int(view["tokenPriceCumulative"]),
+                       int(view["xtzVolumeCumulative"]), _seconds(view["timestamp"]))
+
+
+def advance(storage: dict, now: Union[int, str]) -> Cumulatives:
+    """The accumulators of the dex `storage` brought up to `now`, as the view
+    and the next call compute them."""
+    xtz_pool, token_pool = int(storage["xtzPool"]), int(storage["tokenPool"])
+    elapsed = _seconds(now) - _seconds(storage["lastUpdate"])
+    xtz_price, token_price = int(storage["xtzPriceCumulative"]), int(storage["tokenPriceCumulative"])
+    if xtz_pool:
+        xtz_price += token_pool * PRICE_SCALE // xtz_pool * elapsed
+    if token_pool:
+        token_price += xtz_pool * PRICE_SCALE // token_pool * elapsed
+    return Cumulatives(xtz_price, token_price, int(storage["xtzVolumeCumulative"]), _seconds(now))
+
+
+def average(start: Cumulatives, end: Cumulatives) -> Window:
+    """The average prices and the volume between two reads."""
+    seconds = end.timestamp - start.timestamp
+    if seconds < 0:
+        raise ValueError("the end of the window is before its start")
+    scale = seconds * PRICE_SCALE
+    return Window(
+        seconds=seconds,
+        xtz_price=Fraction(end.xtz_price - start.xtz_price, scale) if seconds else None,
+        token_price=Fraction(end.token_price - start.token_price, scale) if seconds else None,
+        xtz_volume=end.xtz_volume - start.xtz_volume,
+    )
@@ -0,0 +1,204 @@
+"""On-chain and TZIP-16 off-chain views of the dex and its liquidity token.
+
+The views at the end of dex.mligo return what the swap and liquidity
+entrypoints would compute against the current pools, with the same integer
+arithmetic and without their checks:
+
+- `getXtzToTokenPrice` (mutez): tokens bought by `xtzToToken`;
+- `getXtzToTokenReserveFee` (mutez): tez `xtzToToken` sends to the reserve;
+- `getTokenToXtzPrice` (nat): tez bought by `tokenToXtz`;
+- `getTokenToXtzReserveFee` (nat): tez `tokenToXtz` sends to the reserve;
+- `getLiquidityValue` (nat): tez and tokens `removeLiquidity` withdraws;
+- `getCumulatives` (unit): the price and volume accumulators, brought up to
+  the current block;
+- `getHistory` (unit): the "tokenPool", "xtzPool" and "xtzVolume" entries
+  of the `history` big_map the first dex contracts kept;
+- `getPosition` (address): the tez and tokens the address deposited and
+  withdrew, and the liquidity tokens it still holds from its deposits with
+  their cost.
+
+The liquidity token (lqt_fa12.mligo) has the views of `LQT_VIEWS`, which
+return what its callback entrypoints send, without the internal operation
+and the callback contract:
+
+- `get_balance` (address): the balance of the address;
+- `get_allowance` (owner, spender): the allowance of the spender;
+- `get_total_supply` (unit): the total supply.
+
+compile.sh compiles each view function to a lambda with `compile
+expression` and appends it to the compiled contract as a `view` section:
+
+    python -m tools.views add michelson/dex_fa12.tz dex.mligo --ligo "docker run ... ligolang/ligo:0.34.0"
+    python -m tools.views add michelson/lqt_fa12.tz lqt_fa12.mligo --views lqt --ligo "..."
+
+The dex storage has no `%metadata` big_map, so the TZIP-16 views are
+published as a document to host off-chain; `metadata` builds it from the
+view sections of a contract, whose code takes the same `(parameter,
+storage)` pair as a `michelsonStorageView`:
+
+    python -m tools.views metadata michelson/dex_fa12.tz > dex_fa12_metadata.json
+"""
+
+import json
+import shlex
+import subprocess
+import sys
+from typing import Dict, List, NamedTuple
+
+from pytezos.michelson.format import micheline_to_michelson
+from pytezos.michelson.parse import michelson_to_micheline
+
+from tools.global_constants import load
+
+
+class View(NamedTuple):
+    function: str  # the LIGO function of dex.mligo
+    parameter: str
+    return_type: str
+    description: str
+
+
+VIEWS: Dict[str, View] = {
+    "getCumulatives": View(
+        "get_cumulatives", "unit",
+        "(pair (nat %xtzPriceCumulative) (pair (nat %tokenPriceCumulative) "
+        "(pair (nat %xtzVolumeCumulative) (timestamp %timestamp))))",
+        "Time-weighted sums of the prices of the pools and the tez volume traded, at the current block",
+    ),
+    "getHistory": View(
+        "get_history", "unit", "(map string nat)",
+        "The tokenPool, xtzPool and xtzVolume entries of the history big_map of the first dex contracts",
+    ),
+    "getLiquidityValue": View(
+        "get_liquidity_value", "nat", "(pair (mutez %xtz) (nat %tokens))",
+        "Tez and tokens withdrawn by burning the given amount of liquidity tokens",
+    ),
+    "getPosition": View(
+        "get_position", "address",
+        "(pair (mutez %xtzDeposited) (pair (nat %tokensDeposited) (pair (mutez %xtzWithdrawn) "
+        "(pair (nat %tokensWithdrawn) (pair (nat %lqt) (pair (mutez %xtzCost) (nat %tokenCost)))))))",
+        "Running totals of the liquidity an address added and removed, with the cost of the liquidity tokens it holds",
+    ),
+    "getTokenToXtzPrice": View(
+        "get_token_to_xtz_price", "nat", "mutez",
+        "Tez bought by selling the given amount of tokens",
+    ),
+    "getTokenToXtzReserveFee": View(
+        "get_token_to_xtz_reserve_fee", "nat", "mutez",
+        "Tez sent to the reserve when selling the given amount of tokens",
+    ),
+    "getXtzToTokenPrice": View(
+        "get_xtz_to_token_price", "mutez", "nat",
+        "Tokens bought by selling the given amount of tez",
+    ),
+    "getXtzToTokenReserveFee": View(
+        "get_xtz_to_token_reserve_fee", "mutez", "mutez",
+        "Tez sent to the reserve when selling the given amount of tez",
+    ),
+}
+
+LQT_VIEWS: Dict[str, View] = {
+    "get_allowance": View(
+        "get_allowance", "(pair (address %owner) (address %spender))", "nat",
+        "Tokens the spender may transfer from the owner",
+    ),
+    "get_balance": View(
+        "get_balance", "address", "nat",
+        "Liquidity tokens held by the given address",
+    ),
+    "get_total_supply": View(
+        "get_total_supply", "unit", "nat",
+        "Liquidity tokens in circulation",
+    ),
+}
+CONTRACT_VIEWS = {"dex": VIEWS, "lqt": LQT_VIEWS}
+
+
+def view_section(name: str, code: List[dict], views: Dict[str, View] = VIEWS) -> dict:
+    view = views[name]
+    return {
+        "prim": "view",
+        "args": [
+            {"string": name},
+            michelson_to_micheline(view.parameter),
+            michelson_to_micheline(view.return_type),
+            code,
+        ],
+    }
+
+
+def compile_views(source: str, ligo: str, views: Dict[str, View] = VIEWS) -> Dict[str, List[dict]]:
+    """The code of every view of `views`, compiled from the functions of
+    `source` by the `ligo` command."""
+    lambdas = {}
+    for name, view in views.items():
+        michelson = subprocess.run(
+            [*shlex.split(ligo), "compile", "expression", "cameligo", view.function, "--init-file", source,
+             "--protocol", "hangzhou"],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        lambdas[name] = michelson_to_micheline(michelson)
+    return lambdas
+
+
+def add_views(michelson: str, lambdas: Dict[str, List[dict]], views: Dict[str, View] = VIEWS) -> str:
+    """The contract `michelson` with a `view` section per lambda appended."""
+    head = michelson.rstrip()
+    if not head.endswith("}"):
+        raise ValueError("expected a contract in braces")
+    sections = []
+    for name in sorted(lambdas):
+        section = micheline_to_michelson(view_section(name, lambdas[name], views), inline=False)
+        sections.append("\n".join("  " + line for line in section.split("\n")))
+    return head[:-1].rstrip() + " ;\n" + " ;\n".join(sections) + " }\n"
+
+
+def metadata(code: List[dict], name: str = "Dex") -> dict:
+    """TZIP-16 metadata of the contract `code` with its views as
+    `michelsonStorageView`s."""
+    descriptions = {view_name: view.description for views in CONTRACT_VIEWS.values() for view_name, view in views.items()}
+    views = []
+    for section in code:
+        if section["prim"] != "view":
+            continue
+        view_name = section["args"][0]["string"]
+        parameter, return_type, view_code = section["args"][1:]
+        views.append({
+            "name": view_name,
+            "description": descriptions.get(view_name, ""),
+            "pure": True,
+            "implementations": [{
+                "michelsonStorageView": {
+                    "parameter": parameter,
+                    "returnType": return_type,
+                    "code": view_code,
+                },
+            }],
+        })
+    return {"name": name, "interfaces": ["TZIP-016"], "views": views}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Views of the compiled dex.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="append the views of a LIGO source to a compiled contract")
+    add.add_argument("contract")
+    add.add_argument("source")
+    add.add_argument("--ligo", default="ligo")
+    add.add_argument("--views", choices=sorted(CONTRACT_VIEWS), default="dex")
+    tzip16 = commands.add_parser("metadata", help="print the TZIP-16 metadata of the views of a contract")
+    tzip16.add_argument("contract")
+    tzip16.add_argument("--name", default="Dex")
+    args = parser.parse_args()
+
+    if args.command == "add":
+        with open(args.contract) as f:
+            michelson = f.read()
+        with open(args.contract, "w") as f:
+            views = CONTRACT_VIEWS[args.views]
+            f.write(add_views(michelson, compile_views(args.source, args.ligo, views), views))
+    else:
+        json.dump(metadata(load(args.contract), args.name), sys.stdout, indent=2)
+        sys.stdout.write("\n")